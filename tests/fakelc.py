@@ -0,0 +1,188 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Fake `lc` program for tests
+
+Reads `lcin.active` from current directory and writes `light.dat`/`veloc.dat` with synthetic
+curves, one block per bundle. Behaviour can be tuned by environment variables:
+    FAKELC_SLEEP - seconds to sleep before writing output
+    FAKELC_COUNTER - file, a line is appended to it on every run
+    FAKELC_ERROR - error message printed to stderr (as `lc` does)
+    FAKELC_STRAGGLER - `run:seconds`, the run-th run (counted by FAKELC_COUNTER) sleeps additional seconds
+
+Use `install()` to create `lc` executable wrapper in a directory,
+or derive test case from `FakeLcTestCase` which configures fake `lc` as `lc` executable.
+"""
+import fcntl
+import math
+import os
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+
+def install(directory, sleep=None, counter=None, error=None, straggler=None) -> str:
+    """Writes fake `lc` executable into `directory`, returns its path"""
+    path = os.path.join(directory, 'fakelc')
+    with open(path, 'w') as fd:
+        print('#!/bin/sh', file=fd)
+        if sleep is not None:
+            print(f'export FAKELC_SLEEP={sleep}', file=fd)
+        if counter is not None:
+            print(f'export FAKELC_COUNTER={counter}', file=fd)
+        if error is not None:
+            print(f'export FAKELC_ERROR="{error}"', file=fd)
+        if straggler is not None:
+            print(f'export FAKELC_STRAGGLER={straggler[0]}:{straggler[1]}', file=fd)
+        print(f'exec "{sys.executable}" "{os.path.abspath(__file__)}" "$@"', file=fd)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+class FakeLcTestCase(unittest.TestCase):
+    """Installs fake `lc` as configured executable"""
+
+    fakelc_kwargs = {}
+
+    def setUp(self):
+        from wdwrap.cache import LcResultCache
+        from wdwrap.config import cfg
+        from wdwrap.cpuslots import CpuSlots
+        self._cache = LcResultCache.default_instance()
+        LcResultCache.set_default_instance(None)
+        self._slots = CpuSlots.default_instance()
+        CpuSlots.set_default_instance(None)  # host may have few cores, tests limit slots explicitly
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.counter = os.path.join(self.tmpdir.name, 'counter')
+        self._lc = cfg().get('executables', 'lc')
+        cfg().set('executables', 'lc', install(self.tmpdir.name, counter=self.counter, **self.fakelc_kwargs))
+
+    def tearDown(self):
+        from wdwrap.cache import LcResultCache
+        from wdwrap.config import cfg
+        from wdwrap.cpuslots import CpuSlots
+        cfg().set('executables', 'lc', self._lc)
+        LcResultCache.set_default_instance(self._cache)
+        CpuSlots.set_default_instance(self._slots)
+        self.tmpdir.cleanup()
+
+    def runs_count(self):
+        try:
+            with open(self.counter) as fd:
+                return len(fd.readlines())
+        except IOError:
+            return 0
+
+    @staticmethod
+    def scheduler(backend=None, executors=None, autoscale=False, **kwargs):
+        """Creates JobScheduler (aside of singleton instance) with `InlineBackend` by default"""
+        from wdwrap.backends import InlineBackend
+        from wdwrap.jobs import JobScheduler
+        from wdwrap.runners import LcRunner, LcBatchRunner
+        if backend is None:
+            backend = InlineBackend()
+        if executors is None:
+            executors = {'lc': LcRunner(), 'lc-batch': LcBatchRunner()}
+        instance = JobScheduler._instance
+        JobScheduler._instance = None
+        try:
+            ret = JobScheduler(executors, backend=backend, **kwargs)
+        finally:
+            JobScheduler._instance = instance
+        if not autoscale:
+            ret.autoscaler = None
+        return ret
+
+    @staticmethod
+    def segment_bundles(n=4, rv=False):
+        import wdwrap
+        from wdwrap.drivers import MPAGE
+        bundle = wdwrap.default_binary()
+        bundle['MPAGE'] = MPAGE.VELOC if rv else MPAGE.LIGHT
+        ret = []
+        for s in range(n):
+            b = bundle.clone()
+            b['PHSTRT'] = s / n
+            b['PHSTOP'] = (s + 1) / n
+            b['PHIN'] = 0.01
+            ret.append(b)
+        return ret
+
+
+def _float(s):
+    return float(s.replace('D', 'e').replace('d', 'e'))
+
+
+def read_bundles(filename='lcin.active'):
+    """Minimal lcin parser, returns list of dicts with output controlling values"""
+    with open(filename) as fd:
+        lines = [l.split() for l in fd if l.strip()]
+    bundles = []
+    n = 0
+    while n < len(lines) and lines[n][0] != '9':
+        l1, l2, l3 = lines[n], lines[n + 1], lines[n + 2]
+        bundles.append({
+            'MPAGE': int(l1[0]),
+            'JDPHS': int(l2[0]), 'HJD0': _float(l2[1]), 'PERIOD': _float(l2[2]),
+            'HJDST': _float(l3[0]), 'HJDSP': _float(l3[1]), 'HJDIN': _float(l3[2]),
+            'PHSTRT': _float(l3[3]), 'PHSTOP': _float(l3[4]), 'PHIN': _float(l3[5]),
+        })
+        n += 8
+        for terminator in [300., 300., 150.]:
+            while _float(lines[n][0]) != terminator:
+                n += 1
+            n += 1
+    return bundles
+
+
+def phases(b):
+    start, stop, step = b['PHSTRT'], b['PHSTOP'], b['PHIN']
+    count = int((stop - start) / step + 1e-6) + 1
+    return [start + k * step for k in range(count)]
+
+
+def light(ph):
+    p = ph % 1.0
+    dip1 = 0.8 * math.exp(-(min(p, 1.0 - p) / 0.03) ** 2)
+    dip2 = 0.4 * math.exp(-((p - 0.5) / 0.03) ** 2)
+    return 1.0 - dip1 - dip2
+
+
+def main():
+    run = 0
+    if os.environ.get('FAKELC_COUNTER'):
+        with open(os.environ['FAKELC_COUNTER'], 'a+') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)  # concurrent runs get distinct numbers
+            print(os.getpid(), file=fd)
+            fd.flush()
+            fd.seek(0)
+            run = len(fd.readlines())
+    if os.environ.get('FAKELC_STRAGGLER'):
+        straggler, seconds = os.environ['FAKELC_STRAGGLER'].split(':')
+        if run == int(straggler):
+            time.sleep(float(seconds))
+    if os.environ.get('FAKELC_SLEEP'):
+        time.sleep(float(os.environ['FAKELC_SLEEP']))
+    if os.environ.get('FAKELC_ERROR'):
+        print(f'error: {os.environ["FAKELC_ERROR"]}', file=sys.stderr)
+        return
+    bundles = read_bundles()
+    with open('light.dat', 'w') as lfd, open('veloc.dat', 'w') as vfd:
+        for b in bundles:
+            if b['MPAGE'] == 1:
+                print(' #  q=   1.0000000000000000       fake lc output', file=lfd)
+                for ph in phases(b):
+                    l1 = light(ph)
+                    mag = -2.5 * math.log10(l1)
+                    print(f' {b["HJD0"] + ph * b["PERIOD"]:14.6f} {ph:14.5f} {l1 / 2:11.8f} {l1 / 2:11.8f}'
+                          f' {l1:11.8f} {l1:11.8f} {1.0:10.5f} {15.0 + mag:10.4f} {mag:10.4f}   0.000000D+00',
+                          file=lfd)
+            elif b['MPAGE'] == 2:
+                for ph in phases(b):
+                    rv1 = math.sin(2 * math.pi * ph)
+                    print(f' {b["HJD0"] + ph * b["PERIOD"]:14.6f} {ph:12.5f} {0.3 * rv1:11.6f} {-0.5 * rv1:11.6f}'
+                          f'   0.000000    0.000000 {rv1:14.6E} {-1.6 * rv1:14.6E}   0.000000E+00', file=vfd)
+
+
+if __name__ == '__main__':
+    main()
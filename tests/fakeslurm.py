@@ -0,0 +1,139 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Fake SLURM-style batch scheduler for tests
+
+Implements subset of `sbatch`, `squeue` and `scancel` used by `BatchBackend`, tasks are run
+on the local host. State is kept in directory given by `--state` option:
+    <state>/last-job - last job id
+    <state>/<job>/<task> - not finished task, contains pid of running task's process group
+Commands:
+    fakeslurm.py --state DIR sbatch --parsable SCRIPT
+    fakeslurm.py --state DIR squeue -h -r -j JOB -o %i
+    fakeslurm.py --state DIR scancel JOB[_TASK]
+Tasks of array run `FAKESLURM_PARALLEL` (default 2) at once.
+
+Use `commands()` to get commands for `BatchBackend`.
+"""
+import os
+import re
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+
+
+def commands(state: str) -> dict:
+    """`BatchBackend` keyword arguments of fake scheduler keeping state in `state` directory"""
+    prefix = f'{shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))} --state {shlex.quote(state)}'
+    return {'submit': f'{prefix} sbatch', 'queue': f'{prefix} squeue', 'cancel': f'{prefix} scancel'}
+
+
+def sbatch(state, args):
+    script = args[-1]
+    with open(script) as fd:
+        text = fd.read()
+    first, last = map(int, re.search(r'^#SBATCH --array=(\d+)-(\d+)', text, re.M).groups())
+    output = re.search(r'^#SBATCH --output=(.*)$', text, re.M).group(1)
+    with open(os.path.join(state, 'last-job'), 'a+') as fd:
+        fd.seek(0)
+        job = len(fd.read().split()) + 1
+        print(job, file=fd)
+    os.makedirs(os.path.join(state, str(job)))
+    for n in range(first, last + 1):
+        open(os.path.join(state, str(job), str(n)), 'w').close()
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), '--state', state, 'run', str(job), script, output],
+                     start_new_session=True, stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    print(job)
+
+
+def run(state, job, script, output):
+    directory = os.path.join(state, job)
+    tasks = sorted(int(n) for n in os.listdir(directory))
+    lock = threading.Lock()
+
+    def run_task(n):
+        path = os.path.join(directory, str(n))
+        with lock:
+            if not os.path.exists(path):  # cancelled
+                return
+            with open(output.replace('%a', str(n)), 'w') as out:
+                env = dict(os.environ, SLURM_ARRAY_JOB_ID=job, SLURM_ARRAY_TASK_ID=str(n))
+                proc = subprocess.Popen(['/bin/sh', script], env=env, stdout=out, stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+            with open(path, 'w') as fd:
+                print(proc.pid, file=fd)
+        proc.wait()
+        with lock:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def run_tasks():
+        while True:
+            with lock:
+                if not tasks:
+                    return
+                n = tasks.pop(0)
+            run_task(n)
+
+    threads = [threading.Thread(target=run_tasks) for _ in range(int(os.environ.get('FAKESLURM_PARALLEL', 2)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    try:
+        os.rmdir(directory)
+    except OSError:
+        pass
+
+
+def squeue(state, args):
+    job = args[args.index('-j') + 1]
+    directory = os.path.join(state, job)
+    try:
+        tasks = sorted(int(n) for n in os.listdir(directory))
+    except OSError:
+        print('slurm_load_jobs error: Invalid job id specified', file=sys.stderr)
+        sys.exit(1)
+    for n in tasks:
+        print(f'{job}_{n}')
+
+
+def scancel(state, args):
+    for arg in args:
+        job, _, task = arg.partition('_')
+        directory = os.path.join(state, job)
+        try:
+            tasks = [task] if task else os.listdir(directory)
+        except OSError:
+            continue
+        for n in tasks:
+            path = os.path.join(directory, n)
+            try:
+                with open(path) as fd:
+                    pid = fd.read().strip()
+                os.remove(path)
+            except OSError:
+                continue
+            if pid:
+                try:
+                    os.killpg(int(pid), signal.SIGKILL)
+                except OSError:
+                    pass
+
+
+def main(argv):
+    if argv[0] != '--state':
+        sys.exit('Usage: fakeslurm.py --state DIR command args...')
+    state, command, args = argv[1], argv[2], argv[3:]
+    os.makedirs(state, exist_ok=True)
+    if command == 'run':  # tasks of submitted job, started by sbatch
+        run(state, *args)
+    else:
+        {'sbatch': sbatch, 'squeue': squeue, 'scancel': scancel}[command](state, args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,106 @@
+"""
+Unit tests of batch queue (array job) backend
+"""
+import os
+import time
+import unittest
+
+from fakelc import FakeLcTestCase
+import fakeslurm
+
+
+class TestBatchBackend(FakeLcTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.state = os.path.join(self.tmpdir.name, 'slurm')
+        self.shared = os.path.join(self.tmpdir.name, 'shared')
+
+    def backend(self, **kwargs):
+        from wdwrap.backends import BatchBackend
+        b = BatchBackend(directory=self.shared, **fakeslurm.commands(self.state), **kwargs)
+        b.poll_interval = 0.05
+        b.queue_interval = 0.5
+        return b
+
+    def jobs_count(self):
+        try:
+            with open(os.path.join(self.state, 'last-job')) as fd:
+                return len(fd.read().split())
+        except IOError:
+            return 0
+
+    def test_array_job(self):
+        from wdwrap.runners import LcRunner
+        bundles = self.segment_bundles(4)
+        s = self.scheduler(self.backend())
+        try:
+            futures = [s.schedule('lc', b) for b in bundles]
+            results = [f.result(timeout=60) for f in futures]
+        finally:
+            s.backend.shutdown()
+        self.assertEqual(self.jobs_count(), 1)  # all jobs in one array job
+        for b, r in zip(bundles, results):
+            expected = LcRunner().run(b)['light']
+            self.assertTrue((r['light']['mag'].values == expected['mag'].values).all())
+        self.assertFalse([n for n in os.listdir(self.shared) if n.startswith('wdwrap_array-')])  # removed
+
+    def test_not_speculative(self):
+        b = self.backend()
+        try:
+            self.assertFalse(self.scheduler(b).speculative)  # `[jobs] speculative = auto`
+        finally:
+            b.shutdown()
+
+    def test_script(self):
+        b = self.backend()
+        script = b.render_script('/shared/arr', 3)
+        self.assertIn('#SBATCH --array=0-2', script)
+        self.assertIn('/shared/arr/logs/%a.out', script)
+        self.assertIn('wdwrap.worker', script)
+
+    def test_lost_task(self):
+        b = self.backend()
+        try:
+            f = b.submit(os._exit, 3)  # task process dies, no result
+            with self.assertRaises(RuntimeError):
+                f.result(timeout=30)
+        finally:
+            b.shutdown()
+
+    def test_task_error(self):
+        b = self.backend()
+        try:
+            f = b.submit(divmod, 1, 0)
+            with self.assertRaises(ZeroDivisionError):
+                f.result(timeout=30)
+        finally:
+            b.shutdown()
+
+    def test_submit_failure(self):
+        from wdwrap.backends import BatchBackend
+        b = BatchBackend(directory=self.shared, submit='false')
+        try:
+            with self.assertRaises(RuntimeError):
+                b.submit(divmod, 1, 1).result(timeout=10)
+        finally:
+            b.shutdown()
+
+    def test_cancel(self):
+        b = self.backend()
+        try:
+            f1 = b.submit(time.sleep, 30)
+            f2 = b.submit(divmod, 7, 2)
+            self.assertEqual(f2.result(timeout=30), (3, 1))
+            f1.cancel()
+            self.assertTrue(f1.cancelled())
+            deadline = time.monotonic() + 10
+            while os.path.exists(os.path.join(self.state, '1')) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertFalse(os.path.exists(os.path.join(self.state, '1')))  # task killed, job finished
+        finally:
+            b.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
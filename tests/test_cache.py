@@ -0,0 +1,68 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""
+Unit tests of LC results cache
+"""
+import tempfile
+import unittest
+
+
+class TestLcResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_memory_lru(self):
+        from wdwrap.cache import LcResultCache
+        c = LcResultCache(memory_items=2)
+        c.put('a', {'light': 1})
+        c.put('b', {'light': 2})
+        c.get('a')
+        c.put('c', {'light': 3})  # evicts 'b'
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('a'), {'light': 1})
+        self.assertEqual(c.stats()['hits'], 2)
+        self.assertEqual(c.stats()['misses'], 1)
+
+    def test_results_copied(self):
+        import pandas as pd
+        from wdwrap.cache import LcResultCache
+        c = LcResultCache(memory_items=2)
+        result = {'light': pd.DataFrame({'ph': [0.0, 0.5], 'mag': [1.0, 2.0]})}
+        c.put('a', result)
+        result['light']['mag'] += 10.0
+        c.get('a')['light']['mag'] += 10.0
+        self.assertEqual(list(c.get('a')['light']['mag']), [1.0, 2.0])
+
+    def test_disk_store(self):
+        from wdwrap.cache import LcResultCache
+        c1 = LcResultCache(memory_items=0, directory=self.tmpdir.name)
+        c1.put('ab01', {'light': [1, 2, 3]})
+        c2 = LcResultCache(memory_items=10, directory=self.tmpdir.name)
+        self.assertEqual(c2.get('ab01'), {'light': [1, 2, 3]})
+        self.assertEqual(c2.stats()['disk_hits'], 1)
+
+    def test_disk_eviction(self):
+        from wdwrap.cache import LcResultCache
+        c = LcResultCache(memory_items=0, directory=self.tmpdir.name, disk_size=3000)
+        for n in range(10):
+            c.put(f'{n:04d}', {'light': bytes(1000)})
+        self.assertLessEqual(c.stats()['disk_bytes'], 3000)
+        self.assertIsNotNone(c.get('0009'))
+        self.assertIsNone(c.get('0000'))
+
+    def test_job_key(self):
+        import wdwrap
+        from wdwrap.runners import LcRunner
+        r = LcRunner()
+        b1 = wdwrap.default_binary()
+        b2 = wdwrap.default_binary()
+        self.assertEqual(r.job_key(b1), r.job_key(b2))
+        b2['PHSTOP'] = 0.5
+        self.assertNotEqual(r.job_key(b1), r.job_key(b2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+Unit tests of CPU slots
+"""
+import os
+import tempfile
+import unittest
+
+from fakelc import FakeLcTestCase
+
+
+class TestCpuSlots(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_parse_cpu_list(self):
+        from wdwrap.cpuslots import _parse_cpu_list
+        self.assertEqual(_parse_cpu_list('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+
+    def test_physical_cores(self):
+        from wdwrap.cpuslots import physical_cores, available_cpus
+        cores = physical_cores()
+        self.assertGreater(len(cores), 0)
+        self.assertEqual(sorted(c for core in cores for c in core), available_cpus())
+
+    def test_exclusive(self):
+        from wdwrap.cpuslots import CpuSlots
+        slots = CpuSlots(2, directory=self.tmpdir.name)
+        s1 = slots.try_acquire()
+        s2 = slots.try_acquire()
+        self.assertEqual({s1.index, s2.index}, {0, 1})
+        self.assertIsNone(slots.try_acquire())
+        self.assertEqual(slots.busy_count(), 2)
+        other = CpuSlots(2, directory=self.tmpdir.name)  # e.g. other worker of the host
+        self.assertIsNone(other.try_acquire())
+        s1.release()
+        s3 = other.try_acquire()
+        self.assertEqual(s3.index, s1.index)
+        s2.release()
+        s3.release()
+        self.assertEqual(slots.busy_count(), 0)
+
+    def test_cancel_waiting(self):
+        from wdwrap.backends import EventCancelToken
+        from wdwrap.cpuslots import CpuSlots
+        from wdwrap.exceptions import JobCancelledError
+        slots = CpuSlots(1, directory=self.tmpdir.name)
+        with slots.slot():
+            token = EventCancelToken()
+            token.set()
+            with self.assertRaises(JobCancelledError):
+                slots.acquire(token)
+
+    def test_acquire_timeout(self):
+        from wdwrap.cpuslots import CpuSlots
+        slots = CpuSlots(1, directory=self.tmpdir.name)
+        with slots.slot():
+            with self.assertRaises(TimeoutError):
+                slots.acquire(timeout=0.1)
+
+    @unittest.skipUnless(hasattr(os, 'sched_getaffinity'), 'Linux only')
+    def test_pinned_before_exec(self):
+        import subprocess
+        import sys
+        from wdwrap.cpuslots import CpuSlots
+        slots = CpuSlots(1, pin=True, directory=self.tmpdir.name)
+        with slots.slot() as slot:
+            out = subprocess.check_output([sys.executable, '-c', 'import os; print(sorted(os.sched_getaffinity(0)))'],
+                                          preexec_fn=slot.preexec_fn(), text=True)
+        self.assertEqual(out.strip(), str(sorted(slot.cpus)))
+        unpinned = CpuSlots(1, directory=self.tmpdir.name).try_acquire()
+        self.assertIsNone(unpinned.preexec_fn())
+        unpinned.release()
+
+
+class TestRunnerSlots(FakeLcTestCase):
+    """lc processes are limited by CPU slots, not by workers"""
+
+    fakelc_kwargs = {'sleep': 0.3}
+
+    def test_slots_limit_lc(self):
+        import time
+        from wdwrap.backends import ThreadBackend
+        from wdwrap.cpuslots import CpuSlots
+        CpuSlots.set_default_instance(CpuSlots(1, pin=True, directory=self.tmpdir.name))
+        s = self.scheduler(ThreadBackend(workers=3))
+        start = time.monotonic()
+        futures = [s.schedule('lc', b) for b in self.segment_bundles(3)]
+        for f in futures:
+            self.assertIn('light', f.result(timeout=20))
+        self.assertGreater(time.monotonic() - start, 0.9)  # run one by one
+        self.assertEqual(CpuSlots.default_instance().busy_count(), 0)
+
+    def test_pinned(self):
+        from wdwrap.cpuslots import CpuSlots
+        from wdwrap.runners import LcRunner
+        slots = CpuSlots(1, pin=True, directory=self.tmpdir.name)
+        CpuSlots.set_default_instance(slots)
+        self.assertTrue(slots.cores[0])
+        ret = LcRunner().run(self.segment_bundles(1)[0])
+        self.assertIn('light', ret)
+
+    def test_timeout_includes_slot_wait(self):
+        from wdwrap.cpuslots import CpuSlots
+        from wdwrap.runners import LcRunner
+        slots = CpuSlots(1, directory=self.tmpdir.name)
+        CpuSlots.set_default_instance(slots)
+        with slots.slot():
+            with self.assertRaises(TimeoutError):
+                LcRunner().run(self.segment_bundles(1)[0], timeout=0.2)
+        self.assertEqual(self.runs_count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
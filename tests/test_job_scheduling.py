@@ -3,6 +3,8 @@ Unit tests of WD invocation
 """
 import unittest
 
+from fakelc import FakeLcTestCase
+
 
 class TestJobScheduling(unittest.TestCase):
     """ Tests Running WD Code"""
@@ -18,6 +20,428 @@ class TestJobScheduling(unittest.TestCase):
         print(r)
 
 
+class TestBackends(FakeLcTestCase):
+    """Tests JobScheduler with different backends, uses fake `lc`"""
+
+    def check_backend(self, backend):
+        from wdwrap.backends import JobFuture
+        s = self.scheduler(backend)
+        futures = [s.schedule('lc', b) for b in self.segment_bundles(4)]
+        for f in futures:
+            self.assertIsInstance(f, JobFuture)
+            self.assertEqual(len(f.result(timeout=30)['light']), 26)
+        backend.shutdown()
+
+    def test_inline(self):
+        from wdwrap.backends import InlineBackend
+        self.check_backend(InlineBackend())
+
+    def test_threads(self):
+        from wdwrap.backends import ThreadBackend
+        self.check_backend(ThreadBackend(workers=2))
+
+    def test_processes(self):
+        from wdwrap.backends import ProcessBackend
+        self.check_backend(ProcessBackend(workers=2))
+
+    def test_backend_from_config(self):
+        from wdwrap.backends import backend_from_config, ThreadBackend
+        from wdwrap.config import cfg
+        cfg().set('jobs', 'backend', 'threads')
+        try:
+            self.assertIsInstance(backend_from_config(), ThreadBackend)
+        finally:
+            cfg().set('jobs', 'backend', 'dask')
+
+    def test_schedule_async(self):
+        import asyncio
+        s = self.scheduler()
+
+        async def run_all():
+            return await asyncio.gather(*[s.schedule_async('lc', b) for b in self.segment_bundles(4)])
+
+        ret = asyncio.run(run_all())
+        self.assertEqual([len(r['light']) for r in ret], [26] * 4)
+
+    def test_cache_hit_is_ready(self):
+        from wdwrap.cache import LcResultCache
+        s = self.scheduler(cache=LcResultCache())
+        b = self.segment_bundles(1)[0]
+        s.schedule('lc', b).result()
+        f = s.schedule('lc', b.clone())
+        self.assertTrue(f.done())
+        self.assertEqual(self.runs_count(), 1)
+        self.assertEqual(s.cache_stats()['hits'], 1)
+
+
+class TestCancellation(FakeLcTestCase):
+    """Cancelling job future kills running `lc`"""
+
+    fakelc_kwargs = {'sleep': 5}
+
+    def test_runner_cancel_token(self):
+        import threading
+        from wdwrap.backends import EventCancelToken
+        from wdwrap.exceptions import JobCancelledError
+        from wdwrap.runners import LcRunner
+        token = EventCancelToken()
+        threading.Timer(0.3, token.set).start()
+        with self.assertRaises(JobCancelledError):
+            LcRunner().run(self.segment_bundles(1)[0], cancel_token=token)
+
+    def check_slot_freed(self, backend):
+        import time
+        s = self.scheduler(backend)
+        b1, b2 = self.segment_bundles(2)
+        f1 = s.schedule('lc', b1)
+        time.sleep(1.0)  # let it start
+        start = time.monotonic()
+        self.assertTrue(f1.cancel())
+        self.assertTrue(f1.cancelled())
+        # single worker, must be freed by killing lc of cancelled job, second job runs fake lc without sleep
+        import fakelc
+        fakelc.install(self.tmpdir.name)
+        f2 = s.schedule('lc', b2)
+        self.assertEqual(len(f2.result(timeout=10)['light']), 51)
+        self.assertLess(time.monotonic() - start, 4.0)
+        backend.shutdown()
+
+    def test_threads(self):
+        from wdwrap.backends import ThreadBackend
+        self.check_slot_freed(ThreadBackend(workers=1))
+
+    def test_processes(self):
+        from wdwrap.backends import ProcessBackend
+        self.check_slot_freed(ProcessBackend(workers=1))
+
+    def test_cancel_flags_removed(self):
+        """Flag files of cancelled jobs are removed, also of those cancelled while queued"""
+        import os
+        import time
+        from wdwrap.backends import FileCancelToken, ThreadBackend
+
+        class FlagBackend(ThreadBackend):
+            def make_cancel_token(self):
+                return FileCancelToken(directory=directory)
+
+        directory = os.path.join(self.tmpdir.name, 'cancel')
+        backend = FlagBackend(workers=1)
+        try:
+            s = self.scheduler(backend)
+            backend.workers = 2  # both jobs dispatched, the second waits in executor queue
+            f1, f2 = [s.schedule('lc', b) for b in self.segment_bundles(2)]
+            time.sleep(1.0)  # f1 running, f2 queued
+            f2.cancel()
+            f1.cancel()
+            deadline = time.monotonic() + 5.0
+            while os.listdir(directory) and time.monotonic() < deadline:
+                time.sleep(0.1)
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            backend.shutdown()
+
+
+class TestDeduplication(FakeLcTestCase):
+    """Identical jobs in flight are run once"""
+
+    fakelc_kwargs = {'sleep': 0.5}
+
+    def test_identical_jobs_run_once(self):
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=4))
+        b1, b2 = self.segment_bundles(2)
+        futures = [s.schedule('lc', b1.clone()) for _ in range(3)] + [s.schedule('lc', b2)]
+        results = [f.result(timeout=10) for f in futures]
+        self.assertEqual(self.runs_count(), 2)
+        self.assertEqual(s.deduplicated, 2)
+        self.assertTrue(results[0]['light'].equals(results[2]['light']))
+        self.assertIsNot(results[0]['light'], results[2]['light'])  # requesters may modify own results
+
+    def test_cancel_one_requester(self):
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=4))
+        b = self.segment_bundles(1)[0]
+        f1 = s.schedule('lc', b)
+        f2 = s.schedule('lc', b.clone())
+        f1.cancel()
+        self.assertEqual(len(f2.result(timeout=10)['light']), 101)
+        self.assertEqual(self.runs_count(), 1)
+
+    def test_cancel_all_requesters(self):
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=1))
+        b = self.segment_bundles(1)[0]
+        f1 = s.schedule('lc', b)
+        f2 = s.schedule('lc', b.clone())
+        f1.cancel()
+        self.assertEqual(len(s._inflight), 1)
+        f2.cancel()
+        self.assertEqual(len(s._inflight), 0)
+        f3 = s.schedule('lc', b.clone())  # no longer in flight, new job
+        self.assertEqual(len(f3.result(timeout=10)['light']), 101)
+        self.assertEqual(s.deduplicated, 1)
+
+
+class TestSpeculativeExecution(FakeLcTestCase):
+    """Straggler job is run again, the first result is taken"""
+
+    fakelc_kwargs = {'straggler': (4, 30)}
+
+    def test_straggler_duplicated(self):
+        import time
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=4))
+        s.speculative_min_samples = 3
+        bundles = self.segment_bundles(4)
+        for b in bundles[:3]:
+            s.schedule('lc', b).result(timeout=10)
+        self.assertIsNotNone(s.straggler_threshold('lc'))
+        start = time.monotonic()
+        f = s.schedule('lc', bundles[3])  # 4th run sleeps 30s
+        self.assertEqual(len(f.result(timeout=10)['light']), 26)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(s.speculated, 1)
+        self.assertEqual(self.runs_count(), 5)
+
+    def test_no_speculation_without_samples(self):
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=4))
+        self.assertIsNone(s.straggler_threshold('lc'))
+        s.schedule('lc', self.segment_bundles(1)[0]).result(timeout=10)
+        self.assertIsNone(s.straggler_threshold('lc'))
+        self.assertEqual(len(s.runtimes['lc']), 1)
+
+    def test_threshold_scaled_by_size(self):
+        from wdwrap.backends import ThreadBackend
+        from wdwrap.runners import expected_points
+        s = self.scheduler(ThreadBackend(workers=2))
+        s.speculative_min_samples = 3
+        bundles = self.segment_bundles(4)
+        for b in bundles[:3]:
+            s.schedule('lc', b).result(timeout=10)
+        self.assertEqual(len(s.unit_runtimes['lc']), 3)
+        size = expected_points(bundles[0])
+        self.assertEqual(size, 26)
+        self.assertAlmostEqual(s.straggler_threshold('lc', 4 * size), 4 * s.straggler_threshold('lc', size))
+
+
+class TestPriorities(FakeLcTestCase):
+    """Priority classes ordering and workers reserved for interactive jobs"""
+
+    fakelc_kwargs = {'sleep': 0.3}
+
+    def finish_order(self, futures):
+        order = []
+        for name, f in futures:
+            f.add_done_callback(lambda fut, name=name: order.append(name))
+        for _, f in futures:
+            f.result(timeout=20)
+        return order
+
+    def test_strict_order(self):
+        from wdwrap.backends import ThreadBackend
+        from wdwrap.jobs import Priority
+        s = self.scheduler(ThreadBackend(workers=1))
+        s.interactive_reserve = 0
+        b = self.segment_bundles(4)
+        futures = [('bg1', s.schedule('lc', b[0], priority='background')),
+                   ('bg2', s.schedule('lc', b[1], priority=Priority.Background)),
+                   ('fit', s.schedule('lc', b[2], priority=Priority.Fit)),
+                   ('gui', s.schedule('lc', b[3]))]
+        self.assertEqual(s.queued_count(), 3)
+        self.assertEqual(self.finish_order(futures), ['bg1', 'gui', 'fit', 'bg2'])
+
+    def test_interactive_reserve(self):
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=2))
+        s.interactive_reserve = 0.5
+        self.assertEqual(s.reserved_slots(), 1)
+        b = self.segment_bundles(4)
+        background = [s.schedule('lc', bb, priority='background') for bb in b[:3]]
+        self.assertEqual(s.running_count(), 1)
+        self.assertEqual(s.queued_count('background'), 2)
+        gui = s.schedule('lc', b[3])
+        self.assertEqual(s.running_count(), 2)  # dispatched immediately on reserved worker
+        futures = [('gui', gui)] + [(f'bg{n}', f) for n, f in enumerate(background)]
+        self.assertEqual(set(self.finish_order(futures)[:2]), {'bg0', 'gui'})
+
+    def test_promote_deduplicated(self):
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=1))
+        s.interactive_reserve = 0
+        b = self.segment_bundles(3)
+        futures = [('bg0', s.schedule('lc', b[0], priority='background')),
+                   ('fit', s.schedule('lc', b[1], priority='fit')),
+                   ('bg1', s.schedule('lc', b[2], priority='background')),
+                   ('gui', s.schedule('lc', b[2].clone()))]  # same job as bg1
+        self.assertEqual(s.queued_count('interactive'), 1)
+        order = self.finish_order(futures)
+        self.assertEqual(order[0], 'bg0')
+        self.assertEqual(set(order[1:3]), {'bg1', 'gui'})
+        self.assertEqual(order[3], 'fit')
+
+    def test_unknown_priority(self):
+        from wdwrap.jobs import Priority
+        with self.assertRaises(ValueError):
+            Priority.from_value('urgent')
+
+
+class TestMap(FakeLcTestCase):
+    """Windowed bulk submission"""
+
+    fakelc_kwargs = {'sleep': 0.1}
+
+    def bundles(self, s, n, in_flight):
+        for b in self.segment_bundles(n):
+            in_flight.append(s.running_count() + s.queued_count())
+            yield b
+
+    def test_window(self):
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=2))
+        in_flight = []
+        results = list(s.map('lc', self.bundles(s, 12, in_flight), window=3))
+        self.assertEqual([n for n, _ in results], list(range(12)))
+        self.assertTrue(all('light' in r for _, r in results))
+        self.assertLessEqual(max(in_flight), 2)  # window of 3, next item is requested when one is finished
+        self.assertEqual(self.runs_count(), 12)
+
+    def test_completion_order(self):
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=4))
+        results = dict(s.map('lc', self.segment_bundles(8), window=4, ordered=False))
+        self.assertEqual(sorted(results), list(range(8)))
+
+    def test_close_cancels(self):
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=1))
+        g = s.map('lc', self.segment_bundles(8), window=4)
+        next(g)
+        g.close()
+        self.assertEqual(s.queued_count(), 0)
+
+    def test_exceptions(self):
+        from wdwrap.backends import ThreadBackend
+        s = self.scheduler(ThreadBackend(workers=2), executors={'inv': lambda x: 1 / x})
+        results = list(s.map('inv', [1, 0, 2], return_exceptions=True))
+        self.assertIsInstance(results[1][1], ZeroDivisionError)
+        self.assertEqual(results[2][1], 0.5)
+        with self.assertRaises(ZeroDivisionError):
+            list(s.map('inv', [0, 1]))
+
+
+class TestAutoscaling(FakeLcTestCase):
+    """Workers are scaled with queue depth"""
+
+    fakelc_kwargs = {'sleep': 0.5}
+
+    def autoscaled(self, workers, **kwargs):
+        from wdwrap.backends import ThreadBackend
+        from wdwrap.jobs import Autoscaler
+        s = self.scheduler(ThreadBackend(workers=workers))
+        s.autoscaler = Autoscaler(s, **kwargs)
+        s.autoscaler.interval = 0.05
+        return s
+
+    def wait_workers(self, s, workers, timeout=5.0):
+        import time
+        deadline = time.monotonic() + timeout
+        while s.backend.workers != workers and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return s.backend.workers
+
+    def test_scale_up_and_down(self):
+        s = self.autoscaled(1, min_workers=1, max_workers=4, idle_timeout=0.3)
+        futures = [s.schedule('lc', b) for b in self.segment_bundles(4)]
+        self.assertEqual(self.wait_workers(s, 4), 4)
+        for f in futures:
+            f.result(timeout=10)
+        self.assertEqual(self.wait_workers(s, 1), 1)
+
+    def test_scale_down_keeps_running(self):
+        s = self.autoscaled(4, min_workers=1, max_workers=4, idle_timeout=0.1)
+        futures = [s.schedule('lc', b) for b in self.segment_bundles(2)]
+        s.autoscaler.notify()
+        self.assertEqual(self.wait_workers(s, 2, timeout=0.4), 2)  # running jobs are not interrupted
+        for f in futures:
+            self.assertIn('light', f.result(timeout=10))
+        self.assertEqual(self.wait_workers(s, 1), 1)
+
+    def test_no_scale_up_for_short_queue(self):
+        s = self.autoscaled(1, min_workers=1, max_workers=4, startup=100.0)
+        for _ in range(3):
+            s.runtimes['lc'].add(0.5)
+        futures = [s.schedule('lc', b) for b in self.segment_bundles(2)]
+        self.assertIsNone(s.autoscaler.target(0.0))
+        for f in futures:
+            f.result(timeout=10)
+        self.assertEqual(s.backend.workers, 1)
+
+    def test_dask_scale_keeps_busy(self):
+        import time
+        from distributed import Client, LocalCluster
+        from wdwrap.backends import DaskBackend
+        cluster = LocalCluster(n_workers=2, threads_per_worker=1, processes=False, dashboard_address=None)
+        client = Client(cluster)
+        try:
+            backend = DaskBackend(client=client)
+            f = backend.submit(worker_after_sleep, 2.0)
+            deadline = time.monotonic() + 10.0
+            while not any(client.processing().values()) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            busy = [a for a, keys in client.processing().items() if keys]
+            backend.scale(0)  # never below busy workers
+            self.assertEqual(backend.workers, 1)
+            self.assertEqual(f.result(timeout=30), busy[0])  # not killed and run again elsewhere
+            self.assertEqual(list(client.nthreads()), busy)
+        finally:
+            client.close()
+            cluster.close()
+
+    def test_dask_client_cancel_token(self):
+        from distributed import Client, LocalCluster
+        from wdwrap.backends import DaskBackend, DaskCancelToken
+        cluster = LocalCluster(n_workers=1, threads_per_worker=1, processes=False, dashboard_address=None)
+        client = Client(cluster)
+        try:
+            backend = DaskBackend(client=client)  # caller's client may be connected to remote workers
+            self.assertIsInstance(backend.make_cancel_token(), DaskCancelToken)
+        finally:
+            client.close()
+            cluster.close()
+
+    def test_dask_external_workers_refreshed(self):
+        import time
+        from distributed import Client, LocalCluster
+        from wdwrap.backends import DaskExternalBackend
+        cluster = LocalCluster(n_workers=1, threads_per_worker=1, processes=False, dashboard_address=None)
+        client = Client(cluster)
+        try:
+            backend = DaskExternalBackend(client=client, staging=False)
+            backend.workers_refresh_interval = 60.0
+            self.assertEqual(backend.workers, 1)
+            cluster.scale(3)  # by external autoscaler
+            client.wait_for_workers(3, timeout=10)
+            self.assertEqual(backend.workers, 1)  # read at most once per refresh interval
+            backend.workers_refresh_interval = 0.0
+            self.assertEqual(backend.workers, 3)
+            cluster.scale(2)
+            deadline = time.monotonic() + 10.0
+            while backend.workers != 2 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(backend.workers, 2)
+        finally:
+            client.close()
+            cluster.close()
+
+
+def worker_after_sleep(seconds):
+    """Address of the worker running the task"""
+    import time
+    from distributed import get_worker
+    time.sleep(seconds)
+    return get_worker().address
+
 
 if __name__ == '__main__':
     unittest.main()
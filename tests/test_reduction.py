@@ -0,0 +1,132 @@
+"""
+Unit tests of worker-side reduction (chi²)
+"""
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+from fakelc import FakeLcTestCase, light
+
+
+def observations(n=50, offset=0.0, seed=1):
+    """Observations of fake `lc` light curve, out of eclipses (narrow dips are not resolved by model grid)"""
+    from wdwrap.reduction import Observations
+    rng = np.random.default_rng(seed)
+    ph = rng.uniform(0.1, 0.4, n) + rng.integers(0, 2, n) * 0.5
+    mag = np.array([-2.5 * np.log10(light(p)) for p in ph]) + offset
+    return Observations(ph, mag, np.full(n, 2.0), column='mag')
+
+
+class TestObservations(unittest.TestCase):
+
+    def test_reduce(self):
+        from wdwrap.reduction import reduce
+        obs = observations(offset=0.1)
+        x = np.linspace(0, 1, 1001)
+        model = np.array([-2.5 * np.log10(light(p)) for p in x])
+        ret = reduce(x, model, obs, residuals=True)
+        self.assertEqual(ret['n'], 50)
+        self.assertTrue(np.allclose(ret['residuals'], 0.1, atol=1e-3))
+        self.assertAlmostEqual(ret['chi2'], 50 * 2.0 * 0.01, delta=0.01)
+
+    def test_pickle_reference(self):
+        from wdwrap import reduction
+        obs = observations(n=10000)
+        full = len(pickle.dumps(obs))
+        with tempfile.TemporaryDirectory() as d:
+            obs.export(d)
+            data = pickle.dumps(obs)
+            self.assertLess(len(data), full / 100)
+            reduction._cache.clear()
+            o1 = pickle.loads(data)
+            o2 = pickle.loads(data)
+        self.assertTrue((o1.values == obs.values).all())
+        self.assertIs(o1.values, o2.values)  # read once, cached in process
+
+    def test_from_values(self):
+        import pandas as pd
+        from wdwrap.curves import ObservedValues
+        from wdwrap.reduction import Observations
+        df = pd.DataFrame({'hjd': np.linspace(0.0, 3.0, 20), 'mag': np.linspace(10.0, 11.0, 20)})
+        values = ObservedValues(df=df)
+        obs = Observations.from_values(values)
+        self.assertEqual(len(obs), 20)
+        self.assertTrue(np.allclose(obs.ph, values.df['ph']))
+        self.assertTrue(np.allclose(obs.values, df['mag']))
+        self.assertTrue(np.allclose(obs.weights, values.df['weight']))
+        self.assertEqual(obs.key, Observations.from_values(values).key)
+
+
+class TestChi2Jobs(FakeLcTestCase):
+    """`lc-chi2` jobs return chi² instead of model curve"""
+
+    def chi2_scheduler(self, backend):
+        from wdwrap.runners import LcRunner, LcChi2Runner
+        return self.scheduler(backend, executors={'lc': LcRunner(), 'lc-chi2': LcChi2Runner()})
+
+    def check(self, backend):
+        s = self.chi2_scheduler(backend)
+        try:
+            b = self.segment_bundles(1)[0]
+            obs = observations(offset=0.1)
+            f = s.schedule('lc-chi2', b, observations=obs, residuals=True)
+            ret = f.result(timeout=30)
+            self.assertEqual(ret['n'], 50)
+            self.assertTrue(np.allclose(ret['residuals'], 0.1, atol=0.02))
+            bundles = []
+            for k in range(3):
+                bb = b.clone()
+                bb['PHIN'] = 0.01 / (k + 1)
+                bundles.append(bb)
+            chi2 = [r['chi2'] for _, r in s.map('lc-chi2', bundles, observations=obs)]
+            self.assertEqual(len(chi2), 3)
+            self.assertTrue(all(abs(c - 1.0) < 0.3 for c in chi2))
+        finally:
+            s.backend.shutdown()
+
+    def test_inline(self):
+        from wdwrap.backends import InlineBackend
+        self.check(InlineBackend())
+
+    def test_processes(self):
+        from wdwrap.backends import ProcessBackend
+        self.check(ProcessBackend(workers=2))
+
+    def test_process_share_once(self):
+        import os
+        from wdwrap.backends import ProcessBackend
+        backend = ProcessBackend(workers=1)
+        try:
+            obs = observations()
+            shared = backend.share(obs)
+            path = shared.path
+            self.assertIs(backend.share(observations()), shared)  # same key, exported once
+            self.assertTrue(os.path.exists(path))
+        finally:
+            backend.shutdown()
+        self.assertFalse(os.path.exists(path))
+
+    def test_batch_share_once(self):
+        import os
+        from wdwrap.backends import BatchBackend
+        backend = BatchBackend(directory=os.path.join(self.tmpdir.name, 'shared'))
+        try:
+            shared = backend.share(observations())
+            path = shared.path
+            self.assertIs(backend.share(observations()), shared)
+            self.assertTrue(os.path.exists(path))
+        finally:
+            backend.shutdown()
+        self.assertFalse(os.path.exists(path))
+
+    def test_direct_run(self):
+        from wdwrap.runners import LcChi2Runner
+        obs = observations(offset=0.1)
+        ret = LcChi2Runner().run(self.segment_bundles(1)[0], obs)
+        self.assertAlmostEqual(ret['chi2'], 1.0, delta=0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+Unit tests of coalesced regeneration of curves
+"""
+import time
+import unittest
+
+from fakelc import FakeLcTestCase
+
+
+class TestRegenerationScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def callback(self, key):
+        return lambda: self.calls.append((key, time.monotonic()))
+
+    def test_coalesced(self):
+        from wdwrap.regeneration import RegenerationScheduler
+        s = RegenerationScheduler(quiet=0.1, max_latency=1.0)
+        start = time.monotonic()
+        for _ in range(10):
+            for key in 'ab':
+                s.request(key, self.callback(key))
+        self.assertTrue(s.pending('a'))
+        time.sleep(0.4)
+        self.assertEqual(sorted(k for k, _ in self.calls), ['a', 'b'])
+        self.assertGreaterEqual(self.calls[0][1] - start, 0.1)
+        self.assertFalse(s.pending('a'))
+
+    def test_max_latency(self):
+        from wdwrap.regeneration import RegenerationScheduler
+        s = RegenerationScheduler(quiet=0.2, max_latency=0.3)
+        start = time.monotonic()
+        while time.monotonic() - start < 0.7:  # never quiet
+            s.request('a', self.callback('a'))
+            time.sleep(0.02)
+        self.assertGreaterEqual(len(self.calls), 1)
+        self.assertLess(self.calls[0][1] - start, 0.45)  # not postponed by following requests
+
+    def test_immediate_cancel_flush(self):
+        from wdwrap.regeneration import RegenerationScheduler
+        s = RegenerationScheduler(quiet=0.0)
+        s.request('a', self.callback('a'))
+        self.assertEqual(len(self.calls), 1)
+        s = RegenerationScheduler(quiet=10.0)
+        s.request('a', self.callback('a'))
+        s.request('b', self.callback('b'))
+        self.assertTrue(s.cancel('a'))
+        self.assertFalse(s.cancel('a'))
+        s.flush()
+        self.assertEqual([k for k, _ in self.calls], ['a', 'b'])
+
+
+class TestCurvesRegeneration(FakeLcTestCase):
+    fakelc_kwargs = {'sleep': 1.0}
+
+    def setUp(self):
+        super().setUp()
+        from wdwrap.jobs import JobScheduler
+        from wdwrap.regeneration import RegenerationScheduler
+        self._scheduler = JobScheduler._instance
+        self._regeneration = RegenerationScheduler.default_instance()
+        RegenerationScheduler.set_default_instance(RegenerationScheduler(quiet=0.2, max_latency=2.0))
+
+    def tearDown(self):
+        from wdwrap.jobs import JobScheduler
+        from wdwrap.regeneration import RegenerationScheduler
+        JobScheduler._instance = self._scheduler
+        RegenerationScheduler.set_default_instance(self._regeneration)
+        super().tearDown()
+
+    def test_one_generation_per_curve(self):
+        from wdwrap.backends import ThreadBackend
+        from wdwrap.bundle import Bundle
+        from wdwrap.curves import LightCurve
+        from wdwrap.jobs import JobScheduler
+        JobScheduler._instance = self.scheduler(ThreadBackend(workers=4))
+        bundle = Bundle.default_binary()
+        curves = [LightCurve(bundle=bundle).gen_values for _ in range(2)]
+        for g in curves:
+            g.auto_segments = False
+            g.generate()
+        generations = [g._generation for g in curves]
+        for incl in range(80, 90):  # changes of common parameter invalidate both curves
+            bundle['XINCL'] = float(incl)
+        self.assertEqual([g._generation for g in curves], [n + 1 for n in generations])  # abandoned once
+        time.sleep(0.5)
+        self.assertEqual([g._generation for g in curves], [n + 2 for n in generations])  # generated once
+        for g in curves:
+            g.wait()
+            self.assertEqual(g._pass_bundle['XINCL'].val, 89.0)
+
+    def test_one_generation_of_ready_curve(self):
+        """Invalidated curve refreshed (as by plot widget) is generated once after the changes"""
+        from wdwrap.backends import ThreadBackend
+        from wdwrap.bundle import Bundle
+        from wdwrap.curves import LightCurve
+        from wdwrap.jobs import JobScheduler
+        JobScheduler._instance = self.scheduler(ThreadBackend(workers=4))
+        bundle = Bundle.default_binary()
+        g = LightCurve(bundle=bundle).gen_values
+        g.auto_segments = False
+        g.generate(wait=True)
+        self.assertEqual(g.status, g.STATUS.Ready)
+        g.observe(lambda change: change.new == g.STATUS.Invalid and g.refresh(), names=['status'])
+        generation = g._generation
+        for incl in range(80, 90):
+            bundle['XINCL'] = float(incl)
+        self.assertEqual(g.status, g.STATUS.Invalid)
+        self.assertEqual(g._generation, generation)  # no leading-edge generation
+        time.sleep(0.5)
+        self.assertEqual(g._generation, generation + 1)
+        g.wait()
+        self.assertEqual(g.status, g.STATUS.Ready)
+        self.assertEqual(g._pass_bundle['XINCL'].val, 89.0)
+
+    def test_no_outdated_ready(self):
+        """Outdated calculation finishing in quiet period neither makes the curve ready nor updates it"""
+        from wdwrap.backends import ThreadBackend
+        from wdwrap.bundle import Bundle
+        from wdwrap.curves import LightCurve
+        from wdwrap.jobs import JobScheduler
+        from wdwrap.regeneration import RegenerationScheduler
+        RegenerationScheduler.set_default_instance(RegenerationScheduler(quiet=2.0, max_latency=2.0))
+        JobScheduler._instance = self.scheduler(ThreadBackend(workers=4))
+        bundle = Bundle.default_binary()
+        g = LightCurve(bundle=bundle).gen_values
+        g.auto_segments = False
+        g.generate()
+        bundle['XINCL'] = 80.0
+        versions = g.df_version
+        time.sleep(1.5)  # outdated jobs are done meantime
+        self.assertEqual(g.status, g.STATUS.Calculating)
+        self.assertEqual(g.df_version, versions)
+        g.wait()
+        self.assertEqual(g.status, g.STATUS.Ready)
+        self.assertEqual(g._pass_bundle['XINCL'].val, 80.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
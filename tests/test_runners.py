@@ -0,0 +1,169 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""
+Unit tests of runners, uses fake `lc` program (see `fakelc.py`)
+"""
+import unittest
+
+from fakelc import FakeLcTestCase
+
+
+class TestLcRunner(FakeLcTestCase):
+
+    def test_run(self):
+        from wdwrap.runners import LcRunner
+        b = self.segment_bundles(1)[0]
+        ret = LcRunner().run(b)
+        self.assertEqual(len(ret['light']), 101)
+        self.assertEqual(self.runs_count(), 1)
+
+
+class TestLcRunnerAsync(FakeLcTestCase):
+
+    fakelc_kwargs = {'sleep': 0.5}
+
+    def test_run_async_concurrent(self):
+        import asyncio
+        import time
+        from wdwrap.runners import LcRunner
+        r = LcRunner()
+
+        async def run_all():
+            return await asyncio.gather(*[r.run_async(b) for b in self.segment_bundles(8)])
+
+        start = time.monotonic()
+        ret = asyncio.run(run_all())
+        self.assertLess(time.monotonic() - start, 8 * 0.5)
+        self.assertEqual([len(r['light']) for r in ret], [13] * 8)
+        self.assertEqual(self.runs_count(), 8)
+
+    def test_run_async_cancel(self):
+        import asyncio
+        from wdwrap.runners import LcRunner
+        b = self.segment_bundles(1)[0]
+
+        async def run_cancelled():
+            task = asyncio.ensure_future(LcRunner().run_async(b))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run_cancelled())
+
+    def test_bundle_light_async(self):
+        import asyncio
+        b = self.segment_bundles(1)[0]
+        light = asyncio.run(b.light_async())
+        self.assertEqual(len(light), 101)
+        self.assertIs(b.light, light)
+
+
+class TestLcBatchRunner(FakeLcTestCase):
+
+    def test_batch_light(self):
+        from wdwrap.runners import LcBatchRunner
+        bundles = self.segment_bundles(4)
+        ret = LcBatchRunner().run(bundles)
+        self.assertEqual(self.runs_count(), 1)
+        self.assertEqual(len(ret), 4)
+        for b, r in zip(bundles, ret):
+            self.assertEqual(len(r['light']), 26)
+            self.assertAlmostEqual(r['light']['ph'].iloc[0], b['PHSTRT'].val)
+
+    def test_batch_mixed(self):
+        from wdwrap.runners import LcBatchRunner
+        bundles = self.segment_bundles(2) + self.segment_bundles(2, rv=True)
+        ret = LcBatchRunner().run(bundles)
+        self.assertEqual(self.runs_count(), 1)
+        self.assertEqual([list(r.keys()) for r in ret], [['light'], ['light'], ['veloc'], ['veloc']])
+        self.assertAlmostEqual(ret[3]['veloc']['ph'].iloc[0], 0.5)
+
+    def test_headerless_blocks(self):
+        """veloc.dat has no block headers, the lc loop may end before PHSTOP not divisible by PHIN"""
+        import tempfile
+        from wdwrap.runners import LcBatchRunner
+        bundles = self.segment_bundles(3, rv=True)
+        for b, (lo, hi) in zip(bundles, [(0.0, 0.3), (0.35, 0.6), (0.6, 0.8)]):
+            b['PHSTRT'], b['PHSTOP'], b['PHIN'] = lo, hi, 0.1
+        phases = [0.0, 0.1, 0.2, 0.35, 0.45, 0.55, 0.6, 0.7, 0.8]  # 0.3 dropped by rounding of lc loop
+        with tempfile.TemporaryDirectory() as directory:
+            with open(f'{directory}/veloc.dat', 'w') as fd:
+                for ph in phases:
+                    print(f' {ph:14.6f} {ph:12.5f}' + '   0.000000' * 7, file=fd)
+            ret = LcBatchRunner().collect_results(directory, bundles)
+        self.assertEqual([list(r['veloc']['ph']) for r in ret], [phases[:3], phases[3:6], phases[6:]])
+
+
+class TestSlimWorker(FakeLcTestCase):
+    """Pre-rendered job specs run by slim worker runtime"""
+
+    def test_no_heavy_imports(self):
+        import subprocess
+        import sys
+        out = subprocess.check_output([sys.executable, '-c',
+                                       'import sys, wdwrap.worker; '
+                                       'print([m for m in ["pandas", "astropy", "wdwrap.io", "wdwrap.param"] '
+                                       'if m in sys.modules])'], text=True)
+        self.assertEqual(out.strip(), '[]')
+
+    def test_spec(self):
+        import pickle
+        from wdwrap.runners import LcRunner
+        from wdwrap.worker import run_lc
+        b = self.segment_bundles(1)[0]
+        r = LcRunner()
+        fn, spec, finish = r.remote_job(b)
+        self.assertIs(fn, run_lc)
+        self.assertEqual(set(type(v) for v in spec.values()) - {str, list, type(None)}, set())
+        self.assertLess(len(pickle.dumps(spec)), len(pickle.dumps(b)))
+        ret = finish(fn(spec))
+        expected = r.run(b)
+        self.assertTrue((ret['light'].values == expected['light'].values).all())
+        self.assertEqual(list(ret['light'].columns), list(expected['light'].columns))
+
+    def test_batch_spec(self):
+        from wdwrap.runners import LcBatchRunner
+        bundles = self.segment_bundles(2) + self.segment_bundles(2, rv=True)
+        r = LcBatchRunner()
+        fn, spec, finish = r.remote_job(bundles)
+        ret = finish(fn(spec))
+        expected = r.run(bundles)
+        for res, exp in zip(ret, expected):
+            self.assertEqual(set(res), set(exp))
+            for name in res:
+                self.assertTrue((res[name].values == exp[name].values).all())
+
+    def test_scheduled_in_processes(self):
+        from wdwrap.backends import ProcessBackend
+        s = self.scheduler(ProcessBackend(workers=2))
+        try:
+            futures = [s.schedule('lc', b) for b in self.segment_bundles(2)]
+            for f in futures:
+                self.assertEqual(len(f.result(timeout=30)['light']), 51)
+        finally:
+            s.backend.shutdown()
+
+    def test_communicate(self):
+        import subprocess
+        import sys
+        from wdwrap.worker import communicate
+        proc = subprocess.Popen([sys.executable, '-c', 'import sys; print("out"); sys.stderr.write("err"); sys.exit(3)'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        outs, errs, rusage = communicate(proc, timeout=10)
+        self.assertEqual((outs.strip(), errs), ('out', 'err'))
+        self.assertEqual(proc.returncode, 3)  # real exit status of reaped process
+        self.assertGreater(rusage.ru_utime + rusage.ru_stime, 0.0)
+
+    def test_communicate_timeout(self):
+        import subprocess
+        import sys
+        from wdwrap.worker import communicate
+        proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(10)'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with self.assertRaises(TimeoutError):
+            communicate(proc, timeout=0.2)
+        self.assertIsNotNone(proc.returncode)
+
+
+if __name__ == '__main__':
+    unittest.main()
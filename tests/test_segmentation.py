@@ -0,0 +1,323 @@
+"""
+Unit tests of runtime-aware segmentation of generated curves
+"""
+import time
+import unittest
+
+import numpy as np
+
+from fakelc import FakeLcTestCase
+
+
+def eclipse_cost(ph):
+    """Synthetic lc cost of points: in eclipses 10 times more"""
+    p = np.mod(ph, 1.0)
+    eclipse = (np.minimum(p, 1.0 - p) < 0.05) | (np.abs(p - 0.5) < 0.05)
+    return np.where(eclipse, 0.02, 0.002)
+
+
+def runtime(ranges, overhead=0.3):
+    from wdwrap.segmentation import range_phases
+    return overhead + sum(eclipse_cost(range_phases(*r)).sum() for r in ranges)
+
+
+class TestCostModel(unittest.TestCase):
+
+    def trained(self, samples=300):
+        from wdwrap.segmentation import CostModel
+        model = CostModel()
+        rng = np.random.default_rng(1)
+        for _ in range(samples):
+            lo = rng.uniform(0.0, 0.9)
+            hi = lo + rng.uniform(0.02, 1.0 - lo)
+            model.observe([(lo, hi, 0.01)], runtime([(lo, hi, 0.01)]))
+        return model
+
+    def test_learns(self):
+        model = self.trained()
+        self.assertAlmostEqual(model.overhead, 0.3, delta=0.05)
+        self.assertAlmostEqual(model.predict([(0.0, 1.0, 0.01)]), runtime([(0.0, 1.0, 0.01)]), delta=0.1)
+        self.assertGreater(model.point_costs[25], 3 * model.point_costs[12])  # secondary eclipse bin
+
+    def test_plan_balanced(self):
+        model = self.trained()
+        dividers = model.plan(workers=3, step=0.01)
+        self.assertEqual(len(dividers), 4)
+        self.assertEqual((dividers[0], dividers[-1]), (0.0, 1.0))
+        times = [runtime([(lo, hi, 0.01)]) for lo, hi in zip(dividers[:-1], dividers[1:])]
+        self.assertLess(max(times) / min(times), 1.3)
+        equal = [runtime([(lo, hi, 0.01)]) for lo, hi in ((0.0, 0.33), (0.34, 0.66), (0.67, 1.0))]
+        self.assertLess(max(times), max(equal))
+        for d in dividers:  # aligned to points grid
+            self.assertAlmostEqual(d * 100, round(d * 100))
+
+    def test_segments_count(self):
+        from wdwrap.segmentation import CostModel
+        model = CostModel(overhead=0.1, point_cost=0.01)
+        self.assertEqual(len(model.plan(workers=1, step=0.01)), 2)
+        self.assertEqual(len(model.plan(workers=8, step=0.01)), 9)
+        self.assertLessEqual(len(model.plan(workers=64, step=0.01)), 21)
+        cheap = CostModel(overhead=1.0, point_cost=1e-5)  # overhead dominates, one segment
+        self.assertEqual(len(cheap.plan(workers=8, step=0.01)), 2)
+
+
+class TestAdaptiveSampling(unittest.TestCase):
+
+    def setUp(self):
+        import wdwrap
+        self.bundle = wdwrap.default_binary()
+
+    def test_conjunctions(self):
+        from wdwrap.segmentation import conjunction_phases
+        b = self.bundle
+        b['E'], b['PSHIFT'] = 0.0, 0.1
+        self.assertEqual(conjunction_phases(b), (0.1, 0.6))
+        b['E'], b['PSHIFT'], b['PERR0'] = 0.3, 0.0, 0.0
+        _, secondary = conjunction_phases(b)
+        b['PERR0'] = np.pi
+        _, opposite = conjunction_phases(b)
+        self.assertNotAlmostEqual(secondary, 0.5)
+        self.assertAlmostEqual(secondary + opposite, 1.0)  # mirrored periastron
+
+    def test_eclipse_windows(self):
+        from wdwrap.segmentation import eclipse_windows
+        b = self.bundle
+        b['E'] = 0.0
+        windows = eclipse_windows(b)
+        self.assertEqual(len(windows), 3)  # primary window wraps around phase 0
+        self.assertEqual((windows[0][0], windows[-1][1]), (0.0, 1.0))
+        self.assertTrue(windows[1][0] < 0.5 < windows[1][1])
+        b['XINCL'] = 10.0
+        self.assertEqual(eclipse_windows(b), [])
+
+    def test_refinement(self):
+        from fakelc import light
+        from wdwrap.segmentation import interpolation_errors, refinement_ranges
+        ph = np.linspace(0.0, 1.0, 51)
+        mag = -2.5 * np.log10([light(p) for p in ph])
+        errors = interpolation_errors(ph, mag)
+        self.assertGreater(errors[25], 100 * errors[12])  # secondary eclipse vs maximum
+        ranges = refinement_ranges(ph, [mag], tolerance=1e-4, min_step=0.001)
+        self.assertTrue(ranges)
+        for lo, hi, step in ranges:
+            self.assertTrue(hi < 0.2 or lo > 0.3 and hi < 0.7 or lo > 0.8)  # eclipses only
+            self.assertLess(step, 0.02)
+        self.assertEqual(refinement_ranges(ph, [mag], tolerance=1.0, min_step=0.001), [])
+
+
+class TestSegmentResults(unittest.TestCase):
+
+    def test_split(self):
+        import pandas as pd
+        from wdwrap.segmentation import SegmentResults, range_phases
+        results = SegmentResults()
+        ph = np.round(range_phases(0.0, 1.0, 0.01), 5)
+        results.add('model', [pd.DataFrame({'ph': ph[:60], 'mag': ph[:60]}), pd.DataFrame({'ph': ph[50:], 'mag': ph[50:]})])
+        self.assertEqual(len(results.frame('model')), 101)
+        reused, missing = results.split('model', [(0.2, 0.4, 0.01), (0.6, 0.7, 0.01)])
+        self.assertEqual(missing, [])
+        self.assertEqual(sum(len(df) for df in reused), 21 + 11)
+        reused, missing = results.split('model', [(0.2, 0.3, 0.005)])  # finer: every other point missing
+        self.assertEqual(sum(len(df) for df in reused), 11)
+        self.assertEqual(missing, [(0.205, 0.295, 0.005)])
+        self.assertEqual(results.split('other', [(0.2, 0.3, 0.01)]), ([], [(0.2, 0.3, 0.01)]))
+
+
+class TestAutoSegments(FakeLcTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from wdwrap.jobs import JobScheduler
+        from wdwrap.segmentation import CostModels
+        self._models = CostModels.default_instance()
+        CostModels.set_default_instance(CostModels())
+        self._scheduler = JobScheduler._instance
+
+    def tearDown(self):
+        from wdwrap.jobs import JobScheduler
+        from wdwrap.segmentation import CostModels
+        JobScheduler._instance = self._scheduler
+        CostModels.set_default_instance(self._models)
+        super().tearDown()
+
+    def curve(self, workers):
+        from wdwrap.backends import ThreadBackend
+        from wdwrap.bundle import Bundle
+        from wdwrap.curves import LightCurve
+        from wdwrap.jobs import JobScheduler
+        JobScheduler._instance = self.scheduler(ThreadBackend(workers=workers))
+        return LightCurve(bundle=Bundle.default_binary()).gen_values
+
+    def test_generate(self):
+        from wdwrap.segmentation import CostModels
+        g = self.curve(workers=3)
+        g.generate(wait=True)
+        self.assertEqual(g.segments_count(), 3)
+        self.assertEqual(len(g.df), 101)
+        model = CostModels.default_instance().get(g.bundle)
+        self.assertEqual(model.samples, 3)  # fed by runtimes of segment jobs
+
+    def test_manual_segments(self):
+        g = self.curve(workers=3)
+        g.segment_split(0)
+        self.assertFalse(g.auto_segments)
+        segments = list(g.segment_dividers)
+        g.generate(wait=True)
+        self.assertEqual(g.segment_dividers, segments)
+        self.assertFalse(g.to_dict()['segments']['auto'])
+
+    def test_adaptive(self):
+        from scipy.interpolate import CubicSpline
+        from fakelc import light
+        g = self.curve(workers=3)
+        g.adaptive_sampling = True
+        g.generate(wait=True)
+        ph = np.linspace(0.0, 1.0, 2001)
+        true = -2.5 * np.log10([light(p) for p in ph])
+        error = np.abs(CubicSpline(g.df['ph'], g.df['mag'])(ph) - true).max()
+        settings = g.adaptive_settings()
+        self.assertGreater(g._pass_number, 0)
+        self.assertLess(error, 2 * settings['tolerance'] * np.ptp(true))
+        self.assertLess(len(g.df), 1 / settings['min-step'] / 4)
+
+    def test_reuse(self):
+        g = self.curve(workers=2)
+        g.auto_segments = False
+        g.generate(wait=True)
+        runs = self.runs_count()
+        points = len(g.df)
+        g.segment_split(1)
+        g.segment_set_range(0, to_value=0.3)
+        g.generate(wait=True)
+        self.assertEqual(self.runs_count(), runs)  # union of phases unchanged, nothing computed
+        self.assertEqual(len(g.df), points)
+        g.segment_update_data(0, {'PHIN': 0.005})
+        g.generate(wait=True)
+        self.assertEqual(self.runs_count(), runs + 1)  # only missing points of the edited segment
+        self.assertEqual(len(g.df), points + 30)
+        g.bundle['XINCL'] = 85.0  # other model
+        g.generate(wait=True)
+        self.assertGreater(self.runs_count(), runs + 1)
+
+
+class CurveTestCase(FakeLcTestCase):
+    """Generated curve of fixed 4 segments on 2 worker threads"""
+
+    def setUp(self):
+        super().setUp()
+        from wdwrap.jobs import JobScheduler
+        self._scheduler = JobScheduler._instance
+
+    def tearDown(self):
+        from wdwrap.jobs import JobScheduler
+        JobScheduler._instance = self._scheduler
+        super().tearDown()
+
+    def curve(self):
+        from wdwrap.backends import ThreadBackend
+        from wdwrap.bundle import Bundle
+        from wdwrap.curves import LightCurve
+        from wdwrap.jobs import JobScheduler
+        JobScheduler._instance = self.scheduler(ThreadBackend(workers=2))
+        g = LightCurve(bundle=Bundle.default_binary()).gen_values
+        g.auto_segments = False
+        g.progressive = True
+        return g
+
+
+class TestProgressive(CurveTestCase):
+    fakelc_kwargs = {'straggler': (2, 10)}  # second run sleeps 10 s
+
+    def wait_partial(self, g, timeout=8.0):
+        deadline = time.monotonic() + timeout
+        while g.segments_status.count(g.STATUS.Ready) < 3 and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+    def test_partial(self):
+        g = self.curve()
+        g.generate()
+        self.wait_partial(g)
+        self.assertTrue(g.partial)
+        self.assertEqual(g.status, g.STATUS.Calculating)
+        self.assertEqual(g.segments_status.count(g.STATUS.Calculating), 1)
+        self.assertTrue(60 < len(g.df) < 101)
+        ph = np.linspace(0.0, 1.0, 101)
+        values = g.get_values_at(ph)['mag']
+        computed = set(np.round(np.mod(g.df['ph'], 1.0), 5))
+        missing = [p for p in np.round(np.mod(ph, 1.0), 5) if p not in computed]
+        self.assertEqual(values.isna().sum(), len(missing))  # no approximation over pending segment
+        g.wait()
+        self.assertFalse(g.partial)
+        self.assertEqual(len(g.df), 101)
+        self.assertFalse(g.get_values_at(np.linspace(0.0, 1.0, 101))['mag'].isna().any())
+
+    def test_cancel_keeps_finished(self):
+        g = self.curve()
+        g.generate()
+        self.wait_partial(g)
+        g.cancel()
+        runs = self.runs_count()
+        g.generate(wait=True)
+        self.assertEqual(self.runs_count(), runs + 1)  # only the unfinished segment
+        self.assertEqual(len(g.df), 101)
+
+
+class TestPreview(CurveTestCase):
+    fakelc_kwargs = {'straggler': (5, 10)}  # first run of full fidelity stage sleeps 10 s
+
+    def test_preview_bundle(self):
+        g = self.curve()
+        b = g.model_bundle()
+        b['MREF'], b['NREF'] = 2, 3
+        p = g.preview_bundle(b)
+        self.assertEqual((p['N1'].val, p['N2'].val, p['MREF'].val, p['NREF'].val), (10, 10, 1, 1))
+        self.assertEqual(p['PHIN'].val, 0.02)
+        self.assertEqual((b['N1'].val, b['MREF'].val, b['PHIN'].val), (30, 2, 0.01))
+
+    def test_stages(self):
+        g = self.curve()
+        g.fast_preview = True
+        g.generate()
+        deadline = time.monotonic() + 8.0
+        while g._preview_df is None and time.monotonic() < deadline:  # till preview stage is done
+            time.sleep(0.02)
+        self.assertTrue(g.is_preview)
+        self.assertEqual(g.status, g.STATUS.Calculating)
+        self.assertFalse(g.get_values_at(np.linspace(0.0, 1.0, 11))['mag'].isna().any())
+        g.wait()
+        self.assertEqual(self.runs_count(), 8)  # 4 preview and 4 full fidelity segments
+        self.assertFalse(g.is_preview)
+        self.assertEqual(len(g.df), 101)
+
+    def test_cancel(self):
+        g = self.curve()
+        g.fast_preview = True
+        g.generate()
+        g.cancel()  # preview stage cancelled, full fidelity stage is not started
+        time.sleep(1.0)
+        self.assertLessEqual(self.runs_count(), 4)
+        self.assertFalse(g.is_preview)
+
+
+class TestStages(CurveTestCase):
+
+    def test_outdated_stage(self):
+        from wdwrap.segmentation import model_digest
+        g = self.curve()
+        g.fast_preview = True
+        g.generate()
+        generation = g._generation
+        outdated, ranges = g._full_stage
+        outdated = outdated.clone()
+        outdated['XINCL'] = 80
+        g.generate()
+        g._start_stage(outdated, ranges, generation)  # stage of the first generation started late
+        self.assertNotEqual(g._model_key, model_digest(outdated))
+        self.assertNotEqual(g._pass_bundle['XINCL'].val, 80)
+        g.wait()
+        self.assertEqual(g.segment_results.split(model_digest(outdated), ranges)[1], ranges)  # nothing computed
+        self.assertEqual(len(g.df), 101)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+Unit tests of shared-memory transport of results
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from fakelc import FakeLcTestCase
+
+
+class TestShmem(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_export_attach(self):
+        import pickle
+        from wdwrap import shmem
+        a = np.arange(30.0).reshape(10, 3)
+        h = shmem.export(a, self.tmpdir.name)
+        self.assertLess(len(pickle.dumps(h)), 200)
+        b = shmem.attach(pickle.loads(pickle.dumps(h)))
+        self.assertFalse(os.path.exists(h.path))  # unlinked, mapping stays valid
+        self.assertTrue((a == b).all())
+        self.assertTrue(b[:, 1].flags['C_CONTIGUOUS'])  # columns are contiguous
+        b[0, 0] = -1.0  # copy-on-write
+        self.assertEqual(b[0, 0], -1.0)
+
+    def test_resolve_discard(self):
+        from wdwrap import shmem
+        out = {'light': [shmem.export(np.ones((4, 2)), self.tmpdir.name),
+                         shmem.export(np.empty((0, 2)), self.tmpdir.name)]}
+        ret = shmem.resolve(out)
+        self.assertEqual(ret['light'][0].shape, (4, 2))
+        self.assertEqual(ret['light'][1].shape, (0, 2))
+        out = {'light': [shmem.export(np.ones(4), self.tmpdir.name)]}
+        shmem.discard(out)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_sweep(self):
+        from wdwrap import shmem
+        h = shmem.export(np.ones(4), self.tmpdir.name)
+        self.assertEqual(shmem.sweep(self.tmpdir.name, max_age=3600), 0)
+        os.utime(h.path, (0, 0))
+        self.assertEqual(shmem.sweep(self.tmpdir.name, max_age=3600), 1)
+
+
+class TestShmemTransport(FakeLcTestCase):
+    """Results of process workers are passed by shared memory"""
+
+    @staticmethod
+    def mapped(a):
+        import mmap
+        while a is not None:
+            if isinstance(a, mmap.mmap):
+                return True
+            a = a.obj if isinstance(a, memoryview) else getattr(a, 'base', None)
+        return False
+
+    def test_process_backend(self):
+        from wdwrap.backends import ProcessBackend
+        from wdwrap.runners import LcRunner
+        s = self.scheduler(ProcessBackend(workers=2))
+        self.assertTrue(s.shared_memory)
+        s.shm_dir = self.tmpdir.name
+        try:
+            bundles = self.segment_bundles(2) + self.segment_bundles(1, rv=True)
+            futures = [s.schedule('lc', b) for b in bundles]
+            batch = s.schedule('lc-batch', bundles)
+            results = [f.result(timeout=30) for f in futures]
+            batch = batch.result(timeout=30)
+        finally:
+            s.backend.shutdown()
+        expected = [LcRunner().run(b) for b in bundles]
+        for res, bres, exp, name in zip(results, batch, expected, ['light', 'light', 'veloc']):
+            self.assertTrue((res[name].values == exp[name].values).all())
+            self.assertTrue((bres[name].values == exp[name].values).all())
+        self.assertTrue(self.mapped(results[0]['light']['ph'].values))  # zero-copy
+        self.assertEqual([f for f in os.listdir(self.tmpdir.name) if f.startswith('wdwrap_shm')], [])
+
+
+class _IgnoredCancelToken(object):
+    """Cancel token never seen by the job, as when the job finishes before the token is polled"""
+
+    def set(self):
+        pass
+
+    def is_set(self):
+        return False
+
+    def release(self):
+        pass
+
+
+class TestShmemCancel(FakeLcTestCase):
+    """Result of job cancelled while running is removed from shared memory"""
+
+    fakelc_kwargs = {'sleep': 1.0}
+
+    def test_cancelled_discarded(self):
+        import time
+        from wdwrap.backends import ProcessBackend
+
+        class Backend(ProcessBackend):
+            def make_cancel_token(self):
+                return _IgnoredCancelToken()
+
+        s = self.scheduler(Backend(workers=1))
+        s.shm_dir = self.tmpdir.name
+        try:
+            f = s.schedule('lc', self.segment_bundles(1)[0])
+            deadline = time.monotonic() + 10.0
+            while self.runs_count() == 0 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(self.runs_count(), 1)
+            self.assertTrue(f.cancel())
+            s.backend.executor.shutdown(wait=True)  # lc finishes, result is exported
+        finally:
+            s.backend.shutdown()
+        self.assertEqual([f for f in os.listdir(self.tmpdir.name) if f.startswith('wdwrap_shm')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
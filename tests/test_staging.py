@@ -0,0 +1,112 @@
+"""
+Unit tests of staging WD files and lc executable on workers
+"""
+import os
+import unittest
+
+from fakelc import FakeLcTestCase
+
+
+def staged_paths(wdversion):
+    """Run on worker: WD files directory and staged executables"""
+    from wdwrap import tempdir, worker
+    return tempdir.wd_files_path(wdversion), dict(worker._executables)
+
+
+class TestStaging(FakeLcTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from wdwrap.config import cfg
+        self.staging_dir = os.path.join(self.tmpdir.name, 'staged')
+        self.lc = cfg().get('executables', 'lc')
+
+    def tearDown(self):
+        from wdwrap import tempdir, worker
+        tempdir._wd_files_paths.clear()
+        worker._executables.clear()
+        super().tearDown()
+
+    def test_stage(self):
+        from wdwrap import tempdir, worker
+        from wdwrap.staging import StagedFiles, file_digest
+        files = StagedFiles(['2007'], [self.lc])
+        files.stage(self.staging_dir, use_local=False)
+        path = tempdir.wd_files_path('2007')
+        self.assertTrue(path.startswith(self.staging_dir))
+        for name, digest in files.wd_files['2007'].items():
+            self.assertEqual(file_digest(os.path.join(path, name)), digest)
+        staged_lc = worker._executables[self.lc]
+        self.assertTrue(os.access(staged_lc, os.X_OK))
+        mtime = os.stat(staged_lc).st_mtime_ns
+        files.stage(self.staging_dir, use_local=False)  # already staged, not written again
+        self.assertEqual(os.stat(staged_lc).st_mtime_ns, mtime)
+
+    def test_local_files_verified(self):
+        from wdwrap import tempdir, worker
+        from wdwrap.staging import StagedFiles
+        StagedFiles(['2007'], [self.lc], ship=False).stage(self.staging_dir)
+        self.assertEqual(tempdir.wd_files_path('2007'), tempdir.default_wd_files_path('2007'))
+        self.assertNotIn(self.lc, worker._executables)
+        self.assertFalse(os.path.exists(self.staging_dir))
+
+    def test_manifest_cached(self):
+        from unittest import mock
+        from wdwrap import staging
+        directory = os.path.join(self.tmpdir.name, 'wd')
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'atmcof.dat'), 'w') as fd:
+            fd.write('1')
+        with mock.patch('wdwrap.staging.file_digest', wraps=staging.file_digest) as file_digest:
+            manifest = staging.dir_manifest(directory)
+            self.assertIs(staging.dir_manifest(directory), manifest)
+            self.assertEqual(file_digest.call_count, 1)
+            with open(os.path.join(directory, 'atmcof.dat'), 'w') as fd:
+                fd.write('22')
+            self.assertNotEqual(staging.dir_manifest(directory), manifest)
+            self.assertEqual(file_digest.call_count, 2)
+
+    def test_runner_uses_staged(self):
+        """Not only slim workers run staged executable"""
+        import stat
+        from wdwrap import worker
+        from wdwrap.runners import LcRunner
+        marker = os.path.join(self.tmpdir.name, 'staged-run')
+        staged = os.path.join(self.tmpdir.name, 'staged-lc')
+        with open(staged, 'w') as fd:
+            fd.write(f'#!/bin/sh\ntouch "{marker}"\nexec "{self.lc}" "$@"\n')
+        os.chmod(staged, os.stat(staged).st_mode | stat.S_IXUSR)
+        worker.set_executable(self.lc, staged)
+        self.assertIn('light', LcRunner().run(self.segment_bundles(1)[0]))
+        self.assertTrue(os.path.exists(marker))
+
+    def test_verify_fails(self):
+        from wdwrap.staging import StagedFiles
+        with self.assertRaises(RuntimeError):
+            StagedFiles(['2007'], ship=False).stage(self.staging_dir, use_local=False)
+
+    def test_external_cluster(self):
+        """Workers in separate processes, files staged by plugin are used by jobs"""
+        from distributed import Client, LocalCluster
+        from wdwrap.backends import DaskExternalBackend
+        from wdwrap.daskplugin import StagingPlugin
+        from wdwrap.staging import StagedFiles
+        cluster = LocalCluster(n_workers=2, threads_per_worker=1, processes=True, dashboard_address=None)
+        client = Client(cluster)
+        try:
+            plugin = StagingPlugin(StagedFiles(['2015'], [self.lc]), directory=self.staging_dir, use_local=False)
+            backend = DaskExternalBackend(client=client, staging=plugin)
+            for path, executables in client.run(staged_paths, '2015').values():
+                self.assertTrue(path.startswith(self.staging_dir))
+                self.assertTrue(executables[self.lc].startswith(self.staging_dir))
+            s = self.scheduler(backend)
+            ret = s.schedule('lc', self.segment_bundles(1)[0]).result(timeout=60)
+            self.assertEqual(len(ret['light']), 101)
+            self.assertEqual(self.runs_count(), 1)
+        finally:
+            client.close()
+            cluster.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Unit tests of job timing telemetry
+"""
+import os
+import unittest
+
+from fakelc import FakeLcTestCase
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        from wdwrap.telemetry import Histogram
+        h = Histogram((0.1, 1.0, 10.0))
+        for v in [0.05, 0.5, 0.6, 5.0, 50.0]:
+            h.observe(v)
+        self.assertEqual(h.counts, [1, 3, 4])
+        self.assertEqual(h.count, 5)
+        self.assertAlmostEqual(h.sum, 56.15)
+        self.assertEqual(h.percentile(50), 1.0)
+        self.assertIsNone(h.percentile(100))  # above the last bucket
+
+    def test_stage_outside_job(self):
+        from wdwrap import telemetry
+        with telemetry.stage('exec'):  # no-op
+            pass
+        self.assertIsNone(telemetry.current())
+        timed = telemetry.run_timed(lambda: telemetry.add('exec', 1.5) or 42, 0.0)
+        self.assertEqual(timed.value, 42)
+        self.assertEqual(timed.timing.stages['exec'], 1.5)
+        self.assertIsNone(telemetry.current())
+
+
+class TestJobTiming(FakeLcTestCase):
+
+    def check_timing(self, timing, render=True):
+        self.assertIsNotNone(timing)
+        for stage in ['queue', 'setup', 'exec', 'parse'] + (['render'] if render else []):
+            self.assertIn(stage, timing.stages)
+            self.assertGreaterEqual(timing.stages[stage], 0.0)
+        self.assertGreater(timing.cpu_time, 0.0)
+        self.assertGreater(timing.max_rss, 2**20)
+
+    def test_inline(self):
+        s = self.scheduler()
+        f = s.schedule('lc', self.segment_bundles(1)[0])
+        f.result()
+        self.check_timing(f.timing)
+
+    def test_processes(self):
+        from wdwrap.backends import ProcessBackend
+        s = self.scheduler(ProcessBackend(workers=2))
+        try:
+            futures = [s.schedule('lc', b) for b in self.segment_bundles(2)]
+            for f in futures:
+                f.result(timeout=30)
+                self.check_timing(f.timing)
+        finally:
+            s.backend.shutdown()
+
+    def test_full_runner(self):
+        """Without slim workers lcin is rendered on worker"""
+        s = self.scheduler()
+        s.slim_workers = False
+        f = s.schedule('lc', self.segment_bundles(1)[0])
+        f.result()
+        self.check_timing(f.timing)
+
+    def test_aggregation(self):
+        from wdwrap.cache import LcResultCache
+        s = self.scheduler(executors=None, cache=LcResultCache(memory_items=8, directory=None))
+        s.executors['inv'] = lambda x: 1 / x
+        bundles = self.segment_bundles(2)
+        for b in bundles:
+            s.schedule('lc', b).result()
+        s.schedule('lc', bundles[0]).result()  # cached
+        with self.assertRaises(ZeroDivisionError):
+            s.schedule('inv', 0).result()
+        t = s.telemetry
+        self.assertEqual(t.counter('lc', 'done'), 2)
+        self.assertEqual(t.counter('lc', 'cached'), 1)
+        self.assertEqual(t.counter('inv', 'failed'), 1)
+        self.assertEqual(t.histogram('lc', 'exec').count, 2)
+        self.assertEqual(t.histogram('lc', None, 'max_rss_bytes').count, 2)
+        text = t.prometheus_text()
+        self.assertIn('wdwrap_jobs_total{kind="lc",status="done"} 2', text)
+        self.assertIn('wdwrap_job_stage_seconds_bucket{kind="lc",stage="exec",le="+Inf"} 2', text)
+        self.assertIn('wdwrap_job_cpu_seconds_count{kind="lc"} 2', text)
+        path = os.path.join(self.tmpdir.name, 'wdwrap.prom')
+        t.dump(path)
+        with open(path) as fd:
+            self.assertEqual(fd.read(), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""
+Unit tests of WD working directories
+"""
+import os
+import tempfile
+import unittest
+
+
+class TestWdDirPool(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_recycle(self):
+        from wdwrap.tempdir import WdDirPool
+        pool = WdDirPool(root=self.root.name)
+        with pool.workdir('2015') as d1:
+            self.assertTrue(os.path.islink(os.path.join(d1, 'atmcofplanck.dat')))
+            with open(os.path.join(d1, 'light.dat'), 'w') as fd:
+                fd.write('output')
+            os.mkdir(os.path.join(d1, 'subdir'))
+        with pool.workdir('2015') as d2:
+            self.assertEqual(d1, d2)
+            self.assertFalse(os.path.exists(os.path.join(d2, 'light.dat')))
+            self.assertFalse(os.path.exists(os.path.join(d2, 'subdir')))
+            self.assertTrue(os.path.islink(os.path.join(d2, 'atmcofplanck.dat')))
+        self.assertEqual(len(os.listdir(self.root.name)), 1)
+        pool.clear()
+        self.assertEqual(len(os.listdir(self.root.name)), 0)
+
+    def test_pool_size(self):
+        from wdwrap.tempdir import WdDirPool
+        pool = WdDirPool(root=self.root.name, max_idle=2)
+        leased = [pool.workdir('2015') for _ in range(4)]
+        self.assertEqual(len({d.path for d in leased}), 4)
+        self.assertEqual(pool.leased_count(), 4)
+        for d in leased:
+            d.pool.release(d)
+        self.assertEqual(pool.idle_count(), 2)
+        self.assertEqual(len(os.listdir(self.root.name)), 2)
+
+    def test_default_instance_threads(self):
+        import threading
+        import time
+        from wdwrap.tempdir import WdDirPool
+        root = self.root.name
+
+        class SlowPool(WdDirPool):
+            _defaultInstance = None
+
+            @classmethod
+            def from_config(cls):
+                time.sleep(0.05)
+                return cls(root=root)
+
+        pools = []
+        threads = [threading.Thread(target=lambda: pools.append(SlowPool.default_instance())) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len({id(p) for p in pools}), 1)
+
+    def test_disk_cap(self):
+        from wdwrap.tempdir import WdDirPool
+        pool = WdDirPool(root=self.root.name, max_disk=0)
+        with pool.workdir('2015'):
+            pass
+        self.assertEqual(pool.idle_count(), 0)
+        self.assertEqual(len(os.listdir(self.root.name)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
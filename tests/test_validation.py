@@ -0,0 +1,153 @@
+"""
+Unit tests of pre-flight validation of bundles
+"""
+import unittest
+
+import numpy as np
+
+from fakelc import FakeLcTestCase
+
+
+class TestCriticalPotentials(unittest.TestCase):
+
+    def test_values(self):
+        from wdwrap.validation import critical_potentials, outer_critical_potential
+        pot1, pot2 = critical_potentials(1.0)
+        self.assertAlmostEqual(float(pot1), 3.75, places=9)
+        self.assertAlmostEqual(float(pot2), 3.75, places=9)
+        self.assertAlmostEqual(float(outer_critical_potential(1.0)), 3.2068, places=4)
+        # star 2 of mass ratio q is star 1 of mass ratio 1/q
+        q = np.array([0.1, 0.5, 2.0])
+        _, pot2 = critical_potentials(q)
+        pot1, _ = critical_potentials(1.0 / q)
+        np.testing.assert_allclose(pot2, q * pot1 + 0.5 * (1.0 - q))
+
+    def test_eccentric_nonsynchronous(self):
+        """Lobes shrink at periastron and with faster rotation, i.e. critical potentials grow"""
+        from wdwrap.validation import critical_potentials
+        circular, _ = critical_potentials(0.7)
+        eccentric, _ = critical_potentials(0.7, e=0.3)
+        fast, _ = critical_potentials(0.7, f1=2.0)
+        self.assertGreater(float(eccentric), float(circular))
+        self.assertGreater(float(fast), float(circular))
+
+
+class TestValidation(unittest.TestCase):
+
+    def setUp(self):
+        import wdwrap
+        self.bundle = wdwrap.default_binary()
+
+    def test_default_valid(self):
+        from wdwrap.validation import check, problems
+        self.assertEqual(problems(self.bundle), [])
+        check(self.bundle)
+
+    def test_overflowing_detached(self):
+        from wdwrap.exceptions import ValidationError
+        from wdwrap.validation import check
+        self.bundle['POTH'] = 4.0
+        with self.assertRaises(ValidationError) as cm:
+            check(self.bundle)
+        self.assertEqual(len(cm.exception.problems), 1)
+        self.assertIn('POTH', cm.exception.problems[0])
+
+    def test_overcontact(self):
+        from wdwrap.validation import problems
+        b = self.bundle
+        b['MODE'], b['E'], b['F1'], b['F2'], b['RM'] = 3, 0.0, 1.0, 1.0, 1.0
+        b['POTH'], b['POTC'] = 3.5, 3.5
+        self.assertEqual(problems(b), [])
+        b['POTH'] = 3.8  # detached
+        self.assertEqual(len(problems(b)), 1)
+        b['POTH'], b['E'] = 3.5, 0.1
+        self.assertEqual(len(problems(b)), 1)
+
+    def test_range_and_consistency(self):
+        from wdwrap.validation import problems
+        b = self.bundle
+        b['XINCL'] = 200.0
+        b['PHIN'] = 0.0
+        b['MPAGE'] = 3  # line profiles
+        found = problems(b)
+        self.assertTrue(any(p.startswith('XINCL') for p in found))
+        self.assertTrue(any('grid' in p for p in found))
+        self.assertTrue(any('MPAGE=3' in p for p in found))
+
+    def test_arrays(self):
+        from wdwrap.validation import check_arrays, critical_potentials, valid_mask
+        poth = np.linspace(2.0, 10.0, 81)
+        rm = np.array([[0.5], [1.0]])
+        mask = valid_mask(self.bundle, POTH=poth, RM=rm)
+        self.assertEqual(mask.shape, (2, 81))
+        crit1, _ = critical_potentials(rm, self.bundle['F1'].val, self.bundle['F2'].val, self.bundle['E'].val)
+        np.testing.assert_array_equal(mask, poth >= crit1)
+        self.assertIn('RM outside [0.0, None]', check_arrays(self.bundle, RM=[-1.0, 1.0]))
+
+    def test_many(self):
+        from wdwrap.validation import problems, problems_many
+        bundles = [self.bundle.clone() for _ in range(5)]
+        bundles[2]['POTC'] = 1.0
+        found = problems_many(bundles)
+        self.assertEqual([bool(f) for f in found], [False, False, True, False, False])
+        self.assertEqual(found[2], problems(bundles[2]))
+
+
+class TestScheduling(FakeLcTestCase):
+
+    def test_schedule_rejected(self):
+        from wdwrap.exceptions import ValidationError
+        s = self.scheduler()
+        b = self.segment_bundles(1)[0]
+        b['POTH'] = 4.0
+        f = s.schedule('lc', b)
+        with self.assertRaises(ValidationError):
+            f.result()
+        self.assertEqual(self.runs_count(), 0)
+        self.assertEqual(s.telemetry.counter('lc', 'invalid'), 1)
+        s.validate = False
+        s.schedule('lc', b).result()
+        self.assertEqual(self.runs_count(), 1)
+
+    def test_batch_rejected(self):
+        from wdwrap.exceptions import ValidationError
+        s = self.scheduler()
+        bundles = self.segment_bundles(3)
+        bundles[1]['POTC'] = 1.0
+        with self.assertRaises(ValidationError) as cm:
+            s.schedule('lc-batch', bundles).result()
+        self.assertTrue(cm.exception.problems[0].startswith('bundle 1:'))
+
+    def test_map(self):
+        from wdwrap.exceptions import ValidationError
+        s = self.scheduler()
+        bundles = self.segment_bundles(4)
+        bundles[1]['POTH'] = 4.0
+        ret = dict(s.map('lc', bundles, window=3, return_exceptions=True))
+        self.assertIsInstance(ret[1], ValidationError)
+        for n in (0, 2, 3):
+            self.assertIn('light', ret[n])
+        self.assertEqual(self.runs_count(), 3)
+
+    def test_curve_invalid(self):
+        """Generation of curve of invalid model finishes, without points"""
+        from wdwrap.bundle import Bundle
+        from wdwrap.curves import LightCurve
+        from wdwrap.jobs import JobScheduler
+        scheduler = JobScheduler._instance
+        JobScheduler._instance = self.scheduler()
+        try:
+            bundle = Bundle.default_binary()
+            bundle['POTH'] = 4.0
+            g = LightCurve(bundle=bundle).gen_values
+            g.generate()
+            self.assertTrue(g.wait(timeout=10))
+            self.assertEqual(g.status, g.STATUS.Ready)
+            self.assertEqual(len(g.df), 0)
+            self.assertEqual(self.runs_count(), 0)
+        finally:
+            JobScheduler._instance = scheduler
+
+
+if __name__ == '__main__':
+    unittest.main()
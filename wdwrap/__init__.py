@@ -1,8 +1,17 @@
 
 
-# Following imports allows `from wdwrap import u` to match phoebe2 convention
-import astropy.constants as c
-import astropy.units as u
+# `from wdwrap import u` (and `c`) matches phoebe2 convention,
+# astropy is imported on first use, so slim job workers (`wdwrap.worker`) do not load it
+
+
+def __getattr__(name):
+    if name == 'u':
+        import astropy.units as u
+        return u
+    if name == 'c':
+        import astropy.constants as c
+        return c
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 # Convenience functions
 
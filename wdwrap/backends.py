@@ -0,0 +1,823 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Execution backends of `JobScheduler`
+
+Backend runs job executors (e.g. `LcRunner`) and returns `JobFuture`, the same future type for all backends:
+   * `InlineBackend` : runs jobs synchronously in the calling thread
+   * `ThreadBackend` : `concurrent.futures` thread pool
+   * `ProcessBackend` : `concurrent.futures` process pool
+   * `DaskBackend` : local Dask cluster
+   * `DaskExternalBackend` : existing Dask scheduler (`[jobs] scheduler-address`)
+   * `BatchBackend` : SLURM-style batch queue, jobs are submitted as array jobs (`[batch]` section)
+Backend is selected by `[jobs] backend` configuration option.
+"""
+import collections
+import concurrent.futures
+import os
+import tempfile
+import threading
+import time
+import uuid
+from configparser import NoSectionError, NoOptionError
+from typing import Callable, Optional
+
+from .config import cfg
+
+_logger = None
+def logger():
+    global _logger
+    if _logger is None:
+        import logging
+        _logger = logging.getLogger('backends')
+    return _logger
+
+
+class JobFuture(concurrent.futures.Future):
+    """Future of a job, common for all backends
+
+    Follows backend specific future (see `follow`). Cancel of not finished job always succeeds
+    (the future is cancelled immediately), backend is asked to cancel the job with `on_cancel` callback.
+    Futures of `JobScheduler` jobs carry `timing` (`wdwrap.telemetry.JobTiming`) of the finished job.
+    Backends set `settled` to future done when the job cannot run anymore (finished or cancelled before start),
+    `None` if cancel of running job may not stop it.
+    """
+
+    timing = None
+    settled = None
+
+    def __init__(self, on_cancel: Optional[Callable[[], None]] = None):
+        super().__init__()
+        self._cancel_callbacks = []
+        if on_cancel is not None:
+            self.add_cancel_callback(on_cancel)
+
+    def add_cancel_callback(self, fn: Callable[[], None]):
+        """`fn()` will be called when the future is cancelled (to cancel actual job)"""
+        self._cancel_callbacks.append(fn)
+
+    def cancel(self) -> bool:
+        # JobFuture is never marked as running, so cancel fails only for finished jobs
+        if self.cancelled():
+            return True
+        ret = super().cancel()
+        if ret:
+            for fn in self._cancel_callbacks:
+                try:
+                    fn()
+                except Exception as e:
+                    logger().warning(f'Job cancel failed: {e}')
+        return ret
+
+    def set_result_if_pending(self, result):
+        try:
+            self.set_result(result)
+        except concurrent.futures.InvalidStateError:  # cancelled meantime
+            pass
+
+    def set_exception_if_pending(self, exception):
+        try:
+            self.set_exception(exception)
+        except concurrent.futures.InvalidStateError:  # cancelled meantime
+            pass
+
+    def follow(self, future, transform: Optional[Callable] = None) -> 'JobFuture':
+        """Copies state of `future` (`concurrent.futures.Future` or Dask future) when it's done
+
+        Result is converted by `transform(result)` if provided."""
+        future.add_done_callback(lambda f: self._copy_state(f, transform))
+        return self
+
+    def _copy_state(self, future, transform=None):
+        if self.done():
+            return
+        if future.cancelled():
+            concurrent.futures.Future.cancel(self)
+            return
+        try:
+            result = future.result()
+            if transform is not None:
+                result = transform(result)
+            self.timing = getattr(future, 'timing', None) or self.timing
+            self.set_result_if_pending(result)
+        except BaseException as e:
+            self.set_exception_if_pending(e)
+
+    @classmethod
+    def ready(cls, result) -> 'JobFuture':
+        """Already finished future"""
+        f = cls()
+        f.set_result(result)
+        return f
+
+    @classmethod
+    def failed(cls, exception: BaseException) -> 'JobFuture':
+        """Already failed future"""
+        f = cls()
+        f.set_exception(exception)
+        return f
+
+
+class CancelToken(object):
+    """Cancel flag passed to running job
+
+    Runner polls `is_set` while `lc` runs and kills it when set.
+    Backends provide token suitable for location of their workers (see `Backend.make_cancel_token`)."""
+
+    def set(self):
+        raise NotImplementedError
+
+    def is_set(self) -> bool:
+        raise NotImplementedError
+
+    def release(self):
+        """Frees resources, called when job is done"""
+        pass
+
+
+class EventCancelToken(CancelToken):
+    """In-process cancel flag (`threading.Event`), for jobs run in the same process"""
+
+    def __init__(self):
+        super(EventCancelToken, self).__init__()
+        self._event = threading.Event()
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+
+class FileCancelToken(CancelToken):
+    """Cancel flag visible to all processes of the host, flag is set by creating a file"""
+
+    directory = os.path.join(tempfile.gettempdir(), 'wdwrap_cancel')
+
+    def __init__(self, directory: Optional[str] = None):
+        super(FileCancelToken, self).__init__()
+        if directory is not None:
+            self.directory = directory  # e.g. on filesystem shared with batch nodes
+        self.path = os.path.join(self.directory, uuid.uuid4().hex)
+        self._released = False
+
+    def set(self):
+        if self._released:  # job is not running anymore, flag would never be removed
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            open(self.path, 'w').close()
+        except OSError as e:
+            logger().warning(f'Cannot set cancel flag {self.path}: {e}')
+
+    def is_set(self) -> bool:
+        return os.path.exists(self.path)
+
+    def release(self):
+        self._released = True
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class DaskCancelToken(CancelToken):
+    """Cancel flag shared by Dask cluster (`distributed.Event`), for workers on remote hosts"""
+
+    def __init__(self):
+        super(DaskCancelToken, self).__init__()
+        self.name = f'wdwrap-cancel-{uuid.uuid4().hex}'
+        self._released = False
+        self._dask_event = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_dask_event'] = None  # bound to client of the process
+        return state
+
+    def _event(self):
+        if self._dask_event is None:  # created once, `is_set` is polled
+            from distributed import Event
+            self._dask_event = Event(self.name)
+        return self._dask_event
+
+    def set(self):
+        if self._released:
+            return
+        self._event().set()
+
+    def is_set(self) -> bool:
+        try:
+            return self._event().is_set()
+        except Exception:  # no scheduler connection
+            return False
+
+    def release(self):
+        self._released = True
+        try:
+            self._event().clear()
+        except Exception:
+            pass
+
+
+class _Exports(object):
+    """Objects exported to files for jobs (see `Backend.share`), each key is exported once"""
+
+    def __init__(self):
+        super(_Exports, self).__init__()
+        self._exported = {}  # key: exported object
+        self._lock = threading.Lock()
+
+    def export(self, obj, directory: str):
+        with self._lock:
+            try:
+                return self._exported[obj.key]
+            except KeyError:
+                pass
+            ret = self._exported[obj.key] = obj.export(directory)
+        return ret
+
+    def unlink(self):
+        """Removes files of all exported objects"""
+        with self._lock:
+            exported, self._exported = list(self._exported.values()), {}
+        for obj in exported:
+            obj.unlink()
+
+
+class Backend(object):
+    """Abstract backend running jobs"""
+
+    name = None
+    scalable = False  # number of workers can be changed by `scale`
+    shared_memory = False  # workers are processes on client's host, results can be passed by shared memory
+    speculative = True  # duplicates of straggling jobs are run by default (see `[jobs] speculative`)
+
+    def __init__(self, workers: Optional[int] = None):
+        super(Backend, self).__init__()
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+
+    def submit(self, fn, *args, **kwargs) -> JobFuture:
+        raise NotImplementedError
+
+    def make_cancel_token(self) -> CancelToken:
+        """Cancel token which can be passed to jobs run by the backend"""
+        return EventCancelToken()
+
+    def share(self, obj):
+        """Prepares `obj` (e.g. `Observations`) used by many jobs to be shipped to each worker once
+
+        Returns object to be passed to jobs instead of `obj`. In-process backends pass `obj` itself."""
+        return obj
+
+    def scale(self, workers: int):
+        """Changes number of workers, running jobs are never interrupted"""
+        if self.scalable:
+            self.workers = workers
+
+    def shutdown(self):
+        pass
+
+
+class InlineBackend(Backend):
+    """Runs jobs synchronously, `submit` returns finished future"""
+
+    name = 'inline'
+
+    def __init__(self, workers: Optional[int] = None):
+        super().__init__(workers=1)
+
+    def submit(self, fn, *args, **kwargs) -> JobFuture:
+        f = JobFuture()
+        try:
+            f.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            f.set_exception(e)
+        f.settled = f
+        return f
+
+
+class PoolExecutorBackend(Backend):
+    """Base for `concurrent.futures` executors backends"""
+
+    executor_class = None
+    scalable = True
+
+    def __init__(self, workers: Optional[int] = None):
+        super().__init__(workers=workers)
+        self.executor = self.executor_class(max_workers=self.workers)
+
+    def submit(self, fn, *args, **kwargs) -> JobFuture:
+        fut = self.executor.submit(fn, *args, **kwargs)
+        ret = JobFuture(on_cancel=fut.cancel).follow(fut)
+        ret.settled = fut  # cancel of executor future fails for running job
+        return ret
+
+    def scale(self, workers: int):
+        """Replaces executor, the old one finishes its running jobs and exits"""
+        if workers == self.workers:
+            return
+        old, self.executor = self.executor, self.executor_class(max_workers=workers)
+        self.workers = workers
+        old.shutdown(wait=False)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ThreadBackend(PoolExecutorBackend):
+    name = 'threads'
+    executor_class = concurrent.futures.ThreadPoolExecutor
+
+
+class ProcessBackend(PoolExecutorBackend):
+    name = 'processes'
+    executor_class = concurrent.futures.ProcessPoolExecutor
+    shared_memory = True
+
+    def __init__(self, workers: Optional[int] = None):
+        super().__init__(workers=workers)
+        self._exports = _Exports()  # files are removed on `shutdown`
+
+    def make_cancel_token(self) -> CancelToken:
+        return FileCancelToken()
+
+    def share(self, obj):
+        """Exported to shared memory file once, pickles as reference and is read once per worker process"""
+        from .shmem import default_directory
+        return self._exports.export(obj, default_directory())
+
+    def shutdown(self):
+        super().shutdown()
+        self._exports.unlink()
+
+
+class DaskBackend(Backend):
+    """Local Dask cluster backend, or existing `client`"""
+
+    name = 'dask'
+    scalable = True
+
+    def __init__(self, workers: Optional[int] = None, client=None):
+        super().__init__(workers=workers)
+        self._own_client = client is None  # local cluster set up by the backend, not caller's client
+        if client is None:
+            client = self._make_client(workers)
+        self.client = client
+        self._scattered = collections.OrderedDict()  # key: future of object shared by jobs
+        try:
+            self.workers = sum(client.nthreads().values()) or self.workers
+        except Exception:
+            pass
+        self._register_plugins()
+
+    @property
+    def shared_memory(self) -> bool:
+        """Local cluster of worker processes"""
+        from distributed import LocalCluster, Nanny
+        cluster = getattr(self.client, 'cluster', None)
+        if not isinstance(cluster, LocalCluster):
+            return False
+        worker_class = getattr(cluster, 'new_spec', {}).get('cls')
+        return isinstance(worker_class, type) and issubclass(worker_class, Nanny)
+
+    def share(self, obj):
+        """Scattered to all workers once"""
+        key = obj.key
+        try:
+            return self._scattered[key]
+        except KeyError:
+            pass
+        fut = self.client.scatter(obj, broadcast=True, hash=False)
+        self._scattered[key] = fut
+        while len(self._scattered) > 16:
+            self._scattered.popitem(last=False)
+        return fut
+
+    def _register_plugins(self):
+        try:
+            from .daskplugin import SlimWorkerPlugin
+            self.client.register_plugin(SlimWorkerPlugin())
+        except Exception as e:
+            logger().warning(f'Cannot register worker plugin: {e}')
+
+    def _make_client(self, workers):
+        from dask.distributed import Client
+        logger().info(f'Setting up multiprocess dask client with {workers} workers')
+        return Client(n_workers=workers, threads_per_worker=1)  # lc is single threaded
+
+    def submit(self, fn, *args, **kwargs) -> JobFuture:
+        fut = self.client.submit(fn, *args, **kwargs)
+        return JobFuture(on_cancel=fut.cancel).follow(fut)
+
+    def make_cancel_token(self) -> CancelToken:
+        if self._own_client:
+            return FileCancelToken()  # local cluster, workers on the same host
+        return DaskCancelToken()  # caller's client, workers may run on other hosts
+
+    def scale(self, workers: int):
+        """Scales local cluster, only idle workers are closed, never below the number of busy ones"""
+        cluster = getattr(self.client, 'cluster', None)
+        if cluster is None or workers == self.workers:
+            return
+        try:
+            threads = max(self.client.nthreads().values())  # threads per worker process
+            processing = self.client.processing()  # worker address: keys of its tasks
+            names = {a: w['name'] for a, w in self.client.scheduler_info(n_workers=-1)['workers'].items()}
+        except Exception:  # no workers or no scheduler connection
+            threads, processing, names = 1, {}, {}
+        target = max(workers // threads, 1)
+        if target >= len(processing):
+            cluster.scale(target)
+        else:  # `cluster.scale` would close arbitrary workers, killing their running jobs
+            idle = [names[a] for a, keys in processing.items() if not keys and a in names]
+            idle = idle[:len(processing) - target]
+            if idle:
+                cluster.sync(cluster.scale_down, idle)
+            target = len(processing) - len(idle)
+        self.workers = target * threads
+
+    def shutdown(self):
+        self.client.close()
+
+
+class DaskExternalBackend(DaskBackend):
+    """Connects to running Dask scheduler at `[jobs] scheduler-address`
+
+    Workers may have no filesystem shared with client, WD data files and `lc` executable are staged
+    (or verified) on each worker by `StagingPlugin` (see `wdwrap.staging`, `[jobs] stage-files`).
+    `staging` can be plugin to register instead of configured one, or `False` to disable staging.
+    """
+
+    name = 'dask-external'
+    scalable = False  # cluster is managed externally
+    shared_memory = False  # workers may run on other hosts
+    workers_refresh_interval = 2.0  # how often number of workers is read from scheduler [s]
+    _workers_read = float('-inf')  # time of last read of number of workers
+
+    def __init__(self, workers: Optional[int] = None, client=None, address: Optional[str] = None, staging=None):
+        if address is None and client is None:
+            address = cfg().get('jobs', 'scheduler-address')
+        self.address = address
+        self.staging = staging
+        super().__init__(workers=workers, client=client)
+
+    @property
+    def workers(self) -> int:
+        """Threads of connected workers, refreshed as the cluster is scaled externally"""
+        now = time.monotonic()
+        if now - self._workers_read >= self.workers_refresh_interval:
+            self._workers_read = now
+            try:
+                self._workers = max(sum(self.client.nthreads().values()), 1)  # queued on scheduler till one joins
+            except Exception:  # not connected yet or no scheduler connection
+                pass
+        return self._workers
+
+    @workers.setter
+    def workers(self, value: int):
+        self._workers = value
+
+    def _register_plugins(self):
+        super()._register_plugins()
+        staging = self.staging if self.staging is not None else self.staging_from_config()
+        if staging:
+            self.client.register_plugin(staging)  # raises if files cannot be staged
+
+    @staticmethod
+    def staging_from_config():
+        """`StagingPlugin` of configured `lc` and WD versions, `None` if `[jobs] stage-files` is no"""
+        c = cfg()
+        mode = c.get('jobs', 'stage-files', fallback='yes').strip().lower()
+        if mode not in ('yes', 'verify'):
+            return None
+        from .daskplugin import StagingPlugin
+        from .staging import StagedFiles
+        wdversions = c.get('jobs', 'stage-wdversions', fallback='').split() or [c.get('executables', 'version')]
+        files = StagedFiles(wdversions, [c.get('executables', 'lc')], ship=mode == 'yes')
+        directory = c.get('jobs', 'staging-dir', fallback='').strip() or None
+        return StagingPlugin(files, directory=directory)
+
+    def _make_client(self, workers):
+        from dask.distributed import Client
+        logger().info(f'Connecting to dask scheduler {self.address}')
+        return Client(self.address)
+
+    def make_cancel_token(self) -> CancelToken:
+        return DaskCancelToken()
+
+
+class _BatchArray(object):
+    """Submitted array job"""
+
+    def __init__(self, directory: str, job_id: str, tasks: dict):
+        super(_BatchArray, self).__init__()
+        self.directory = directory
+        self.job_id = job_id
+        self.tasks = tasks  # index: JobFuture, not collected tasks
+
+
+class BatchBackend(Backend):
+    """SLURM-style batch queue backend
+
+    Jobs submitted within `collect_delay` (at most `max_array_size`) are rendered into a directory shared
+    with batch nodes, one task file per job (with slim workers it's pre-rendered lcin, see `LcRunner.job_spec`),
+    and submitted as one array job. Task `n` is run on batch node by `wdwrap.worker.main`
+    and writes `results/n.pkl`, results are collected as they appear. Tasks which left the queue without
+    result fail. Cancel of job cancels its task (`scancel <job>_<n>`).
+
+    Commands are pluggable (`[batch]` section), they are called as:
+        `<submit> --parsable <script>` prints job id,
+        `<queue> -h -r -j <job> -o %i` prints not finished tasks, `<job>_<n>` per line,
+        `<cancel> <job>_<n>`.
+
+    Parameters
+    ----------
+    workers : int or None
+        Max number of tasks in flight (queued or running), default `[batch] max-tasks`
+    directory : str or None
+        Directory shared with batch nodes, default `[batch] directory` or `~/.cache/wdwrap/batch`
+    submit, queue, cancel : str or None
+        Commands (can contain options), default `[batch] submit/queue/cancel` or `sbatch`, `squeue`, `scancel`
+    python : str or None
+        Python interpreter on batch nodes, default `[batch] python` or client's interpreter
+    """
+
+    name = 'batch'
+    speculative = False  # duplicate would wait in cluster queue and its node time is charged
+
+    def __init__(self, workers: Optional[int] = None, directory: Optional[str] = None,
+                 submit: Optional[str] = None, queue: Optional[str] = None, cancel: Optional[str] = None,
+                 python: Optional[str] = None):
+        import shlex
+        import sys
+        c = cfg()
+        if workers is None:
+            workers = c.getint('batch', 'max-tasks', fallback=256)
+        super().__init__(workers=workers)
+        self.directory = directory or c.get('batch', 'directory', fallback='').strip() \
+            or os.path.expanduser('~/.cache/wdwrap/batch')
+        os.makedirs(self.directory, exist_ok=True)
+        self.submit_command = shlex.split(submit or c.get('batch', 'submit', fallback='sbatch'))
+        self.queue_command = shlex.split(queue or c.get('batch', 'queue', fallback='squeue'))
+        self.cancel_command = shlex.split(cancel or c.get('batch', 'cancel', fallback='scancel'))
+        self.python = python or c.get('batch', 'python', fallback='').strip() or sys.executable
+        self.options = c.get('batch', 'options', fallback='').strip()  # extra #SBATCH lines content
+        self.collect_delay = c.getfloat('batch', 'collect-delay', fallback=0.2)
+        self.max_array_size = c.getint('batch', 'max-array-size', fallback=1000)
+        self.poll_interval = c.getfloat('batch', 'poll-interval', fallback=0.5)
+        self.queue_interval = c.getfloat('batch', 'queue-interval', fallback=10.0)
+        self._cond = threading.Condition()
+        self._queued = []  # (future, fn, args, kwargs) waiting for array submission
+        self._queued_since = None
+        self._arrays = []
+        self._thread = None
+        self._closed = False
+        self._exports = _Exports()  # files are removed on `shutdown`
+
+    def submit(self, fn, *args, **kwargs) -> JobFuture:
+        f = JobFuture()
+        f.add_cancel_callback(lambda: self._cancel(f))
+        f.settled = f  # cancelled task is removed from queue or killed
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Backend is shut down')
+            if not self._queued:
+                self._queued_since = time.monotonic()
+            self._queued.append((f, fn, args, kwargs))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='wdwrap-batch', daemon=True)
+                self._thread.start()
+            elif len(self._queued) >= self.max_array_size:
+                self._cond.notify()
+        return f
+
+    def make_cancel_token(self) -> CancelToken:
+        return FileCancelToken(directory=os.path.join(self.directory, 'cancel'))
+
+    def share(self, obj):
+        """Exported to shared directory once, pickles as reference and is read once per task"""
+        return self._exports.export(obj, self.directory)
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            queued, self._queued = self._queued, []
+            arrays, self._arrays = self._arrays, []
+            self._cond.notify()
+        for f, _, _, _ in queued:
+            concurrent.futures.Future.cancel(f)
+        for array in arrays:
+            self._command(self.cancel_command + [array.job_id])
+            for f in array.tasks.values():
+                concurrent.futures.Future.cancel(f)
+            self._remove(array)
+        self._exports.unlink()
+
+    def _run(self):
+        last_queue_check = time.monotonic()
+        while True:
+            batch = None
+            with self._cond:
+                if self._closed or (not self._queued and not self._arrays):
+                    self._thread = None
+                    return
+                if self._queued:
+                    wait = self._queued_since + self.collect_delay - time.monotonic()
+                    if wait <= 0 or len(self._queued) >= self.max_array_size:
+                        batch = self._queued[:self.max_array_size]
+                        del self._queued[:self.max_array_size]
+                        self._queued_since = time.monotonic()
+            if batch:
+                self._submit_array(batch)
+            now = time.monotonic()
+            if now - last_queue_check >= self.queue_interval:
+                last_queue_check = now
+                self._check_queue()
+            else:
+                self._collect()
+            with self._cond:
+                wait = self.poll_interval
+                if self._queued:
+                    wait = min(wait, max(self._queued_since + self.collect_delay - time.monotonic(), 0.0))
+                if wait > 0:
+                    self._cond.wait(wait)
+
+    def _submit_array(self, batch):
+        import pickle
+        directory = tempfile.mkdtemp(prefix='wdwrap_array-', dir=self.directory)
+        for sub in ['tasks', 'results', 'logs']:
+            os.mkdir(os.path.join(directory, sub))
+        tasks = {}
+        for f, fn, args, kwargs in batch:
+            if f.cancelled():
+                continue
+            index = len(tasks)
+            try:
+                with open(os.path.join(directory, 'tasks', f'{index}.pkl'), 'wb') as fd:
+                    pickle.dump((fn, args, kwargs), fd)
+            except Exception as e:
+                f.set_exception_if_pending(e)
+                continue
+            tasks[index] = f
+        if not tasks:
+            self._remove(_BatchArray(directory, None, tasks))
+            return
+        script = os.path.join(directory, 'job.sh')
+        with open(script, 'w') as fd:
+            fd.write(self.render_script(directory, len(tasks)))
+        out, err, code = self._command(self.submit_command + ['--parsable', script])
+        job_id = out.strip().split(';')[0] if code == 0 else ''
+        if not job_id:
+            e = RuntimeError(f'Batch job submission failed ({code}): {err.strip() or out.strip()}')
+            for f in tasks.values():
+                f.set_exception_if_pending(e)
+            self._remove(_BatchArray(directory, None, tasks))
+            return
+        logger().info(f'Submitted batch array job {job_id} of {len(tasks)} tasks')
+        array = _BatchArray(directory, job_id, tasks)
+        with self._cond:
+            if self._closed:
+                self._command(self.cancel_command + [job_id])
+                return
+            self._arrays.append(array)
+
+    def render_script(self, directory: str, tasks: int) -> str:
+        """Array job script, task index is taken from `$SLURM_ARRAY_TASK_ID`"""
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        lines = ['#!/bin/sh',
+                 '#SBATCH --job-name=wdwrap',
+                 f'#SBATCH --array=0-{tasks - 1}',
+                 f'#SBATCH --output={os.path.join(directory, "logs", "%a.out")}']
+        lines += [f'#SBATCH {o}' for o in self.options.split(';') if o.strip()]
+        lines += [f'export PYTHONPATH="{package_root}${{PYTHONPATH:+:$PYTHONPATH}}"',
+                  f'exec "{self.python}" -c "from wdwrap.worker import main; main()" "{directory}"', '']
+        return '\n'.join(lines)
+
+    def _collect(self):
+        """Sets futures of tasks which results appeared"""
+        import pickle
+        for array in list(self._arrays):
+            try:
+                names = os.listdir(os.path.join(array.directory, 'results'))
+            except OSError:
+                names = []
+            for name in names:
+                if not name.endswith('.pkl'):
+                    continue
+                index = int(name[:-4])
+                with self._cond:
+                    f = array.tasks.pop(index, None)
+                if f is None:
+                    continue
+                try:
+                    with open(os.path.join(array.directory, 'results', name), 'rb') as fd:
+                        kind, value = pickle.load(fd)
+                except Exception as e:
+                    kind, value = 'error', RuntimeError(f'Cannot read result of batch task {array.job_id}_{index}: {e}')
+                if kind == 'result':
+                    f.set_result_if_pending(value)
+                else:
+                    f.set_exception_if_pending(value)
+            self._remove_if_done(array)
+
+    def _check_queue(self):
+        """Collects results, tasks which left the queue without result fail"""
+        active = {}
+        for array in list(self._arrays):
+            active[array.job_id] = self._queued_tasks(array.job_id)
+        self._collect()  # after queue check, result of finished task is already there
+        for array in list(self._arrays):
+            if active.get(array.job_id) is None:
+                continue
+            with self._cond:
+                lost = {n: array.tasks.pop(n) for n in list(array.tasks) if n not in active[array.job_id]}
+            for index, f in lost.items():
+                f.set_exception_if_pending(RuntimeError(
+                    f'Batch task {array.job_id}_{index} finished without result{self._log_tail(array, index)}'))
+            self._remove_if_done(array)
+
+    def _queued_tasks(self, job_id: str) -> Optional[set]:
+        """Indices of not finished tasks of job, `None` if the queue cannot be checked"""
+        import re
+        out, err, code = self._command(self.queue_command + ['-h', '-r', '-j', job_id, '-o', '%i'])
+        if code != 0:
+            if 'invalid job id' in err.lower():  # job left the queue
+                return set()
+            logger().warning(f'Batch queue check failed ({code}): {err.strip()}')
+            return None
+        ret = set()
+        for line in out.split():
+            m = re.fullmatch(rf'{re.escape(job_id)}_(\d+)', line.strip())
+            if m:
+                ret.add(int(m.group(1)))
+        return ret
+
+    def _cancel(self, future):
+        with self._cond:
+            for n, (f, _, _, _) in enumerate(self._queued):
+                if f is future:
+                    del self._queued[n]
+                    return
+            for array in self._arrays:
+                for index, f in array.tasks.items():
+                    if f is future:
+                        del array.tasks[index]
+                        break
+                else:
+                    continue
+                break
+            else:
+                return
+        self._command(self.cancel_command + [f'{array.job_id}_{index}'])
+        self._remove_if_done(array)
+
+    def _remove_if_done(self, array):
+        with self._cond:
+            if array.tasks or array not in self._arrays:
+                return
+            self._arrays.remove(array)
+        self._remove(array)
+
+    @staticmethod
+    def _remove(array):
+        import shutil
+        shutil.rmtree(array.directory, ignore_errors=True)
+
+    @staticmethod
+    def _log_tail(array, index, lines=5) -> str:
+        try:
+            with open(os.path.join(array.directory, 'logs', f'{index}.out')) as fd:
+                tail = fd.readlines()[-lines:]
+        except OSError:
+            return ''
+        return ':\n' + ''.join(tail) if tail else ''
+
+    @staticmethod
+    def _command(args):
+        """Runs command, returns (stdout, stderr, exit code)"""
+        import subprocess
+        try:
+            p = subprocess.run(args, capture_output=True, text=True, timeout=60)
+        except (OSError, subprocess.SubprocessError) as e:
+            return '', str(e), -1
+        return p.stdout, p.stderr, p.returncode
+
+
+BACKENDS = {b.name: b for b in [InlineBackend, ThreadBackend, ProcessBackend, DaskBackend, DaskExternalBackend,
+                                BatchBackend]}
+
+
+def backend_from_config() -> Backend:
+    """Creates backend selected by `[jobs] backend` option (default: dask)"""
+    c = cfg()
+    name = c.get('jobs', 'backend', fallback='dask').strip()
+    try:
+        workers = c.getint('jobs', 'workers')
+    except (NoSectionError, NoOptionError, ValueError):
+        workers = None
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown jobs backend "{name}", available: {", ".join(BACKENDS)}')
+    return cls(workers=workers)
@@ -66,9 +66,33 @@ class Bundle(ParameterSet):
         """Runs WD `lc` program. No need to be called directly
 
         An access to `light` or `veloc` properties calculates data if needed"""
+        from .cache import LcResultCache
         from .runners import LcRunner
         r = LcRunner()
-        return r.run(self)
+        cache = LcResultCache.default_instance()
+        if cache is None:
+            return r.run(self)
+        key = r.job_key(self)
+        ret = cache.get(key)
+        if ret is None:
+            ret = r.run(self)
+            cache.put(key, ret)
+        return ret
+
+    async def lc_async(self):
+        """Coroutine version of `lc()`"""
+        from .cache import LcResultCache
+        from .runners import LcRunner
+        r = LcRunner()
+        cache = LcResultCache.default_instance()
+        if cache is None:
+            return await r.run_async(self)
+        key = r.job_key(self)
+        ret = cache.get(key)
+        if ret is None:
+            ret = await r.run_async(self)
+            cache.put(key, ret)
+        return ret
 
     def to_dict(self):
         ret = {
@@ -116,6 +140,22 @@ class Bundle(ParameterSet):
     def veloc(self, val):
         self._veloc = val
 
+    async def light_async(self):
+        """Awaitable counterpart of `light` property"""
+        if self._light is None:
+            self['MPAGE'] = MPAGE.LIGHT
+            ret = await self.lc_async()
+            self._light = ret['light']
+        return self._light
+
+    async def veloc_async(self):
+        """Awaitable counterpart of `veloc` property"""
+        if self._veloc is None:
+            self['MPAGE'] = MPAGE.VELOC
+            ret = await self.lc_async()
+            self._veloc = ret['veloc']
+        return self._veloc
+
 
 
 
@@ -0,0 +1,239 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Content-addressed cache of LC results
+
+Results of `lc` runs are cached under a digest of the rendered lcin text, the WD version
+and the identity of the `lc` executable (see `LcRunner.job_key`).
+The cache has two tiers: in-memory LRU and persistent on-disk store with size cap.
+"""
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from configparser import NoSectionError, NoOptionError
+from typing import Optional
+
+from .config import cfg
+
+_logger = None
+def logger():
+    global _logger
+    if _logger is None:
+        import logging
+        _logger = logging.getLogger('cache')
+    return _logger
+
+
+def digest(*parts) -> str:
+    """sha256 hex digest of `parts` (strings or bytes) separated by null byte"""
+    h = hashlib.sha256()
+    for p in parts:
+        if isinstance(p, str):
+            p = p.encode()
+        h.update(p)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def copy_result(result):
+    """Copy of job result not sharing mutable objects (DataFrames, arrays) with `result`
+
+    Dicts and lists of results are copied recursively, objects with `copy` method are copied."""
+    if isinstance(result, dict):
+        return {k: copy_result(v) for k, v in result.items()}
+    if isinstance(result, (list, tuple)):
+        return type(result)(copy_result(v) for v in result)
+    copy = getattr(result, 'copy', None)
+    return copy() if callable(copy) else result
+
+
+class LcResultCache(object):
+    """Two tier (memory LRU + disk) cache of `lc` results
+
+    Results are copied on `put` and `get`, callers may modify returned dataframes.
+
+    Parameters
+    ----------
+    memory_items : int
+        Max number of results kept in memory, 0 disables memory tier
+    directory : str or None
+        Directory of persistent store, `None` disables disk tier
+    disk_size : int
+        Max size of persistent store in bytes, the least recently used entries are evicted
+    """
+
+    _defaultInstance = None
+    _defaultConfigured = False
+
+    def __init__(self, memory_items: int = 256, directory: Optional[str] = None, disk_size: int = 512 * 2**20):
+        super(LcResultCache, self).__init__()
+        self.memory_items = memory_items
+        self.directory = directory
+        self.disk_size = disk_size
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_usage = None
+
+    def get(self, key: str) -> Optional[dict]:
+        """Returns cached result or `None`, updates hit/miss counters"""
+        with self._lock:
+            try:
+                ret = self._memory[key]
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return copy_result(ret)
+            except KeyError:
+                pass
+        ret = self._disk_get(key)
+        with self._lock:
+            if ret is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._memory_put(key, ret)
+        return copy_result(ret)
+
+    def put(self, key: str, result: dict):
+        with self._lock:
+            self._memory_put(key, copy_result(result))
+        self._disk_put(key, result)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.hits = self.misses = self.disk_hits = 0
+            for path, _, _ in self._disk_entries():
+                self._remove(path)
+            self._disk_usage = 0
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'disk_hits': self.disk_hits,
+            'memory_items': len(self._memory),
+            'disk_bytes': self._disk_usage or 0,
+        }
+
+    def _memory_put(self, key, result):
+        if self.memory_items <= 0:
+            return
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    # Disk tier
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pkl')
+
+    def _disk_get(self, key):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fd:
+                ret = pickle.load(fd)
+            os.utime(path)  # mtime is LRU order for eviction
+            return ret
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _disk_put(self, key, result):
+        if not self.directory or self.disk_size <= 0:
+            return
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'wb') as fd:
+                pickle.dump(result, fd, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)  # atomic, concurrent writers of the same key are fine
+        except (OSError, pickle.PicklingError) as e:
+            logger().warning(f'Cannot store lc result in cache: {e}')
+            self._remove(tmp)
+            return
+        with self._lock:
+            if self._disk_usage is None:
+                self._disk_usage = sum(s for _, s, _ in self._disk_entries())
+            else:
+                self._disk_usage += size
+            if self._disk_usage > self.disk_size:
+                self._evict()
+
+    def _disk_entries(self):
+        """list of (path, size, mtime) of persistent store entries"""
+        ret = []
+        if not self.directory:
+            return ret
+        try:
+            subdirs = list(os.scandir(self.directory))
+        except OSError:
+            return ret
+        for sub in subdirs:
+            if not sub.is_dir():
+                continue
+            for f in os.scandir(sub.path):
+                if f.name.endswith('.pkl'):
+                    try:
+                        st = f.stat()
+                    except OSError:
+                        continue
+                    ret.append((f.path, st.st_size, st.st_mtime))
+        return ret
+
+    def _evict(self):
+        entries = sorted(self._disk_entries(), key=lambda e: e[2])
+        usage = sum(s for _, s, _ in entries)
+        target = self.disk_size * 0.9  # some hysteresis to not scan the store on every put
+        for path, size, _ in entries:
+            if usage <= target:
+                break
+            self._remove(path)
+            usage -= size
+        self._disk_usage = usage
+        logger().info(f'Cache evicted down to {usage} bytes')
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @classmethod
+    def default_instance(cls) -> Optional['LcResultCache']:
+        """Configured cache singleton, `None` if caching is disabled"""
+        if not cls._defaultConfigured:
+            cls._defaultInstance = cls.from_config()
+            cls._defaultConfigured = True
+        return cls._defaultInstance
+
+    @classmethod
+    def set_default_instance(cls, cache: Optional['LcResultCache']):
+        cls._defaultInstance = cache
+        cls._defaultConfigured = True
+
+    @classmethod
+    def from_config(cls) -> Optional['LcResultCache']:
+        """Creates cache configured in `[cache]` section, returns `None` if cache is disabled"""
+        c = cfg()
+        try:
+            if not c.getboolean('cache', 'enabled'):
+                return None
+        except (NoSectionError, NoOptionError):
+            return None
+        memory_items = c.getint('cache', 'memory-items', fallback=256)
+        disk_size = int(c.getfloat('cache', 'disk-size', fallback=0) * 2**20)
+        directory = c.get('cache', 'directory', fallback='').strip()
+        if not directory:
+            directory = os.path.expanduser('~/.cache/wdwrap/lc')
+        if disk_size <= 0:
+            directory = None
+        return cls(memory_items=memory_items, directory=directory, disk_size=disk_size)
@@ -0,0 +1,263 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""CPU slots of `lc` processes
+
+`lc` is single threaded, running more `lc` processes than physical cores only adds context switches.
+Each running `lc` holds a slot, by default there is one slot per physical core (hyperthread siblings
+share the slot). Slots are host-wide: they are `flock`-ed files shared by all processes (threads, process pool
+and local Dask workers), lock of crashed process is released by OS. Number of slots is independent
+of number of workers. Optionally `lc` is pinned (`sched_setaffinity`) to CPUs of its slot's core.
+
+Configured in `[cpu]` section.
+"""
+import asyncio
+import fcntl
+import glob
+import os
+import tempfile
+import threading
+import time
+from configparser import NoSectionError, NoOptionError
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+
+from .config import cfg
+from .exceptions import JobCancelledError
+
+def _parse_cpu_list(s: str) -> List[int]:
+    """Parses kernel CPU list, e.g. '0-3,8'"""
+    ret = []
+    for part in s.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            ret.extend(range(int(lo), int(hi) + 1))
+        else:
+            ret.append(int(part))
+    return ret
+
+
+def available_cpus() -> List[int]:
+    """Logical CPUs the process may run on"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not Linux
+        return list(range(os.cpu_count() or 1))
+
+
+def physical_cores() -> List[Tuple[int, ...]]:
+    """Available physical cores, each as tuple of its logical CPUs (hyperthread siblings)"""
+    cpus = available_cpus()
+    cores = []
+    seen = set()
+    for cpu in cpus:
+        if cpu in seen:
+            continue
+        siblings = None
+        for name in ['core_cpus_list', 'thread_siblings_list']:
+            try:
+                with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/{name}') as fd:
+                    siblings = _parse_cpu_list(fd.read())
+                break
+            except (OSError, ValueError):
+                continue
+        if not siblings:
+            siblings = [cpu]
+        core = tuple(c for c in siblings if c in cpus) or (cpu,)
+        seen.update(core)
+        cores.append(core)
+    return cores
+
+
+# slots held by this process, fds are closed in forked children (which would keep the locks otherwise)
+_held = set()
+
+
+def _close_inherited():
+    for slot in list(_held):
+        try:
+            os.close(slot.fd)
+        except OSError:
+            pass
+    _held.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_close_inherited)
+
+
+class CpuSlot(object):
+    """Acquired slot, `release` it when `lc` is finished"""
+
+    def __init__(self, index: int, cpus: Tuple[int, ...], fd: int, pin: bool):
+        super(CpuSlot, self).__init__()
+        self.index = index
+        self.cpus = cpus
+        self.fd = fd
+        self.pin = pin
+
+    def preexec_fn(self) -> Optional[Callable[[], None]]:
+        """`preexec_fn` of `subprocess.Popen` pinning the child to slot's CPUs before `lc` is executed
+
+        `None` if pinning is disabled or not supported (not Linux)."""
+        if not self.pin or not hasattr(os, 'sched_setaffinity'):
+            return None
+        cpus = self.cpus
+
+        def pin():
+            try:
+                os.sched_setaffinity(0, cpus)
+            except OSError:  # e.g. CPU not allowed in container, `lc` runs unpinned
+                pass
+        return pin
+
+    def release(self):
+        if self.fd is None:
+            return
+        _held.discard(self)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+
+class CpuSlots(object):
+    """Host-wide CPU slots
+
+    Parameters
+    ----------
+    slots : int or None
+        Number of slots, `None` for number of physical cores
+    pin : bool
+        Pin `lc` processes to CPUs of slot's core
+    directory : str or None
+        Directory of slot lock files, `None` for system temp dir
+    """
+
+    _defaultInstance = None
+    _defaultConfigured = False
+    _defaultLock = threading.Lock()
+
+    poll_interval = 0.05  # [s] waiting for free slot
+
+    def __init__(self, slots: Optional[int] = None, pin: bool = False, directory: Optional[str] = None):
+        super(CpuSlots, self).__init__()
+        cores = physical_cores()
+        if slots is None:
+            slots = len(cores)
+        self.slots = max(slots, 1)
+        self.pin = pin
+        self.cores = [cores[n % len(cores)] for n in range(self.slots)]  # more slots than cores oversubscribes
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), f'wdwrap_slots-{os.getuid()}')
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> Optional[CpuSlot]:
+        """Acquires free slot, returns `None` if all slots are taken"""
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % self.slots  # spread load when slots are not contended
+        for k in range(self.slots):
+            n = (start + k) % self.slots
+            fd = os.open(os.path.join(self.directory, f'slot-{n}.lock'),
+                         os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            slot = CpuSlot(n, self.cores[n], fd, self.pin)
+            _held.add(slot)
+            return slot
+        return None
+
+    def acquire(self, cancel_token=None, timeout: Optional[float] = None) -> CpuSlot:
+        """Waits for free slot
+
+        Raises `JobCancelledError` if `cancel_token` is set meantime, `TimeoutError` after `timeout` [s]."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            slot = self.try_acquire()
+            if slot is not None:
+                return slot
+            if cancel_token is not None and cancel_token.is_set():
+                raise JobCancelledError()
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError
+            time.sleep(self.poll_interval)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> CpuSlot:
+        """Coroutine version of `acquire`"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            slot = self.try_acquire()
+            if slot is not None:
+                return slot
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError
+            await asyncio.sleep(self.poll_interval)
+
+    @contextmanager
+    def slot(self, cancel_token=None, timeout: Optional[float] = None):
+        s = self.acquire(cancel_token, timeout)
+        try:
+            yield s
+        finally:
+            s.release()
+
+    def busy_count(self) -> int:
+        """Number of slots taken by all processes of the host"""
+        ret = 0
+        for path in glob.glob(os.path.join(self.directory, 'slot-*.lock')):
+            try:
+                n = int(os.path.basename(path)[5:-5])
+            except ValueError:
+                continue
+            if n >= self.slots:
+                continue
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            except OSError:
+                ret += 1
+            finally:
+                os.close(fd)
+        return ret
+
+    @classmethod
+    def default_instance(cls) -> Optional['CpuSlots']:
+        """Configured slots singleton, `None` if slots are disabled"""
+        if not cls._defaultConfigured:
+            with cls._defaultLock:
+                if not cls._defaultConfigured:
+                    cls._defaultInstance = cls.from_config()
+                    cls._defaultConfigured = True
+        return cls._defaultInstance
+
+    @classmethod
+    def set_default_instance(cls, slots: Optional['CpuSlots']):
+        cls._defaultInstance = slots
+        cls._defaultConfigured = True
+
+    @classmethod
+    def from_config(cls) -> Optional['CpuSlots']:
+        """Creates slots configured in `[cpu]` section, returns `None` if slots are disabled"""
+        c = cfg()
+        try:
+            slots = c.getint('cpu', 'slots')
+        except (NoSectionError, NoOptionError):
+            return None
+        except ValueError:  # auto
+            slots = None
+        if slots is not None and slots <= 0:
+            return None
+        directory = c.get('cpu', 'directory', fallback='').strip() or None
+        return cls(slots=slots, pin=c.getboolean('cpu', 'pin', fallback=False), directory=directory)
@@ -4,21 +4,24 @@ import math
 import random
 import threading
 from collections import OrderedDict
+from configparser import NoSectionError, NoOptionError
 from concurrent.futures import CancelledError
 from typing import Optional, List
 
 import numpy as np
 import pandas as pd
-from dask.distributed import Future
 from scipy.interpolate import CubicSpline
 from traitlets import HasTraits, Bool, Int, Float, Instance, Unicode
 
 from wdwrap.bundle import Bundle
 from wdwrap.config import cfg
 from wdwrap.drivers import MPAGE
-from wdwrap.jobs import JobScheduler
+from wdwrap.backends import JobFuture
+from wdwrap.jobs import JobScheduler, Priority
 from wdwrap.param import ParFlag
 from wdwrap.parameters import ParameterSet
+from wdwrap.regeneration import RegenerationScheduler
+from wdwrap.segmentation import CostModels, SegmentResults, eclipse_windows, model_digest, refinement_ranges
 
 """
 Module contains three families of classes:
@@ -397,16 +400,31 @@ class GeneratedValues(CurveValues):
         pass
 
     def refresh(self, wait=False):
-        """Generate if needed"""
-        if self.status == self.STATUS.Invalid:
-            self.generate(wait=wait, timeout=self.gen_timeout)
+        """Generate if needed
+
+        Without `wait` the generation is requested from `RegenerationScheduler`, so it's coalesced
+        with following changes of the model."""
+        if self.status != self.STATUS.Invalid:
+            return
+        if wait:
+            self.generate(wait=True, timeout=self.gen_timeout)
+        else:
+            RegenerationScheduler.default_instance().request(self, lambda: self.generate(timeout=self.gen_timeout))
 
     def invalidate(self):
-        if self.status == self.STATUS.Calculating:  # cancel and re-generate
-            self.generate(timeout=self.gen_timeout)
+        regeneration = RegenerationScheduler.default_instance()
+        if regeneration.pending(self):  # outdated calculation already abandoned
+            regeneration.request(self, lambda: self.generate(timeout=self.gen_timeout))
+        elif self.status == self.STATUS.Calculating:
+            self.abandon()  # outdated model never reaches the curve, only its re-generation is delayed
+            regeneration.request(self, lambda: self.generate(timeout=self.gen_timeout))
         else:
             self.status = self.STATUS.Invalid
 
+    def abandon(self):
+        """Stops calculation of outdated model, the curve stays calculating till it's generated again"""
+        pass
+
     def cancel(self):
         pass
 
@@ -419,7 +437,24 @@ class GeneratedValues(CurveValues):
 
 
 class WdGeneratedValues(GeneratedValues):
+    """Curve generated by `lc`, computed in segments of phase range
+
+    With `auto_segments` (`[curves] auto-segments`) number of segments and their boundaries are planned
+    on each generation by runtime cost model (`wdwrap.segmentation`), so segments end at about the same time
+    on available workers. Editing segments manually switches `auto_segments` off.
+
+    With `progressive` (`[curves] progressive-results`) each finished segment is merged into the curve
+    immediately: `df` is updated while `status` is still Calculating, `partial` is set and `segments_status`
+    tells which segment jobs are ready. Between computed ranges (`partial_ranges`) values are NaN.
+
+    With `fast_preview` (`[curves] preview`) generation runs in two stages: reduced fidelity preview
+    (coarse surface grid, simple reflection, sparse phases, see `preview_bundle`) is shown first (`is_preview`),
+    then it is replaced by full fidelity points. Both stages are cancelled by the next generation.
+    """
     segment_dividers_version = Int()
+    partial = Bool(default_value=False)
+    is_preview = Bool(default_value=False)
+    max_segments = 20
 
     def __init__(self, *args, bundle: Bundle, rv: bool, **kwargs):
         super().__init__(*args, **kwargs)
@@ -430,10 +465,29 @@ class WdGeneratedValues(GeneratedValues):
         self.parameters.update_filtered(self.bundle, ParameterSet.filter_curve)
 
         n = cfg().getint('curves', 'default-segments')
-        assert 0 < n <= 20
+        assert 0 < n <= self.max_segments
         self.segment_dividers = [float(v) for v in np.linspace(0, 1, n + 1)]
         self.segment_data = [{'PHIN': bundle['PHIN'].val} for _ in range(n)]  # n identical (but not the same) dicts
-        self.futures: List[Future] = []
+        self.auto_segments = cfg().getboolean('curves', 'auto-segments', fallback=True)
+        self.futures: List[JobFuture] = []
+        self.futures_ranges: List[list] = []  # phase ranges (start, stop, step) computed by each of futures
+        self.segments_status: List[int] = []  # STATUS of each of futures: Calculating, Ready or Invalid (failed)
+        self.partial_ranges: List[tuple] = []  # (start, stop) phases covered by partial `df`
+        self.progressive = cfg().getboolean('curves', 'progressive-results', fallback=True)
+        self._abandoned = {}  # not collected futures of cancelled generations: model key of their results
+        self._cost_model = None  # runtime model of the last generation
+        self.adaptive_sampling = cfg().getboolean('curves', 'adaptive-sampling', fallback=False)
+        self.fast_preview = cfg().getboolean('curves', 'preview', fallback=False)
+        self._preview_df = None  # points of preview stage, shown until replaced by full fidelity ones
+        self._full_stage = None  # (bundle, ranges) of full fidelity stage, scheduled when preview is done
+        self._generation = 0  # incremented by cancel, callbacks of cancelled generation do not schedule
+        self._generation_lock = threading.RLock()
+        self._pass_bundle = None
+        self._pass_timeout = None
+        self._pass_results = []  # segments dataframes of the generation (all passes of adaptive sampling)
+        self._pass_number = 0
+        self.segment_results = SegmentResults(column=self.indep_column)  # computed points, reused by generations
+        self._model_key = None
         self.__handler_bundle_value_change = lambda change: self.on_bundle_value_change(change)
         self.__handler_invalidate = lambda change: self.invalidate()
         self.bundle.observe(self.__handler_bundle_value_change, names=['val'],
@@ -448,6 +502,8 @@ class WdGeneratedValues(GeneratedValues):
         d['segments'] = {
             'boundaries': self.segment_dividers,
             'data': self.segment_data,
+            'auto': self.auto_segments,
+            'adaptive': self.adaptive_sampling,
         }
         # do we  save generated values ?
         d['dataframe'] = self.df_to_dict()
@@ -458,40 +514,107 @@ class WdGeneratedValues(GeneratedValues):
         self.parameters.from_dict(d['wd_parameters'])
         self.segment_dividers = d['segments']['boundaries']
         self.segment_data = d['segments']['data']
+        self.auto_segments = d['segments'].get('auto', False)
+        self.adaptive_sampling = d['segments'].get('adaptive', self.adaptive_sampling)
 
 
     def terminal_clean_up(self):
         self.bundle.unobserve(self.__handler_bundle_value_change, names=['val'])
         self.parameters.unobserve(self.__handler_bundle_value_change, names=['val'])
         self.unobserve_all()
+        RegenerationScheduler.default_instance().cancel(self)
+        self.segment_results.clear()
         self.parameters = None
         self.bundle = None
         super().terminal_clean_up()
 
 
-    def generate(self, wait=False, timeout=None):
-        self.cancel()
+    def model_bundle(self) -> Bundle:
+        """Bundle of the curve model: common parameters with curve specific ones, output type of the curve"""
         bundle = self.bundle.clone()
         bundle.update_parameters(self.parameters)
         bundle['MPAGE'] = MPAGE.VELOC if self.is_rv else MPAGE.LIGHT
-        running = False
-        for s in range(self.segments_count()):
-            b = bundle.clone()
-            lo, hi = self.segment_range(s)
-            b['PHSTRT'] = lo
-            b['PHSTOP'] = hi
-            b['PHIN'] = self.segment_data[s]['PHIN']
-            self.calculation_semaphore.acquire(blocking=False)
-            f = JobScheduler.instance().schedule('lc', b, timeout=timeout)
-            f.add_done_callback(lambda fut: self.on_segment_calculated(fut))
-            running = True
-            logger().info(f'Future scheduled: {f}')
-            self.futures.append(f)
-        if running:
-            self.status = self.STATUS.Calculating
+        return bundle
+
+    def generate(self, wait=False, timeout=None):
+        RegenerationScheduler.default_instance().cancel(self)  # superseded by this generation
+        self.abandon()  # calculation lock is kept held, `wait` returns when this generation is done
+        generation = self._generation
+        bundle = self.model_bundle()
+        self._pass_timeout = timeout
+        self._preview_df = None
+        self._full_stage = None
+        if self.adaptive_sampling:
+            ranges = self.initial_sampling_ranges(bundle)
+        else:
+            if self.auto_segments:
+                self.plan_segments(bundle)
+            ranges = [(*self.segment_range(s), self.segment_data[s]['PHIN']) for s in range(self.segments_count())]
+        if self.fast_preview:
+            self._full_stage = (bundle, ranges)
+            bundle = self.preview_bundle(bundle)
+            step = bundle['PHIN'].val
+            ranges = [(*self.segment_range(s), step) for s in range(self.segments_count())]
+        self._start_stage(bundle, ranges, generation)
         if wait:
             self.wait()
 
+    def _start_stage(self, bundle: Bundle, ranges, generation: int):
+        """Starts computation of the model `bundle` in phase `ranges` (preview or full fidelity stage)"""
+        model_key = model_digest(bundle)
+        cost_model = CostModels.default_instance().get(bundle)
+        with self._generation_lock:  # state of outdated stage never replaces the one of the next generation
+            if generation != self._generation:  # cancelled meantime
+                return
+            self._pass_bundle = bundle
+            self._pass_results = []
+            self._pass_number = 0
+            self._model_key = model_key
+            self._cost_model = cost_model
+        self._schedule_ranges(ranges, generation)
+
+    def _schedule_ranges(self, ranges, generation: int):
+        """Schedules `lc` jobs of phase `ranges` (start, stop, step) of `generation`
+
+        Points already computed for the model are taken from `segment_results`, only missing ones are computed."""
+        futures = []
+        jobs_ranges = []
+        with self._generation_lock:
+            if generation != self._generation:  # cancelled meantime
+                return
+            reused, ranges = self.segment_results.split(self._model_key, ranges)
+            self._pass_results.extend(reused)
+            segments = []
+            for lo, hi, step in ranges:
+                b = self._pass_bundle.clone()
+                b['PHSTRT'] = lo
+                b['PHSTOP'] = hi
+                b['PHIN'] = step
+                segments.append(b)
+            per_job = self.segments_per_job() or max(len(segments), 1)
+            for n in range(0, len(segments), per_job):
+                self.calculation_semaphore.acquire(blocking=False)
+                if per_job == 1:
+                    f = JobScheduler.instance().schedule('lc', segments[n], timeout=self._pass_timeout,
+                                                         priority=Priority.Interactive)
+                else:  # many segments in single lc process
+                    f = JobScheduler.instance().schedule('lc-batch', segments[n:n + per_job],
+                                                         timeout=self._pass_timeout, priority=Priority.Interactive)
+                logger().info(f'Future scheduled: {f}')
+                futures.append(f)
+                jobs_ranges.append(list(ranges[n:n + per_job]))
+            # callbacks after all futures are known, futures of inline backends are already done
+            self.futures = futures
+            self.futures_ranges = jobs_ranges
+            self.segments_status = [self.STATUS.Calculating] * len(futures)
+        if not ranges:  # all points reused
+            self._pass_done(generation)
+            return
+        if futures:
+            self.status = self.STATUS.Calculating
+        for f in futures:
+            f.add_done_callback(lambda fut: self.on_segment_calculated(fut))
+
     def wait(self, timeout=None) -> bool:
         if timeout is None:
             timeout = -1
@@ -502,55 +625,235 @@ class WdGeneratedValues(GeneratedValues):
             return False
 
     def on_segment_calculated(self, fut):
+        """Collects finished segment job, the curve is updated when `progressive` or all jobs are done"""
         logger().info(f'Future done: {fut}')
-        if fut not in self.futures:  # ignore old futures
-            return
-        for f in self.futures:  # ignore if there are some futures still running
-            if not f.done():
+        with self._generation_lock:
+            if fut in self._abandoned:  # of cancelled generation, results are still good for its model
+                self.segment_results.add(self._abandoned.pop(fut), self._segment_frames(fut))
                 return
-        futures = self.futures
-        self.futures = []
-        logger().info(f'Futures all done, collecting')
-        results = []
-        for f in futures:
             try:
-                result = f.result()
-                df = result.get('veloc' if self.is_rv else 'light', None)
-                if df is not None:
-                    results.append(df)
-            except CancelledError:
-                pass
-
-        # results = [f.result().get('veloc' if self.is_rv else 'light', None) for f in self.futures]
-        # results = [r for r in results if r is not None]
+                n = self.futures.index(fut)
+            except ValueError:  # ignore old futures
+                return
+            if self.segments_status[n] != self.STATUS.Calculating:  # already collected
+                return
+            generation = self._generation
+            self._observe_runtimes([fut], [self.futures_ranges[n]])
+            computed = self._segment_frames(fut)
+            self.segment_results.add(self._model_key, computed)
+            self._pass_results.extend(computed)
+            pending = self.segments_status.count(self.STATUS.Calculating) > 1
+            if pending and self.progressive and computed:  # before status, readers see its points with it
+                self._set_partial_df(self._combine(self._pass_results))
+            self.segments_status[n] = self.STATUS.Ready if computed else self.STATUS.Invalid
+            if pending:
+                return
+            logger().info(f'Futures all done, collecting')
+            self.futures = []
+        self._pass_done(generation)
+
+    def _segment_frames(self, fut) -> list:
+        """Dataframes of curve points from finished segment job, empty if the job failed or was cancelled"""
+        try:
+            result = fut.result()
+        except CancelledError:
+            return []
+        except Exception as e:  # e.g. `ValidationError` of rejected bundle
+            logger().error(f'Curve segment calculation failed: {e}')
+            return []
+        if isinstance(result, dict):
+            result = [result]  # single segment job
+        frames = [r.get('veloc' if self.is_rv else 'light', None) for r in result]
+        return [df for df in frames if df is not None]
+
+    def _pass_done(self, generation: int):
+        """All points of the pass are available: next pass of adaptive sampling or the curve is ready"""
+        df = self._combine(self._pass_results)
+        if self._full_stage is not None:  # preview is ready, full fidelity stage follows
+            with self._generation_lock:
+                if generation != self._generation:  # cancelled meantime
+                    return
+                self._set_partial_df(df)  # complete preview is published before the stage switch
+                bundle, ranges = self._full_stage
+                self._full_stage = None
+                self._preview_df = df
+                self._pass_results = []
+            logger().info(f'Preview ready, full fidelity stage')
+            self._start_stage(bundle, ranges, generation)
+            return
+        if self.adaptive_sampling and self._pass_number < self.adaptive_settings()['passes']:
+            ranges = self.refinement_ranges(df)
+            if ranges:
+                with self._generation_lock:
+                    if generation != self._generation:  # cancelled meantime
+                        return
+                    self._pass_number += 1
+                    logger().info(f'Adaptive sampling pass {self._pass_number}: {len(ranges)} ranges')
+                self._schedule_ranges(ranges, generation)
+                return
+        with self._generation_lock:
+            if generation != self._generation:  # cancelled meantime
+                return
+            self.set_df(df)
+        self._release_semaphore()
+
+    def _combine(self, results) -> pd.DataFrame:
+        """Single dataframe of results of segments, sorted by phase, without repeated points"""
         try:
             df = pd.concat(results)
         except ValueError:  # nothing to concatenate
-            df = self._empty_dataframe()
+            return self._empty_dataframe()
         df = df[~df.duplicated([self.indep_column])]
-        df.sort_values(self.indep_column)
-        df.reindex()
-        self.set_df(df)
-        self._release_semaphore()
+        return df.sort_values(self.indep_column).reset_index(drop=True)
+
+    def _observe_runtimes(self, futures, ranges):
+        """Feeds cost model with `lc` runtimes of finished segment jobs"""
+        for f, r in zip(futures, ranges):
+            timing = getattr(f, 'timing', None)  # no timing for cached results
+            if timing is not None and 'exec' in timing.stages and not f.cancelled() and f.exception() is None:
+                self._cost_model.observe(r, timing.stages['exec'])
+
+    def plan_segments(self, bundle: Optional[Bundle] = None, step: Optional[float] = None):
+        """Sets segments of equal predicted runtime for workers of the scheduler (`auto_segments` mode)
+
+        Points grid `step` defaults to PHIN of the bundle."""
+        if bundle is None:
+            bundle = self.model_bundle()
+        phin = bundle['PHIN'].val if step is None else step
+        per_job = self.segments_per_job()
+        workers = JobScheduler.instance().backend.workers * per_job if per_job else 1
+        dividers = CostModels.default_instance().get(bundle).plan(workers, phin, max_segments=self.max_segments)
+        self.segment_dividers = dividers
+        self.segment_data = [{'PHIN': phin} for _ in range(len(dividers) - 1)]
+
+    @staticmethod
+    def adaptive_settings() -> dict:
+        """`[curves]` settings of adaptive sampling"""
+        c = cfg()
+        return {
+            'initial-step': c.getfloat('curves', 'adaptive-initial-step', fallback=0.02),
+            'min-step': c.getfloat('curves', 'adaptive-min-step', fallback=0.001),
+            'tolerance': c.getfloat('curves', 'adaptive-tolerance', fallback=0.0002),
+            'passes': c.getint('curves', 'adaptive-passes', fallback=4),
+        }
+
+    @staticmethod
+    def preview_settings() -> dict:
+        """`[curves]` settings of preview stage"""
+        c = cfg()
+        return {
+            'grid': c.getint('curves', 'preview-grid', fallback=10),
+            'step': c.getfloat('curves', 'preview-step', fallback=0.02),
+        }
+
+    def preview_bundle(self, bundle: Bundle) -> Bundle:
+        """Reduced fidelity model of `bundle`: coarse surface grids, simple reflection, sparse phases"""
+        settings = self.preview_settings()
+        preview = bundle.clone()
+        for grid in ['N1', 'N2']:
+            preview[grid] = min(preview[grid].val, settings['grid'])
+        preview['MREF'] = 1
+        preview['NREF'] = 1
+        preview['PHIN'] = max(preview['PHIN'].val, settings['step'])
+        return preview
+
+    def initial_sampling_ranges(self, bundle: Bundle) -> list:
+        """First pass of adaptive sampling: segments with coarse step, eclipse windows with finer step"""
+        settings = self.adaptive_settings()
+        step = settings['initial-step']
+        if self.auto_segments:
+            self.plan_segments(bundle, step)
+        ranges = [(*self.segment_range(s), step) for s in range(self.segments_count())]
+        fine = max(step / 4.0, settings['min-step'])
+        for lo, hi in eclipse_windows(bundle):
+            ranges.append((round(lo, 12), round(hi, 12), fine))
+        return ranges
+
+    def refinement_ranges(self, df: pd.DataFrame) -> list:
+        """Ranges where interpolation of points computed so far is not accurate enough"""
+        settings = self.adaptive_settings()
+        columns = [df[c].values for c in sorted(self.dep_columns & set(df.columns))]
+        if not columns:
+            return []
+        return refinement_ranges(df[self.indep_column].values, columns, settings['tolerance'], settings['min-step'])
 
     def set_df(self, df):
+        self.partial = False
+        self.is_preview = False
+        self.partial_ranges = []
+        self._preview_df = None
         super().set_df(df)
         self.status = self.STATUS.Ready
 
+    def _set_partial_df(self, df):
+        """Curve of points computed so far, calculation goes on
+
+        Preview points are kept where full fidelity ones are not computed yet."""
+        col = self.indep_column
+        ranges = [(d[col].min(), d[col].max()) for d in self._pass_results if len(d) > 0]
+        preview = self._preview_df
+        if preview is not None and len(preview) > 0:
+            preview = preview[~self._covered(preview[col].values, ranges)]
+            df = self._combine([df, preview])
+            ranges.append((self._preview_df[col].min(), self._preview_df[col].max()))
+        self.partial_ranges = sorted(ranges)
+        self.is_preview = preview is not None or self._full_stage is not None
+        self.partial = True
+        super().set_df(df)
+
+    @staticmethod
+    def _covered(x, ranges) -> np.ndarray:
+        """Mask of phases `x` within any of (start, stop) `ranges`"""
+        covered = np.zeros(len(x), dtype=bool)
+        for lo, hi in ranges:
+            covered |= (x >= lo - 1e-9) & (x <= hi + 1e-9)
+        return covered
+
+    def get_values_at(self, indep_var_values=None):
+        """Curve values at specified points, NaN outside `partial_ranges` for partial curve"""
+        df = super().get_values_at(indep_var_values)
+        if indep_var_values is None or not self.partial:
+            return df
+        x = np.mod(np.asarray(indep_var_values, dtype=float), 1.0)
+        covered = self._covered(x, self.partial_ranges) | self._covered(x + 1.0, self.partial_ranges)  # 0 is 1
+        for col in self.dep_columns & set(df.columns):
+            df.loc[~covered, col] = np.nan
+        return df
+
     def _release_semaphore(self):
         try:
             self.calculation_semaphore.release()
         except RuntimeError:
             pass
 
-    def cancel(self):
-        for f in self.futures:
+    def abandon(self):
+        with self._generation_lock:
+            self._generation += 1
+            futures = self.futures
+            self.futures = []  # before cancel, done callbacks of cancelled futures are ignored
+            for f, status in zip(futures, self.segments_status):
+                if status == self.STATUS.Calculating:  # not collected yet, its callback keeps result if any
+                    self._abandoned[f] = self._model_key
+        for f in futures:
             if not f.done():
-                self.status = self.STATUS.Canceling
                 f.cancel()
-        self.futures = []
+
+    def cancel(self):
+        RegenerationScheduler.default_instance().cancel(self)  # pending regeneration is superseded
+        if any(not f.done() for f in self.futures):
+            self.status = self.STATUS.Canceling
+        self.abandon()
         self._release_semaphore()
 
+    @staticmethod
+    def segments_per_job() -> int:
+        """Number of segments calculated in single `lc` process, 0 means all"""
+        try:
+            n = cfg().getint('curves', 'segments-per-job')
+        except (NoSectionError, NoOptionError, ValueError):
+            n = 1
+        return max(n, 0)
+
     def segments_count(self) -> int:
         return len(self.segment_data)
 
@@ -574,15 +877,20 @@ class WdGeneratedValues(GeneratedValues):
         if divider is None:
             if math.isclose(lo, hi):
                 divider = lo
-            else:
-                divider = lo + (hi - lo) / 2.
+            else:  # in the middle, on points grid of the segment so computed points are reused
+                phin = self.segment_data[segment].get('PHIN') or 0.0
+                steps = round((hi - lo) / 2. / phin) if phin > 0.0 else 0
+                divider = lo + steps * phin if 0 < steps * phin < hi - lo else lo + (hi - lo) / 2.
+                divider = round(divider, 12)
         data = copy.copy(self.segment_data[segment])
+        self.auto_segments = False
         self.segment_dividers.insert(segment + 1, divider)
         self.segment_data.insert(segment + 1, data)
         self.segment_dividers_version += 1
         return divider
 
     def segment_delete(self, segment: int, update_version=True):
+        self.auto_segments = False
         del self.segment_data[segment]
         del self.segment_dividers[max(segment, 1)]  # delete left boundary if not first
         self.segment_dividers_version += 1
@@ -628,6 +936,7 @@ class WdGeneratedValues(GeneratedValues):
                 else:
                     break
         if modified:
+            self.auto_segments = False
             self.segment_dividers_version += 1
 
     def segment_get_data(self, segment: int, key: str):
@@ -640,6 +949,7 @@ class WdGeneratedValues(GeneratedValues):
 
     def segment_set_data(self, segment: int, data: dict):
         if data != self.segment_data[segment]:
+            self.auto_segments = False
             self.segment_data[segment] = data
             self.segment_dividers_version += 1
 
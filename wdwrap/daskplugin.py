@@ -0,0 +1,41 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Dask worker plugins, imported only when Dask backend is used"""
+from distributed import WorkerPlugin
+
+
+class SlimWorkerPlugin(WorkerPlugin):
+    """Creates slim `lc` runner (`wdwrap.worker`) once, when worker starts"""
+
+    name = 'wdwrap-slim-worker'
+    idempotent = True
+
+    def setup(self, worker):
+        from wdwrap import worker as slim
+        slim.runner()
+
+
+class StagingPlugin(WorkerPlugin):
+    """Stages or verifies WD data files and `lc` executable on each worker once (see `wdwrap.staging`)
+
+    For workers without filesystem shared with client, e.g. of external Dask scheduler.
+
+    Parameters
+    ----------
+    files : StagedFiles
+        Files to be present on workers (created on client)
+    directory : str or None
+        Staging directory on workers, default `~/.cache/wdwrap/staged`
+    use_local : bool
+        Use worker's own files if identical
+    """
+
+    name = 'wdwrap-staging'
+    idempotent = False  # re-registered plugin (e.g. new lc executable) is staged again
+
+    def __init__(self, files, directory=None, use_local=True):
+        self.files = files
+        self.directory = directory
+        self.use_local = use_local
+
+    def setup(self, worker):
+        self.files.stage(self.directory, use_local=self.use_local)
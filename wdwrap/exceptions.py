@@ -1,4 +1,6 @@
 #  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+from concurrent.futures import CancelledError
+
 
 class FileFormatError(Exception):
     pass
@@ -13,4 +15,17 @@ class FileFormatMultipleSetsError(FileFormatError):
 
 
 class FileFormatVersionError(FileFormatError):
-    pass
\ No newline at end of file
+    pass
+
+
+class JobCancelledError(CancelledError):
+    """Raised by runners when job is cancelled while running"""
+    pass
+
+
+class ValidationError(ValueError):
+    """Raised for bundles rejected by pre-flight validation (`wdwrap.validation`)"""
+
+    def __init__(self, problems):
+        super(ValidationError, self).__init__('Invalid model: ' + '; '.join(problems))
+        self.problems = list(problems)
@@ -282,14 +282,47 @@ class FixedTableReader(DataFrameReader):
             if '#' in l[:2]:
                 pass
             else:
-                row = []
-                for s in l.split():
-                    if s[-4:-3] == 'D':  # Fortran exponent -> python
-                        s = s.replace('D', 'e', 1)
-                    row.append(float(s))
-                table.append(row)
+                table.append(self._parse_row(l))
         return pd.DataFrame(table, columns=self.columns['names'])
 
+    def blocks(self, sizes=None):
+        """Reads table as list of DataFrames, one per block
+
+        Used for output of multi-bundle LC runs. If `sizes` (rows per block) is not provided,
+        table is split at header (comment) lines, each header starts new block.
+        """
+        tables = []
+        table = None
+        for l in self.fd:
+            if '#' in l[:2]:
+                if sizes is None:
+                    table = []
+                    tables.append(table)
+            else:
+                if table is None:
+                    table = []
+                    tables.append(table)
+                table.append(self._parse_row(l))
+        if sizes is not None:
+            rows = tables[0] if tables else []
+            if sum(sizes) != len(rows):
+                raise ValueError(f'Table of {len(rows)} rows cannot be split into blocks of {sizes} rows')
+            tables = []
+            start = 0
+            for n in sizes:
+                tables.append(rows[start:start + n])
+                start += n
+        return [pd.DataFrame(t, columns=self.columns['names']) for t in tables]
+
+    @staticmethod
+    def _parse_row(line):
+        row = []
+        for s in line.split():
+            if s[-4:-3] == 'D':  # Fortran exponent -> python
+                s = s.replace('D', 'e', 1)
+            row.append(float(s))
+        return row
+
 
 class Reader_light(FixedTableReader):
     """Reads light curve generated by LC"""
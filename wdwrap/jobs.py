@@ -1,21 +1,258 @@
 #  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
 from __future__ import annotations
 
+import asyncio
+import collections
+import math
+import os
+import queue
+import threading
+import time
+import weakref
 from configparser import NoSectionError, NoOptionError
-from typing import Callable, Mapping, Optional
+from typing import Any, Callable, Iterable, Iterator, Mapping, Optional, Tuple
 import logging
 
-from dask.distributed import Client, Future
+import numpy as np
 
+from wdwrap import shmem, telemetry
+from wdwrap.backends import Backend, DaskBackend, JobFuture, backend_from_config
+from wdwrap.cache import LcResultCache, copy_result
 from wdwrap.config import cfg
-from wdwrap.runners import LcRunner
+from wdwrap.exceptions import ValidationError
+from wdwrap.runners import LcRunner, LcBatchRunner, LcChi2Runner
+
+class Priority:
+    """Job priority classes, jobs of lower value class are always dispatched first"""
+    Interactive = 0  # GUI refresh etc, may use workers reserved by `[jobs] interactive-reserve`
+    Fit = 1
+    Background = 2
+
+    @classmethod
+    def from_value(cls, value) -> int:
+        """Priority from int or class name (case insensitive)"""
+        if isinstance(value, str):
+            try:
+                return getattr(cls, value.strip().capitalize())
+            except AttributeError:
+                raise ValueError(f'Unknown job priority "{value}"')
+        value = int(value)
+        if value not in (cls.Interactive, cls.Fit, cls.Background):
+            raise ValueError(f'Unknown job priority {value}')
+        return value
+
+
+class RuntimeStats(object):
+    """Recent runtimes [s] of jobs of one kind"""
+
+    def __init__(self, size: int = 200):
+        super(RuntimeStats, self).__init__()
+        self.samples = collections.deque(maxlen=size)
+
+    def add(self, runtime: float):
+        self.samples.append(runtime)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        return float(np.percentile(self.samples, q))
+
+
+class _Attempt(object):
+    """Single run of a job, waits in scheduler queue until a worker slot is free"""
+
+    def __init__(self, job_kind, priority: int, submit: Callable[[], JobFuture], size: Optional[int] = None):
+        super().__init__()
+        self.job_kind = job_kind
+        self.priority = priority
+        self.size = size  # `JobScheduler.job_size`, None if not known
+        self.submit = submit  # submits to backend
+        self.future = JobFuture()
+        self.submitted = time.time()  # wall-clock, for queue time measured on worker
+        self.started = None  # dispatch time, None while queued
+
+    def elapsed(self, now) -> Optional[float]:
+        return None if self.started is None else now - self.started
+
+
+class _Job(object):
+    """Scheduled job, may run in several attempts (speculative execution), the first finished attempt wins"""
+
+    def __init__(self, job_kind, priority: int, launch: Callable[[int], _Attempt], speculative=False):
+        super().__init__()
+        self.job_kind = job_kind
+        self.priority = priority
+        self.launch = launch
+        self.speculative = speculative
+        self.attempts = []
+        self.speculated = False
+        self.future = JobFuture(on_cancel=self.cancel_attempts)
+        self.add_attempt()
+
+    def add_attempt(self):
+        attempt = self.launch(self.priority)
+        self.attempts.append(attempt)
+        attempt.future.add_done_callback(self._attempt_done)
+
+    def _attempt_done(self, f):
+        if f.cancelled():
+            return
+        if f.exception() is not None and any(not a.future.done() for a in self.attempts):
+            return  # other attempt may still succeed
+        try:
+            self.future.timing = f.timing
+            self.future.set_result_if_pending(f.result())
+        except Exception as e:
+            self.future.set_exception_if_pending(e)
+        self.cancel_attempts()
+
+    def cancel_attempts(self):
+        for a in list(self.attempts):
+            if not a.future.done():
+                a.future.cancel()  # kills lc of the loser
+
+
+class _SharedJob(object):
+    """Job shared by all requesters of identical job"""
+
+    def __init__(self, key, priority: int):
+        super().__init__()
+        self.key = key
+        self.priority = priority  # the highest requested priority
+        self.job: Optional[_Job] = None
+        self.subscribers = 0
+        self._pending = []
+
+    def subscribe(self, unsubscribe) -> JobFuture:
+        """New requester's future, following shared job's one
+
+        The first requester gets the result itself (e.g. zero-copy from shared memory), others own copies."""
+        transform = copy_result if self.subscribers > 0 else None
+        self.subscribers += 1
+        ret = JobFuture(on_cancel=lambda: unsubscribe(self))
+        if self.job is None:
+            self._pending.append((ret, transform))
+        else:
+            ret.follow(self.job.future, transform=transform)
+        return ret
+
+    def set_job(self, job: _Job):
+        self.job = job
+        pending, self._pending = self._pending, []
+        for f, transform in pending:
+            f.follow(job.future, transform=transform)
+
+
+class Autoscaler(object):
+    """Scales number of backend workers with scheduler queue depth
+
+    Scales up to `max_workers` when jobs wait in queue, unless observed runtimes show the queue would be
+    drained by current workers sooner than `startup` [s] (time to start new worker).
+    Scales down after `idle_timeout` [s] of workers underuse, to `min_workers` but never below the number
+    of running jobs, so no running `lc` is interrupted.
+    """
+
+    interval = 0.5  # [s]
+
+    def __init__(self, scheduler: 'JobScheduler', min_workers: int = 1, max_workers: Optional[int] = None,
+                 idle_timeout: float = 60.0, startup: float = 1.0):
+        super(Autoscaler, self).__init__()
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.scheduler = scheduler
+        self.min_workers = max(min_workers, 1)
+        self.max_workers = max(max_workers, self.min_workers)
+        self.idle_timeout = idle_timeout
+        self.startup = startup
+        self._underused_since = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def notify(self):
+        """Wakes autoscaler up, called by scheduler when job is queued"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='wdwrap-autoscaler', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def target(self, now: float) -> Optional[int]:
+        """Desired number of workers, `None` to keep current"""
+        s = self.scheduler
+        workers = s.backend.workers
+        running, queued = s.running_count(), s.queued_count()
+        if queued > 0:
+            self._underused_since = None
+            if workers >= self.max_workers:
+                return None
+            work = s.queued_work()
+            if work is not None and work / workers < self.startup:
+                return None  # drained before new worker starts
+            return min(self.max_workers, running + queued)
+        if running >= workers:
+            self._underused_since = None
+            return None
+        if self._underused_since is None:
+            self._underused_since = now
+            return None
+        if now - self._underused_since < self.idle_timeout:
+            return None
+        self._underused_since = now
+        return max(self.min_workers, running)
+
+    def _run(self):
+        s = self.scheduler
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            target = self.target(time.monotonic())
+            if target is not None and target != s.backend.workers:
+                logging.getLogger('jobs').info(f'Scaling workers {s.backend.workers} -> {target} '
+                                               f'(running: {s.running_count()}, queued: {s.queued_count()})')
+                s.backend.scale(target)
+                s._dispatch()
+            with self._lock:
+                if s.running_count() + s.queued_count() == 0 and s.backend.workers <= self.min_workers:
+                    self._thread = None
+                    return
+
+    @classmethod
+    def from_config(cls, scheduler: 'JobScheduler') -> Optional['Autoscaler']:
+        """Autoscaler configured in `[jobs]` section, `None` if autoscaling is disabled"""
+        c = cfg()
+        if not c.getboolean('jobs', 'autoscale', fallback=False):
+            return None
+        try:
+            max_workers = c.getint('jobs', 'max-workers')
+        except (NoSectionError, NoOptionError, ValueError):
+            max_workers = None
+        return cls(scheduler,
+                   min_workers=c.getint('jobs', 'min-workers', fallback=1),
+                   max_workers=max_workers,
+                   idle_timeout=c.getfloat('jobs', 'idle-timeout', fallback=60.0),
+                   startup=c.getfloat('jobs', 'worker-startup', fallback=1.0))
+
 
 class JobScheduler(object):
+    """Schedules jobs on backend
+
+    Jobs wait in scheduler queues, one per `Priority` class, and are dispatched to backend when a worker is free.
+    Queues are served in strict priority order, running jobs are never preempted.
+    `[jobs] interactive-reserve` share of workers is kept for `Priority.Interactive` jobs only,
+    so GUI refresh does not wait for long fit or background batches.
+    Number of workers of scalable backends is adjusted by `Autoscaler` (`[jobs] autoscale`).
+    """
     _instance: Optional[JobScheduler] = None
 
     def __init__(self,
                  executors: Optional[Mapping[str, Callable]] = None,
-                 client: Optional[Client] = None,) -> None:
+                 client=None,
+                 cache: Optional[LcResultCache] = None,
+                 backend: Optional[Backend] = None,) -> None:
         if self._instance is not None:
             raise RuntimeError(
                 'Do instance JobScheduler directly, use JobScheduler.instance to obtain singleton instance')
@@ -23,26 +260,566 @@ class JobScheduler(object):
         if executors is None:
             executors = {}
         self.executors = executors
-        if client is None:
-            try:
-                n = cfg().getint('jobs', 'workers')
-            except (NoSectionError, NoOptionError, ValueError):
-                n = None
-            logging.info(f'Setting up multiprocess dash client with {n} workers')
-            client = Client(n_workers=n)
-        self.client = client
-
-    def schedule(self, job_kind, *args, **kwargs) -> Future:
+        self.cache = cache
+        if backend is None:
+            if client is not None:  # dask client provided
+                backend = DaskBackend(client=client)
+            else:
+                backend = backend_from_config()
+        self.backend = backend
+        c = cfg()
+        self.validate = c.getboolean('jobs', 'validate', fallback=True)
+        self.deduplicate = c.getboolean('jobs', 'deduplicate', fallback=True)
+        self.slim_workers = c.getboolean('jobs', 'slim-workers', fallback=True)
+        try:
+            self.shared_memory = c.getboolean('jobs', 'shared-memory')
+        except (NoSectionError, NoOptionError, ValueError):  # auto
+            self.shared_memory = backend.shared_memory
+        self.shm_dir = c.get('jobs', 'shared-memory-dir', fallback='').strip() or None
+        if self.slim_workers and self.shared_memory:
+            shmem.sweep(self.shm_dir)  # left by crashed sessions
+        self.deduplicated = 0  # counter of requests attached to already running jobs
+        self._inflight = {}  # key: _SharedJob
+        self._inflight_lock = threading.RLock()
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        # priority queues
+        self.interactive_reserve = c.getfloat('jobs', 'interactive-reserve', fallback=0.25)
+        self._queues = {p: collections.deque() for p in (Priority.Interactive, Priority.Fit, Priority.Background)}
+        self._running = 0  # dispatched attempts
+        self._slots_lock = threading.RLock()
+        # straggler mitigation
+        try:
+            self.speculative = c.getboolean('jobs', 'speculative')
+        except (NoSectionError, NoOptionError, ValueError):  # auto
+            self.speculative = backend.speculative
+        self.speculative_percentile = c.getfloat('jobs', 'speculative-percentile', fallback=95.0)
+        self.speculative_min_samples = c.getint('jobs', 'speculative-min-samples', fallback=20)
+        self.speculated = 0  # counter of launched duplicates
+        self.runtimes = collections.defaultdict(RuntimeStats)  # job_kind: RuntimeStats
+        self.unit_runtimes = collections.defaultdict(RuntimeStats)  # job_kind: RuntimeStats per `job_size` unit
+        self._speculative_jobs = []
+        self._watchdog = None
+        self.autoscaler = Autoscaler.from_config(self) if backend.scalable else None
+        self.telemetry = telemetry.Telemetry.from_config()
+
+    @property
+    def client(self):
+        """Dask client of Dask backends, `None` for other backends"""
+        return getattr(self.backend, 'client', None)
+
+    def schedule(self, job_kind, *args, priority=None, **kwargs) -> JobFuture:
+        """Schedules job, returns future of job result
+
+        Parameters
+        ----------
+        job_kind : str
+            Executor name, e.g. 'lc'
+        priority : int or str or None
+            `Priority` class of the job, default `Priority.Interactive`
+        args, kwargs
+            Passed to executor
+
+        Jobs are validated first (if `validate` is set and executor provides `problems`), invalid job
+        is returned as already failed future with `ValidationError` and never reaches a worker.
+        Results of cacheable jobs (executor provides `job_key`) are looked up in `cache` first,
+        cache hit is returned as already finished future.
+        Request for the job identical to pending or running one (same `job_key`) is attached to that job,
+        the job is cancelled when all requesters cancel their futures. Queued job is promoted
+        to the highest priority of its requesters.
+        Cancelling returned future of `cancellable` executor's job terminates the job also when it's running.
+        Job of `cancellable` executor running longer than `speculative_percentile` of recent runtimes
+        of its `job_kind` (scaled by job size, see `straggler_threshold`) is run again on idle worker,
+        the first finished run wins and the other is killed.
+        """
+        priority = Priority.Interactive if priority is None else Priority.from_value(priority)
         ex = self.get_job_executor(job_kind)
-        return self.client.submit(ex, *args, **kwargs)
+        if self.validate:
+            problems = self.job_problems(ex, *args, **kwargs)
+            if problems:
+                return self._rejected(job_kind, problems)
+        return self._schedule(job_kind, priority, ex, *args, **kwargs)
+
+    def _rejected(self, job_kind, problems) -> JobFuture:
+        self.telemetry.record(job_kind, None, 'invalid')
+        return JobFuture.failed(ValidationError(problems))
+
+    def _schedule(self, job_kind, priority, ex, *args, **kwargs) -> JobFuture:
+        """`schedule` of validated job"""
+        key = self.job_key(ex, *args, **kwargs)
+        if key is not None and self.cache is not None:
+            result = self.cache.get(key)
+            if result is not None:
+                self.telemetry.record(job_kind, None, 'cached')
+                return JobFuture.ready(result)
+        if key is None or not self.deduplicate:
+            return self._submit(job_kind, priority, ex, key, *args, **kwargs).future
+        with self._inflight_lock:
+            shared = self._inflight.get(key)
+            created = shared is None
+            if created:
+                shared = _SharedJob(key, priority)
+                self._inflight[key] = shared
+            else:
+                self.deduplicated += 1
+                if priority < shared.priority:
+                    shared.priority = priority
+                    if shared.job is not None:
+                        self._promote(shared.job, priority)
+            ret = shared.subscribe(self._unsubscribe)
+        if created:
+            job = self._submit(job_kind, priority, ex, key, *args, **kwargs)
+            job.future.add_done_callback(lambda fut: self._remove_inflight(shared))
+            with self._inflight_lock:
+                shared.set_job(job)
+                if shared.priority < job.priority:  # promoted meantime
+                    self._promote(job, shared.priority)
+                orphaned = shared.subscribers == 0  # all requesters cancelled meantime
+            if orphaned:
+                job.future.cancel()
+        return ret
+
+    def _submit(self, job_kind, priority, ex, key, *args, **kwargs) -> _Job:
+        speculative = self.speculative and getattr(ex, 'cancellable', False)
+        size = self.job_size(ex, *args, **kwargs)
+        job = _Job(job_kind, priority, lambda prio: self._launch(job_kind, prio, ex, size, *args, **kwargs),
+                   speculative=speculative)
+        if speculative and not job.future.done():
+            with self._slots_lock:
+                self._speculative_jobs.append(job)
+                self._start_watchdog()
+        if key is not None and self.cache is not None:
+            job.future.add_done_callback(lambda fut: self._store_result(key, fut))
+        return job
+
+    def _launch(self, job_kind, priority, ex, size, *args, **kwargs) -> _Attempt:
+        """Queues new attempt of the job"""
+        attempt = _Attempt(job_kind, priority,
+                           lambda: self._backend_submit(ex, attempt.submitted, *args, **kwargs), size=size)
+        attempt.future.add_done_callback(lambda fut: self._attempt_done(attempt))
+        with self._slots_lock:
+            self._queues[priority].append(attempt)
+        self._dispatch()
+        if self.autoscaler is not None and attempt.started is None:
+            self.autoscaler.notify()
+        return attempt
+
+    def _backend_submit(self, ex, submitted, *args, **kwargs) -> JobFuture:
+        """Submits job run by `telemetry.run_timed`, returned future carries `timing` of the job"""
+        token = None
+        if getattr(ex, 'cancellable', False):
+            token = self.backend.make_cancel_token()
+        remote_job = getattr(ex, 'remote_job', None) if self.slim_workers else None
+        if remote_job is not None:  # pre-rendered spec run by slim worker runtime
+            start = time.perf_counter()
+            fn, spec, finish = remote_job(*args, **kwargs)
+            render = time.perf_counter() - start
+            if 'shared' in spec:  # objects shipped to each worker once
+                spec['shared'] = {k: self.backend.share(v) for k, v in spec['shared'].items()}
+            if self.shared_memory:
+                spec.update(shared_memory=True, shm_dir=self.shm_dir)
+                finish = self._shm_finish(finish)
+            bf = self.backend.submit(telemetry.run_timed, fn, submitted, spec, cancel_token=token)
+            f = JobFuture(on_cancel=bf.cancel)
+            f.follow(bf, transform=lambda timed: self._finish_timed(f, timed, finish, render))
+            if self.shared_memory:  # `bf` is cancelled with `f`, the job may still finish and export its result
+                settled = bf.settled if bf.settled is not None else bf
+                settled.add_done_callback(lambda fut: self._discard_uncollected(f, fut))
+        else:
+            if token is not None:
+                kwargs['cancel_token'] = token
+            bf = self.backend.submit(telemetry.run_timed, ex, submitted, *args, **kwargs)
+            f = JobFuture(on_cancel=bf.cancel)
+            f.follow(bf, transform=lambda timed: self._finish_timed(f, timed))
+        if token is not None:
+            f.add_cancel_callback(token.set)  # kills running lc
+            self._release_when_settled(bf, token)
+        return f
+
+    @staticmethod
+    def _release_when_settled(bf: JobFuture, token):
+        """Frees cancel `token` when the job cannot run anymore, e.g. cancelled while still queued"""
+        if bf.settled is not None:
+            bf.settled.add_done_callback(lambda fut: token.release())
+        else:  # cancel may not stop running job, its runner releases the token
+            bf.add_done_callback(lambda fut: fut.cancelled() or token.release())
+
+    @staticmethod
+    def _finish_timed(f: JobFuture, timed: telemetry.Timed, finish=None, render=0.0):
+        """Result of job run by `run_timed` converted by `finish`, timing is attached to `f`"""
+        timing = timed.timing
+        if render:
+            timing.add('render', render)
+        result = timed.value
+        if finish is not None:
+            start = time.perf_counter()
+            result = finish(result)
+            timing.add('parse', time.perf_counter() - start)
+        f.timing = timing
+        return result
+
+    @staticmethod
+    def _shm_finish(finish):
+        return lambda output: finish(shmem.resolve(output))
+
+    @staticmethod
+    def _discard_uncollected(f: JobFuture, settled):
+        """Removes shared memory of result of job cancelled meantime, `settled` is done when the job finished"""
+        if not f.cancelled() or settled.cancelled():
+            return
+        try:
+            shmem.discard(settled.result().value)
+        except Exception:
+            pass
+
+    def reserved_slots(self) -> int:
+        """Number of workers reserved for interactive jobs"""
+        workers = self.backend.workers
+        if self.interactive_reserve <= 0.0 or workers <= 1:
+            return 0
+        return min(max(int(math.ceil(workers * self.interactive_reserve)), 1), workers - 1)
+
+    def _next_attempt(self) -> Optional[_Attempt]:
+        """Pops attempt to be dispatched, `None` if no worker is free"""
+        workers = self.backend.workers
+        for priority, queue in self._queues.items():
+            if not queue:
+                continue
+            limit = workers if priority == Priority.Interactive else workers - self.reserved_slots()
+            if self._running >= limit:
+                return None  # strict order, lower priorities have to wait
+            return queue.popleft()
+        return None
+
+    def _dispatch(self):
+        while True:
+            with self._slots_lock:
+                attempt = self._next_attempt()
+                if attempt is None:
+                    return
+                attempt.started = time.monotonic()
+                self._running += 1
+            self._start(attempt)
+
+    def _start(self, attempt: _Attempt):
+        if attempt.future.done():  # cancelled meantime
+            return
+        try:
+            f = attempt.submit()
+        except Exception as e:
+            attempt.future.set_exception_if_pending(e)
+            return
+        attempt.future.add_cancel_callback(f.cancel)
+        if attempt.future.cancelled():
+            f.cancel()
+        attempt.future.follow(f)
+
+    def _attempt_done(self, attempt: _Attempt):
+        now = time.monotonic()
+        with self._slots_lock:
+            if attempt.started is None:  # cancelled while queued
+                try:
+                    self._queues[attempt.priority].remove(attempt)
+                except ValueError:
+                    pass
+            else:
+                self._running -= 1
+        f = attempt.future
+        if attempt.started is not None and not f.cancelled() and f.exception() is None:
+            self.runtimes[attempt.job_kind].add(now - attempt.started)
+            if attempt.size:
+                self.unit_runtimes[attempt.job_kind].add((now - attempt.started) / attempt.size)
+        if f.cancelled():
+            self.telemetry.record(attempt.job_kind, None, 'cancelled')
+        else:
+            self.telemetry.record(attempt.job_kind, f.timing, 'failed' if f.exception() is not None else 'done')
+        self._dispatch()
+
+    def _promote(self, job: _Job, priority: int):
+        """Moves queued attempts of the job to higher priority queue"""
+        with self._slots_lock:
+            job.priority = priority
+            for a in job.attempts:
+                if a.started is None and a.priority > priority:
+                    try:
+                        self._queues[a.priority].remove(a)
+                    except ValueError:
+                        continue
+                    a.priority = priority
+                    self._queues[priority].append(a)
+        self._dispatch()
+
+    def queued_count(self, priority=None) -> int:
+        """Number of jobs waiting for a worker (of `priority` class or all)"""
+        with self._slots_lock:
+            if priority is not None:
+                return len(self._queues[Priority.from_value(priority)])
+            return sum(len(q) for q in self._queues.values())
+
+    def running_count(self) -> int:
+        return self._running
+
+    def queued_work(self) -> Optional[float]:
+        """Expected runtime [s] of queued jobs (by median of recent runtimes), `None` if not known yet"""
+        medians = {}
+        with self._slots_lock:
+            kinds = [a.job_kind for q in self._queues.values() for a in q]
+        for kind in kinds:
+            if kind not in medians:
+                stats = self.runtimes.get(kind)
+                medians[kind] = stats.percentile(50) if stats is not None else None
+            if medians[kind] is None:
+                return None
+        return sum(medians[kind] for kind in kinds)
+
+    straggler_check_interval = 0.2  # [s]
+
+    def straggler_threshold(self, job_kind, size: Optional[int] = None) -> Optional[float]:
+        """Runtime [s] after which job of `job_kind` is considered straggler, `None` if not known yet
+
+        For job of known `size` (see `job_size`) the percentile of runtimes per size unit is scaled by `size`,
+        so that large jobs are not taken for stragglers among small ones."""
+        stats = self.runtimes.get(job_kind) if size is None else self.unit_runtimes.get(job_kind)
+        if stats is None or len(stats) < max(self.speculative_min_samples, 1):
+            return None
+        return stats.percentile(self.speculative_percentile) * (size or 1)
+
+    def _start_watchdog(self):
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch_stragglers, name='wdwrap-stragglers', daemon=True)
+            self._watchdog.start()
+
+    def _watch_stragglers(self):
+        while True:
+            time.sleep(self.straggler_check_interval)
+            with self._slots_lock:
+                self._speculative_jobs = [j for j in self._speculative_jobs if not j.future.done()]
+                if not self._speculative_jobs:
+                    self._watchdog = None
+                    return
+                jobs = [j for j in self._speculative_jobs if not j.speculated]
+                idle = self.backend.workers - self._running - self.queued_count()
+            now = time.monotonic()
+            for j in jobs:
+                if idle <= 0:
+                    break
+                threshold = self.straggler_threshold(j.job_kind, j.attempts[0].size)
+                elapsed = j.attempts[0].elapsed(now)
+                if threshold is None or elapsed is None or elapsed <= threshold:
+                    continue
+                logging.getLogger('jobs').info(
+                    f'{j.job_kind} job running {elapsed:.1f}s (threshold {threshold:.1f}s), launching duplicate')
+                j.speculated = True
+                self.speculated += 1
+                j.add_attempt()
+                idle -= 1
+
+    def _unsubscribe(self, shared: _SharedJob):
+        with self._inflight_lock:
+            shared.subscribers -= 1
+            if shared.subscribers > 0:
+                return
+            if self._inflight.get(shared.key) is shared:
+                del self._inflight[shared.key]
+        if shared.job is not None:
+            shared.job.future.cancel()
+
+    def _remove_inflight(self, shared: _SharedJob):
+        with self._inflight_lock:
+            if self._inflight.get(shared.key) is shared:
+                del self._inflight[shared.key]
+
+    def map(self, job_kind, items: Iterable, window: Optional[int] = None, ordered: bool = True,
+            priority=None, return_exceptions: bool = False, **kwargs) -> Iterator[Tuple[int, Any]]:
+        """Runs job for each of `items`, generates `(index, result)` pairs
+
+        Items are consumed lazily and at most `window` jobs are in flight at once (including finished ones
+        waiting to be yielded in `ordered` mode), so memory does not grow with number of items.
+
+        Parameters
+        ----------
+        job_kind : str
+            Executor name, e.g. 'lc'
+        items : iterable
+            Jobs arguments, e.g. generator of bundles
+        window : int or None
+            Max number of jobs in flight, default `[jobs] map-window` (auto: twice the number of workers)
+        ordered : bool
+            Yield results in order of `items`, otherwise as jobs complete
+        priority : int or str or None
+            `Priority` class of the jobs
+        return_exceptions : bool
+            Yield exception of failed job as its result, otherwise the exception is raised
+        kwargs
+            Passed to executor
+
+        Items pulled into the window are validated at once (`problems_many` of executor), invalid items
+        are not scheduled and fail with `ValidationError`.
+        Jobs in flight are cancelled when generator is closed before exhausting (e.g. on `break`).
+        """
+        if window is None:
+            window = self.map_window()
+        window = max(int(window), 1)
+        items = iter(items)
+        done = queue.SimpleQueue()  # indices of finished jobs
+        pending = {}  # index: future
+        finished = {}  # index: future, finished but not yielded yet
+        submitted = 0
+        yielded = 0
+        exhausted = False
+        try:
+            while True:
+                chunk = []
+                while not exhausted and len(pending) + len(finished) + len(chunk) < window:
+                    try:
+                        chunk.append(next(items))
+                    except StopIteration:
+                        exhausted = True
+                for f in self._schedule_many(job_kind, chunk, priority, **kwargs):
+                    pending[submitted] = f
+                    f.add_done_callback(lambda fut, n=submitted: done.put(n))
+                    submitted += 1
+                n = yielded if ordered else next(iter(finished), None)
+                if n in finished:
+                    f = finished.pop(n)
+                    yielded += 1
+                    yield n, self._map_result(f, return_exceptions)
+                    continue
+                if not pending:
+                    return
+                n = done.get()
+                finished[n] = pending.pop(n)
+        finally:
+            for f in pending.values():
+                f.cancel()
+
+    def _schedule_many(self, job_kind, items: list, priority, **kwargs) -> list:
+        """Schedules job for each of `items`, items are validated at once"""
+        if not items:
+            return []
+        priority = Priority.Interactive if priority is None else Priority.from_value(priority)
+        ex = self.get_job_executor(job_kind)
+        problems_many = getattr(ex, 'problems_many', None) if self.validate else None
+        found = problems_many(items, **kwargs) if problems_many is not None else [None] * len(items)
+        return [self._rejected(job_kind, problems) if problems
+                else self._schedule(job_kind, priority, ex, item, **kwargs)
+                for item, problems in zip(items, found)]
+
+    @staticmethod
+    def _map_result(future, return_exceptions):
+        if not return_exceptions:
+            return future.result()
+        try:
+            return future.result()
+        except Exception as e:
+            return e
+
+    def map_window(self) -> int:
+        """Default max number of jobs in flight of `map`"""
+        try:
+            return cfg().getint('jobs', 'map-window')
+        except (NoSectionError, NoOptionError, ValueError):
+            return 2 * self.backend.workers
+
+    async def schedule_async(self, job_kind, *args, priority=None, **kwargs):
+        """Coroutine counterpart of `schedule`, returns job result
+
+        Executors providing `run_async` coroutine (e.g. `LcRunner`) are run natively in the running event loop,
+        with at most `[jobs] async-slots` jobs running at once (`priority` does not apply).
+        Other executors are scheduled with `schedule` and awaited without blocking a thread."""
+        ex = self.get_job_executor(job_kind)
+        run_async = getattr(ex, 'run_async', None)
+        if run_async is None:
+            return await self.wrap_future(self.schedule(job_kind, *args, priority=priority, **kwargs))
+        key = self.job_key(ex, *args, **kwargs) if self.cache is not None else None
+        if key is not None:
+            result = self.cache.get(key)
+            if result is not None:
+                return result
+        async with self._async_semaphore():
+            result = await run_async(*args, **kwargs)
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    @staticmethod
+    def wrap_future(future) -> asyncio.Future:
+        """Makes asyncio future of the running loop following job future"""
+        loop = asyncio.get_running_loop()
+        ret = loop.create_future()
+
+        def copy_state(fut):
+            if ret.done():
+                return
+            if fut.cancelled():
+                ret.cancel()
+                return
+            try:
+                ret.set_result(fut.result())
+            except Exception as e:
+                ret.set_exception(e)
+
+        future.add_done_callback(lambda fut: loop.call_soon_threadsafe(copy_state, fut))
+        return ret
+
+    def _async_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        try:
+            return self._async_semaphores[loop]
+        except KeyError:
+            pass
+        try:
+            n = cfg().getint('jobs', 'async-slots')
+        except (NoSectionError, NoOptionError, ValueError):
+            n = os.cpu_count() or 1
+        sem = asyncio.Semaphore(n)
+        self._async_semaphores[loop] = sem
+        return sem
 
     def get_job_executor(self, job_kind) -> Callable:
         return self.executors.get(job_kind, None)
 
+    def job_key(self, executor, *args, **kwargs) -> Optional[str]:
+        try:
+            return executor.job_key(*args, **kwargs)
+        except AttributeError:
+            return None
+
+    @staticmethod
+    def job_size(executor, *args, **kwargs) -> Optional[int]:
+        """Amount of work of the job (executor's `job_size`), `None` if executor does not provide it"""
+        try:
+            return executor.job_size(*args, **kwargs)
+        except AttributeError:
+            return None
+
+    @staticmethod
+    def job_problems(executor, *args, **kwargs) -> list:
+        """Reasons the job cannot succeed, empty list for valid job or executor not providing `problems`"""
+        problems = getattr(executor, 'problems', None)
+        if problems is None:
+            return []
+        return problems(*args, **kwargs)
+
+    def cache_stats(self) -> dict:
+        """Cache hit/miss counters"""
+        if self.cache is None:
+            return {}
+        return self.cache.stats()
+
+    def _store_result(self, key, fut):
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        try:
+            self.cache.put(key, fut.result())
+        except Exception as e:
+            logging.getLogger('jobs').warning(f'Cannot cache result of {fut}: {e}')
+
     @classmethod
     def instance(cls):
         if cls._instance is None:
             cls._instance = JobScheduler({
                 'lc': LcRunner(),
-            })
+                'lc-batch': LcBatchRunner(),
+                'lc-chi2': LcChi2Runner(),
+            }, cache=LcResultCache.default_instance())
         return cls._instance
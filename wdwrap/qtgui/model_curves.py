@@ -116,12 +116,18 @@ class CurveGeneratedContainer(CurveValuesContainer):
     def __init__(self, name, data, parent=None, columns_mapper=lambda col: col, read_only=True):
         super().__init__(name, data, parent, columns_mapper, read_only)
         data.observe(lambda change: self.on_curve_status_change(change), 'status')
+        data.observe(lambda change: self.on_curve_data_change(change), 'df_version')
 
     def add_children_for_private_wd_parameters(self):
         parameters = self.content.parameters
         for key, item in parameters.items():
             WdParameterContainer(key, item, parent=self)
 
+    def on_curve_data_change(self, change):
+        if self.content.partial:  # complete curve is signalled by Ready status
+            logger().info(f'Curve {self} partially calculated - emitting signal')
+            self.sig_curve_changed.emit(self)
+
     def on_curve_status_change(self, change):
         logger().info('Curve {} status {} -> {}'.format(
             self,
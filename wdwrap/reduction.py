@@ -0,0 +1,122 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Worker-side reduction of models against observations
+
+For fitting and scans the client needs only chi² (or residuals) of the model, not the model curve.
+`lc-chi2` jobs (`LcChi2Runner`) compare `lc` output with `Observations` on worker and return few numbers.
+
+Observations are shipped to each worker once: after `Observations.export` they pickle as a reference
+to file (read once per worker process and cached), Dask backends scatter them to workers.
+Module needs only numpy, it's used by slim worker runtime (`wdwrap.worker`).
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from .cache import digest
+from .shmem import PREFIX as SHM_PREFIX
+
+PREFIX = SHM_PREFIX + 'obs-'  # stale files are removed by `shmem.sweep`
+
+# observations unpickled by this process, key: Observations
+_cache = OrderedDict()
+_cache_size = 16
+
+
+class Observations(object):
+    """Observed points of a curve: phases, values and weights
+
+    Parameters
+    ----------
+    ph : array
+        Phases of observations
+    values : array
+        Observed values (e.g. magnitudes or radial velocities)
+    weights : array or None
+        Weights of points, chi² is sum of `weights * residuals**2`, default ones
+    column : str
+        Model column compared with `values`, e.g. 'mag', 'rv1'
+    """
+
+    def __init__(self, ph, values, weights=None, column: str = 'mag'):
+        super(Observations, self).__init__()
+        self.ph = np.ascontiguousarray(ph, dtype=float)
+        self.values = np.ascontiguousarray(values, dtype=float)
+        if weights is None:
+            weights = np.ones_like(self.values)
+        self.weights = np.ascontiguousarray(weights, dtype=float)
+        if not (self.ph.shape == self.values.shape == self.weights.shape):
+            raise ValueError('Phases, values and weights of observations have to be of the same length')
+        self.column = column
+        self.key = digest(column, self.ph.tobytes(), self.values.tobytes(), self.weights.tobytes())
+        self.path = None
+
+    @classmethod
+    def from_values(cls, obs_values, column: str = 'mag') -> 'Observations':
+        """Observations from `ObservedValues` (phased and weighted by its transformers)"""
+        df = obs_values.df
+        weights = df['weight'].values if 'weight' in df.columns else None
+        return cls(df[obs_values.indep_column].values, df[column].values, weights, column=column)
+
+    def __len__(self):
+        return len(self.ph)
+
+    def export(self, directory: str) -> 'Observations':
+        """Writes observations into `directory` visible to workers, since then pickles as reference"""
+        path = os.path.join(directory, f'{PREFIX}{self.key}.npy')
+        try:
+            os.utime(path)  # in use, not stale
+        except OSError:
+            tmp = f'{path}.{os.getpid()}.tmp'
+            np.save(tmp, np.stack([self.ph, self.values, self.weights]))
+            os.replace(tmp + '.npy', path)
+        self.path = path
+        return self
+
+    def unlink(self):
+        """Removes file written by `export`, observations pickle by value again"""
+        if self.path is None:
+            return
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.path = None
+
+    def __getstate__(self):
+        if self.path is not None:
+            return {'key': self.key, 'column': self.column, 'path': self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        cached = _cache.get(state['key'])
+        if cached is not None:
+            _cache.move_to_end(state['key'])
+            self.__dict__.update(cached.__dict__)
+            return
+        if 'ph' not in state:  # reference, read from file once per process
+            ph, values, weights = np.load(state['path'])
+            state = dict(state, ph=ph, values=values, weights=weights)
+        self.__dict__.update(state)
+        _cache[self.key] = self
+        while len(_cache) > _cache_size:
+            _cache.popitem(last=False)
+
+
+def reduce(model_ph, model_values, observations: Observations, residuals: bool = False) -> dict:
+    """Compares model with observations
+
+    Model is interpolated (linear, periodic in phase) at phases of observations.
+    Returns dict with `chi2`, number of points `n` and (if requested) `residuals` (observed - model).
+    """
+    model_ph = np.asarray(model_ph, dtype=float) % 1.0
+    model_values = np.asarray(model_values, dtype=float)
+    if len(model_ph) == 0:
+        raise ValueError('Empty model')
+    order = np.argsort(model_ph)
+    model_at = np.interp(observations.ph % 1.0, model_ph[order], model_values[order], period=1.0)
+    res = observations.values - model_at
+    ret = {'chi2': float(np.sum(observations.weights * res ** 2)), 'n': len(res)}
+    if residuals:
+        ret['residuals'] = res
+    return ret
@@ -0,0 +1,124 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Debounced, coalesced regeneration of curves
+
+Bundle observers invalidate a curve on every single parameter change. Typing a value or dragging through
+several parameters would cancel and resubmit calculation of the curve on each change.
+`RegenerationScheduler` groups the requests: regeneration of a curve runs once, when no other request
+for the same curve arrives during `quiet` period, but not later than `max_latency` after the first
+of grouped requests. Like `wdwrap.qtgui.signal_delayed.SignalDelayedPermanentTimer` but without Qt,
+the callbacks are called from the scheduler thread.
+"""
+import threading
+import time
+from typing import Callable, Hashable, Optional
+
+from wdwrap.config import cfg
+
+_logger = None
+
+
+def logger():
+    global _logger
+    if _logger is None:
+        import logging
+        _logger = logging.getLogger('regeneration')
+    return _logger
+
+
+class RegenerationScheduler(object):
+    """Coalescing scheduler of delayed callbacks, one pending callback per key
+
+    Parameters
+    ----------
+    quiet : float
+        Seconds without new request for the key before the callback is called, 0 - call immediately
+    max_latency : float
+        Maximal seconds from the first of grouped requests to the call
+    """
+    _defaultInstance = None
+    _defaultLock = threading.Lock()
+
+    def __init__(self, quiet: Optional[float] = None, max_latency: Optional[float] = None):
+        super(RegenerationScheduler, self).__init__()
+        if quiet is None:
+            quiet = cfg().getfloat('curves', 'regenerate-quiet', fallback=0.25)
+        if max_latency is None:
+            max_latency = cfg().getfloat('curves', 'regenerate-max-latency', fallback=1.0)
+        self.quiet = quiet
+        self.max_latency = max(max_latency, quiet)
+        self._pending = {}  # key: [callback, first request time, last request time]
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def request(self, key: Hashable, callback: Callable[[], None]):
+        """Schedules `callback`, replaces pending callback of the `key`"""
+        if self.quiet <= 0.0:
+            callback()
+            return
+        now = time.monotonic()
+        with self._condition:
+            pending = self._pending.get(key)
+            if pending is None:
+                logger().info(f'Regeneration of {key} scheduling')
+                self._pending[key] = [callback, now, now]
+            else:
+                logger().info(f'Regeneration of {key} rescheduling')
+                pending[0], pending[2] = callback, now
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='regeneration', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def cancel(self, key: Hashable) -> bool:
+        """Drops pending callback of the `key`, returns True if there was one"""
+        with self._condition:
+            return self._pending.pop(key, None) is not None
+
+    def pending(self, key: Hashable) -> bool:
+        with self._condition:
+            return key in self._pending
+
+    def flush(self):
+        """Calls all pending callbacks now, in calling thread"""
+        with self._condition:
+            due = [pending[0] for pending in self._pending.values()]
+            self._pending.clear()
+        self._call(due)
+
+    def _deadline(self, pending) -> float:
+        _, first, last = pending
+        return min(last + self.quiet, first + self.max_latency)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                due = [k for k, p in self._pending.items() if self._deadline(p) <= now]
+                callbacks = [self._pending.pop(k)[0] for k in due]
+                if not callbacks:
+                    if self._pending:
+                        self._condition.wait(min(self._deadline(p) for p in self._pending.values()) - now)
+                    else:
+                        self._condition.wait()
+                    continue
+            self._call(callbacks)
+
+    @staticmethod
+    def _call(callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger().error(f'Regeneration failed: {e}')
+
+    @classmethod
+    def default_instance(cls) -> 'RegenerationScheduler':
+        if cls._defaultInstance is None:
+            with cls._defaultLock:
+                if cls._defaultInstance is None:
+                    cls._defaultInstance = cls()
+        return cls._defaultInstance
+
+    @classmethod
+    def set_default_instance(cls, instance: Optional['RegenerationScheduler']):
+        cls._defaultInstance = instance
@@ -1,37 +1,67 @@
 from __future__ import print_function
+import asyncio
 import os
-import re
+import shutil
 import subprocess
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-from .tempdir import WdTempDir
+import numpy as np
+import pandas as pd
+
+from . import telemetry, worker
+from .cpuslots import CpuSlots
+from .tempdir import WdDirPool
 from .io import *
 from .config import cfg
+from .drivers import MPAGE
+from .exceptions import JobCancelledError
 
 
 class Runner(object):
     """Stateless Runner
 
     Thread safe, multiple jobs can be run be runner. Runner does not store state of the runner.
+    Jobs can be cancelled while running with `cancel_token` (see `wdwrap.backends.CancelToken`),
+    cancelled job raises `JobCancelledError`.
     """
+    cancellable = True  # accepts `cancel_token`
+    poll_interval = 0.1  # how often cancel token is checked [s]
+
     def __init__(self):
         super(Runner, self).__init__()
 
-    def __call__(self, bundle, timeout=None):
-        # TODO: super slow temp:
-        import time
-        # time.sleep(5)
-        return self.run(bundle=bundle, timeout=timeout)
+    def __call__(self, bundle, timeout=None, cancel_token=None):
+        return self.run(bundle, timeout=timeout, cancel_token=cancel_token)
 
-    def run(self, bundle, timeout=None):
+    def run(self, bundle, timeout=None, cancel_token=None):
         raise NotImplementedError
 
+    def job_key(self, bundle, timeout=None):
+        """Content digest identifying result of the job, `None` if job results are not cacheable"""
+        return None
+
+    def job_size(self, bundle, timeout=None):
+        """Amount of work of the job (e.g. number of phase points), `None` if not known
+
+        Runtimes of jobs are compared per unit of size when looking for stragglers."""
+        return None
+
+    def problems(self, bundle, timeout=None) -> list:
+        """Reasons the job cannot succeed (checked before scheduling), empty list for valid job"""
+        return []
+
+    def problems_many(self, items, **kwargs) -> list:
+        """`problems` of jobs of each of `items`"""
+        return [self.problems(item, **kwargs) for item in items]
+
     def cancel(self, proc):
-        self.canceled = True
+        """Kills running process"""
         try:
-            self.proc.kill()
+            proc.kill()
             logging.getLogger('runner').info(f'Canceling job. Killing')
-        except AttributeError:
+        except (AttributeError, ProcessLookupError):
             pass
 
 
@@ -41,32 +71,166 @@ class LcRunner(Runner):
         super(LcRunner, self).__init__()
         self.executable = cfg().get('executables', 'lc')
 
-    def run(self, bundle, timeout=None):
+    def job_key(self, bundle, timeout=None):
+        """Digest of rendered lcin, WD version and `lc` executable identity"""
+        from .cache import digest
+        return digest(render_lcin(bundle), self.wdversion(bundle), executable_identity(self.executable))
+
+    def job_size(self, bundle, timeout=None):
+        return expected_points(bundle) or None
+
+    def problems(self, bundle, timeout=None) -> list:
+        from .validation import problems
+        return problems(bundle)
+
+    def problems_many(self, items, **kwargs) -> list:
+        from .validation import problems_many
+        return problems_many(items)
+
+    outputs = [('light', MPAGE.LIGHT, Reader_light), ('veloc', MPAGE.VELOC, Reader_veloc)]
+
+    def job_spec(self, bundle, timeout=None) -> dict:
+        """Pre-rendered job for slim worker runtime (see `wdwrap.worker`)"""
+        return {
+            'lcin': render_lcin(bundle),
+            'wdversion': self.wdversion(bundle),
+            'executable': self.executable,
+            'timeout': timeout,
+            'outputs': [name for name, _, _ in self.outputs],
+        }
+
+    def remote_job(self, bundle, timeout=None):
+        """Job for slim worker: returns `(function, spec, finish)`
+
+        `function(spec, cancel_token=...)` is run on worker, `finish(output)` converts its output
+        on client side into the result of `run`."""
+        return worker.run_lc, self.job_spec(bundle, timeout=timeout), \
+            lambda output: self.results_from_output(output, bundle)
+
+    def results_from_output(self, output: dict, bundle) -> dict:
+        """Converts slim worker output into `run` result (dict of DataFrames)"""
+        ret = {}
+        for name, _, reader in self.outputs:
+            if name in output:
+                ret[name] = self._frames(output[name], reader, single=True)[0]
+        return ret
+
+    @staticmethod
+    def _frames(blocks, reader, single=False) -> list:
+        """DataFrames of output blocks (2D arrays), `single` joins all blocks into one frame"""
+        columns = reader().columns['names']
+        if single and len(blocks) != 1:
+            blocks = [np.concatenate(blocks) if blocks else np.empty((0, len(columns)))]
+        return [pd.DataFrame(b, columns=columns, copy=False) for b in blocks]  # keeps shared memory views
+
+    def run(self, bundle, timeout=None, cancel_token=None):
         # if timeout is None:
         #     timeout = 3075840000  # sto lat sto lat!
         # abs_timeout = datetime.now() + timedelta(seconds=timeout)
         # if datetime.now() > abs_timeout:
         #     raise TimeoutError
 
-        with WdTempDir(bundle.wdversion, delete_on_exit=False) as d:
+        try:
+            if cancel_token is not None and cancel_token.is_set():  # cancelled while queued
+                raise JobCancelledError()
+            start = time.perf_counter()
+            with WdDirPool.default_instance().workdir(self.wdversion(bundle)) as d:
+                telemetry.add('setup', time.perf_counter() - start)
+                with telemetry.stage('render'):
+                    self.write_lcin(bundle, d)
+                self.execute(d, timeout=timeout, cancel_token=cancel_token)
+                with telemetry.stage('parse'):
+                    ret = self.collect_results(d, bundle)
+        finally:
+            if cancel_token is not None:
+                cancel_token.release()
+        return ret
+        # print (errs)
+        # print (d)
+
+    async def run_async(self, bundle, timeout=None):
+        """Coroutine version of `run`
+
+        `lc` process is supervised by event loop, parsing of output is done in default loop executor.
+        If coroutine is cancelled, `lc` process is killed."""
+        loop = asyncio.get_running_loop()
+        with WdDirPool.default_instance().workdir(self.wdversion(bundle)) as d:
             self.write_lcin(bundle, d)
-            proc = subprocess.Popen([self.executable], cwd=d,
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                    text=True)
+            await self.execute_async(d, timeout=timeout)
+            ret = await loop.run_in_executor(None, self.collect_results, d, bundle)
+        return ret
+
+    def wdversion(self, bundle):
+        return bundle.wdversion
+
+    @contextmanager
+    def cpu_slot(self, cancel_token=None, timeout=None):
+        """Holds CPU slot (see `wdwrap.cpuslots`) while `lc` runs, yields `None` if slots are disabled"""
+        slots = CpuSlots.default_instance()
+        if slots is None:
+            yield None
+            return
+        with slots.slot(cancel_token, timeout) as slot:
+            yield slot
+
+    def execute(self, directory, timeout=None, cancel_token=None):
+        """Runs `lc` in `directory` containing lcin file, `timeout` includes waiting for CPU slot"""
+        slot_wait = time.perf_counter()
+        with self.cpu_slot(cancel_token, timeout) as slot:
+            waited = time.perf_counter() - slot_wait
+            telemetry.add('slot', waited)
+            with telemetry.stage('exec'):
+                proc = subprocess.Popen([worker.executable_path(self.executable)], cwd=directory,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        preexec_fn=slot and slot.preexec_fn())
+                remaining = None if timeout is None else max(timeout - waited, 0.0)
+                outs, errs, rusage = self._communicate(proc, remaining, cancel_token)
+            telemetry.add_usage(rusage)
+        self.check_errors(errs)
+
+    def _communicate(self, proc, timeout=None, cancel_token=None):
+        return worker.communicate(proc, timeout=timeout, cancel_token=cancel_token, poll_interval=self.poll_interval)
+
+    async def execute_async(self, directory, timeout=None):
+        """Coroutine version of `execute`"""
+        slots = CpuSlots.default_instance()
+        slot_wait = time.perf_counter()
+        slot = None if slots is None else await slots.acquire_async(timeout)
+        if timeout is not None:
+            timeout = max(timeout - (time.perf_counter() - slot_wait), 0.0)
+        try:
+            proc = await asyncio.create_subprocess_exec(worker.executable_path(self.executable), cwd=directory,
+                                                        stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.PIPE,
+                                                        preexec_fn=slot and slot.preexec_fn())
             try:
-                outs, errs = proc.communicate(timeout=timeout)
-            except subprocess.TimeoutExpired:
+                outs, errs = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+            except asyncio.TimeoutError:
                 logging.getLogger('runner').info(f'Timeout ({timeout}s) occurred. Killing')
-                proc.kill()
+                self._kill_async(proc)
+                await proc.wait()
                 raise TimeoutError
+            except asyncio.CancelledError:
+                logging.getLogger('runner').info(f'Canceling job. Killing')
+                self._kill_async(proc)
+                await proc.wait()
+                raise
+        finally:
+            if slot is not None:
+                slot.release()
+        self.check_errors(errs.decode(errors='replace'))
 
-            errors = re.search(r'error:\s*(.*)', errs)
-            if errors:
-                raise RuntimeError('lc error: ' + errors.groups()[0])
-            ret = self.collect(d)
-        return ret
-        # print (errs)
-        # print (d)
+    @staticmethod
+    def _kill_async(proc):
+        try:
+            proc.kill()
+        except ProcessLookupError:  # already finished
+            pass
+
+    check_errors = staticmethod(worker.check_errors)
+
+    def collect_results(self, directory, bundle):
+        return self.collect(directory)
 
     def write_lcin(self, bundle, directory, filename='lcin.active'):
         w = Writer_lcin(filepath=os.path.join(directory, filename), bundle=bundle)
@@ -91,3 +255,184 @@ class LcRunner(Runner):
             return Reader_veloc(filepath).df
         return None
 
+
+class LcBatchRunner(LcRunner):
+    """Runs list of bundles in single `lc` process
+
+    All bundles are written into one lcin file, `lc` output is split back into per-bundle results.
+    Process spawn and `lc` startup is paid once per batch instead of once per bundle.
+    Returns list of results (dicts like `LcRunner.run` returns), one per bundle.
+    """
+
+    def run(self, bundles, timeout=None, cancel_token=None):
+        bundles = list(bundles)
+        if not bundles:
+            return []
+        return super().run(bundles, timeout=timeout, cancel_token=cancel_token)
+
+    async def run_async(self, bundles, timeout=None):
+        bundles = list(bundles)
+        if not bundles:
+            return []
+        return await super().run_async(bundles, timeout=timeout)
+
+    def wdversion(self, bundles):
+        wdversion = bundles[0].wdversion
+        if any(b.wdversion != wdversion for b in bundles):
+            raise ValueError('All bundles of the batch have to be of the same WD version')
+        return wdversion
+
+    def job_key(self, bundles, timeout=None):
+        from .cache import digest
+        bundles = list(bundles)
+        if not bundles:
+            return None
+        return digest('batch', super().job_key(bundles, timeout=timeout))  # result differs from single run
+
+    def job_size(self, bundles, timeout=None):
+        return sum(expected_points(b) for b in bundles) or None
+
+    def problems(self, bundles, timeout=None) -> list:
+        return self.problems_many([bundles])[0]
+
+    def problems_many(self, items, **kwargs) -> list:
+        """Bundles of all batches are validated at once"""
+        from .validation import problems_many
+        batches = [list(bundles) for bundles in items]
+        found = iter(problems_many([b for bundles in batches for b in bundles]))
+        return [[f'bundle {n}: {p}' for n in range(len(bundles)) for p in next(found)] for bundles in batches]
+
+    def collect_results(self, directory, bundles):
+        ret = [{} for _ in bundles]
+        for name, mpage, reader in self.outputs:
+            if not any(b['MPAGE'].val == mpage for b in bundles):
+                continue
+            try:
+                dfs = reader(os.path.join(directory, name + '.dat')).blocks()
+            except IOError:
+                continue
+            self._assign(ret, bundles, name, mpage, dfs)
+        return ret
+
+    def results_from_output(self, output: dict, bundles) -> list:
+        ret = [{} for _ in bundles]
+        for name, mpage, reader in self.outputs:
+            if name in output and any(b['MPAGE'].val == mpage for b in bundles):
+                self._assign(ret, bundles, name, mpage, self._frames(output[name], reader))
+        return ret
+
+    @staticmethod
+    def _assign(ret, bundles, name, mpage, dfs):
+        """Assigns output blocks `dfs` to results of bundles of `mpage` type"""
+        idx = [n for n, b in enumerate(bundles) if b['MPAGE'].val == mpage]
+        if len(dfs) != len(idx):  # no headers in output, split where phase (or hjd) restarts
+            df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+            dfs = split_blocks(df, [bundles[n] for n in idx])
+        for n, df in zip(idx, dfs):
+            ret[n][name] = df
+
+
+class LcChi2Runner(LcRunner):
+    """Runs `lc` and compares its output with observations, returns chi²
+
+    Job arguments: `bundle`, `observations` (`wdwrap.reduction.Observations`), `residuals` flag.
+    Returns dict with `chi2`, number of points `n` and, if `residuals` is set, residuals vector.
+    With slim workers the comparison is done on worker (see `wdwrap.reduction`).
+    """
+
+    def job_key(self, bundle, observations=None, residuals=False, timeout=None):
+        from .cache import digest
+        return digest('chi2', super().job_key(bundle), observations.key, str(bool(residuals)))
+
+    def job_size(self, bundle, observations=None, residuals=False, timeout=None):
+        return super().job_size(bundle)
+
+    def problems(self, bundle, observations=None, residuals=False, timeout=None) -> list:
+        return super().problems(bundle)
+
+    def _reduce_params(self, bundle, observations, residuals):
+        name, _, reader = self.outputs[0] if bundle['MPAGE'].val == MPAGE.LIGHT else self.outputs[1]
+        columns = reader().columns['names']
+        return {'output': name, 'ph': columns.index('ph'), 'value': columns.index(observations.column),
+                'residuals': bool(residuals)}
+
+    def job_spec(self, bundle, observations=None, residuals=False, timeout=None) -> dict:
+        spec = super().job_spec(bundle, timeout=timeout)
+        spec['shared'] = {'observations': observations}
+        spec['reduce'] = self._reduce_params(bundle, observations, residuals)
+        return spec
+
+    def remote_job(self, bundle, observations=None, residuals=False, timeout=None):
+        return worker.run_reduce, self.job_spec(bundle, observations, residuals, timeout=timeout), \
+            lambda output: output
+
+    def run(self, bundle, observations=None, residuals=False, timeout=None, cancel_token=None):
+        from .reduction import reduce
+        params = self._reduce_params(bundle, observations, residuals)
+        df = super().run(bundle, timeout=timeout, cancel_token=cancel_token)[params['output']]
+        return reduce(df['ph'].values, df[observations.column].values, observations, residuals=residuals)
+
+    def __call__(self, bundle, observations=None, residuals=False, timeout=None, cancel_token=None):
+        return self.run(bundle, observations, residuals, timeout=timeout, cancel_token=cancel_token)
+
+
+def output_range(bundle) -> tuple:
+    """(column, start, stop, step) of independent variable of `lc` output for the bundle"""
+    if bundle['JDPHS'].val == 1:
+        return 'hjd', float(bundle['HJDST']), float(bundle['HJDSP']), float(bundle['HJDIN'])
+    return 'ph', float(bundle['PHSTRT']), float(bundle['PHSTOP']), float(bundle['PHIN'])
+
+
+def expected_points(bundle) -> int:
+    """Number of output points `lc` generates for the bundle (approximately, see `split_blocks`)"""
+    _, start, stop, step = output_range(bundle)
+    if step <= 0.0 or stop < start:
+        return 0
+    return int((stop - start) / step + 1e-6) + 1
+
+
+def split_blocks(df: pd.DataFrame, bundles) -> list:
+    """Splits header-less `lc` output table of many `bundles` into per-bundle blocks
+
+    The number of points of a block depends on rounding in the `lc` loop over phases, so blocks are found
+    by the independent variable instead: new block starts where it decreases or repeats (overlapping
+    or adjacent ranges), or where the previous block is complete, i.e. its next point would exceed stop
+    of its range."""
+    if not bundles:
+        return []
+    ranges = [output_range(b) for b in bundles]
+    column = ranges[0][0]
+    if len(df) == 0 or column not in df.columns:
+        raise ValueError(f'Table of {len(df)} rows cannot be split into {len(bundles)} blocks')
+    steps = [step for _, _, _, step in ranges if step > 0.0]
+    tol = min(steps) / 4.0 if steps else 1e-9
+    x = df[column].values
+    bounds = [0]
+    for _, _, stop, step in ranges[:-1]:
+        pos = bounds[-1]
+        for i in range(pos + 1, len(x)):
+            if x[i] <= x[i - 1] + tol or x[i] > stop + tol or (step > 0.0 and x[i - 1] + step > stop + tol):
+                bounds.append(i)
+                break
+        else:
+            raise ValueError(f'Table of {len(df)} rows cannot be split into {len(bundles)} blocks')
+    bounds.append(len(x))
+    return [df.iloc[lo:hi].reset_index(drop=True) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+
+def render_lcin(bundle) -> str:
+    """Returns lcin file content for bundle (or list of bundles)"""
+    import io
+    buf = io.StringIO()
+    Writer_lcin(filepath=buf, bundle=bundle).write()
+    return buf.getvalue()
+
+
+def executable_identity(executable: str) -> str:
+    """Identifies executable by resolved path, size and modification time"""
+    path = shutil.which(executable) or executable
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path
+    return f'{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}'
@@ -0,0 +1,353 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Runtime-aware division of generated curves into segments
+
+Generated curve (`wdwrap.curves.WdGeneratedValues`) is computed in segments, each segment is `lc` job
+of a part of the phase range. Runtime of `lc` per phase point depends on the model grid
+(`N1`, `N2`, `MREF`, `NREF`...) and on the phase (points in eclipses cost more), so equal-width segments
+finish unevenly.
+
+`CostModel` predicts runtime of a job: overhead (process startup, reading tables) plus sum of costs
+of its phase points, costs are kept per phase bin. The model is fed by measured `exec` times of finished
+segment jobs (normalised least mean squares update). `CostModel.plan` chooses number of segments
+and their boundaries so segments end at about the same time on available workers.
+Models are kept per grid settings (`CostModels`), the same model serves all curves of similar bundles.
+
+Adaptive sampling places points where the curve needs them: the first pass is computed with coarse step,
+finer in eclipse windows predicted from conjunction phases (`eclipse_windows`). Then error of cubic spline
+interpolation of computed points is estimated (`interpolation_errors`) and `refinement_ranges` with finer step
+are computed where the error exceeds tolerance, until the curve is accurate or the minimal step is reached.
+
+Computed points are kept by `SegmentResults` per model (`model_digest`, independent of phase range),
+segments split, moved or with changed `PHIN` compute only points not computed yet.
+"""
+import math
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import CubicSpline
+
+# parameters affecting lc runtime per phase point
+COST_PARAMETERS = ('MPAGE', 'N1', 'N2', 'N1L', 'N2L', 'MREF', 'NREF', 'IPB', 'NL', 'IFAT1', 'IFAT2', 'MODE')
+
+Range = Tuple[float, float, float]  # (start, stop, step) of phase grid
+
+
+def range_phases(start: float, stop: float, step: float) -> np.ndarray:
+    """Phase points `lc` computes for the range (as `wdwrap.runners.expected_points`)"""
+    if step <= 0.0 or stop < start:
+        return np.empty(0)
+    return start + step * np.arange(int((stop - start) / step + 1e-6) + 1)
+
+
+def cost_key(bundle) -> str:
+    """Identity of grid settings which determine `lc` runtime per point"""
+    values = []
+    for name in COST_PARAMETERS:
+        try:
+            values.append(f'{name}={bundle[name].val}')
+        except KeyError:
+            pass
+    return ';'.join([getattr(bundle, 'wdversion', '')] + values)
+
+
+class CostModel(object):
+    """Runtime of `lc` job: `overhead` + sum of per-point costs of phase bins covered by job points
+
+    Parameters
+    ----------
+    bins : int
+        Number of phase bins of [0, 1)
+    overhead : float
+        Initial estimate of job overhead [s]
+    point_cost : float
+        Initial estimate of cost of a point [s]
+    rate : float
+        Learning rate of updates, 0 < rate <= 1
+    """
+
+    def __init__(self, bins: int = 50, overhead: float = 0.05, point_cost: float = 0.001, rate: float = 0.5):
+        super(CostModel, self).__init__()
+        self.bins = bins
+        self.rate = rate
+        self.weights = np.concatenate([[overhead], np.full(bins, point_cost)])
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    @property
+    def overhead(self) -> float:
+        return float(self.weights[0])
+
+    @property
+    def point_costs(self) -> np.ndarray:
+        """Cost of a point in each phase bin [s]"""
+        return self.weights[1:]
+
+    def features(self, ranges: Sequence[Range]) -> np.ndarray:
+        """[1, number of points in each bin] of job computing `ranges`"""
+        ph = np.concatenate([range_phases(*r) for r in ranges]) if ranges else np.empty(0)
+        idx = np.minimum((np.mod(ph, 1.0) * self.bins).astype(int), self.bins - 1)
+        return np.concatenate([[1.0], np.bincount(idx, minlength=self.bins)])
+
+    def predict(self, ranges: Sequence[Range]) -> float:
+        """Predicted runtime of job computing phase `ranges` [s]"""
+        return float(self.weights @ self.features(ranges))
+
+    def observe(self, ranges: Sequence[Range], seconds: float):
+        """Updates model with measured runtime of job computing phase `ranges`"""
+        x = self.features(ranges)
+        with self._lock:
+            predicted = float(self.weights @ x)
+            if self.samples == 0 and predicted > 0.0:  # first sample: rescale the prior
+                self.weights *= seconds / predicted
+            else:
+                self.weights += self.rate * (seconds - predicted) * x / float(x @ x)
+                np.maximum(self.weights, 1e-9, out=self.weights)
+            self.samples += 1
+
+    def cumulative_cost(self, phases: np.ndarray, step: float) -> np.ndarray:
+        """Cost of points on grid of `step` from phase 0 to `phases` (piecewise linear in phase)"""
+        density = self.point_costs / step  # cost per unit of phase
+        edges = np.concatenate([[0.0], np.cumsum(density / self.bins)])
+        return np.interp(phases, np.linspace(0.0, 1.0, self.bins + 1), edges)
+
+    def makespan(self, segments: int, workers: int, cost: float, dispatch: float = 0.0) -> float:
+        """Predicted wall-clock time of `cost` of points divided into equal-cost `segments`"""
+        return math.ceil(segments / workers) * (self.overhead + cost / segments) + dispatch * segments
+
+    def plan(self, workers: int, step: float, start: float = 0.0, stop: float = 1.0,
+             max_segments: int = 20, dispatch: float = 0.005) -> List[float]:
+        """Segment dividers of [`start`, `stop`] for `workers` with points grid `step`
+
+        Number of segments minimises predicted makespan (`dispatch` is client side cost of a job [s]),
+        dividers split cost of points equally and are aligned to the points grid."""
+        workers = max(int(workers), 1)
+        points = range_phases(start, stop, step)
+        cum_lo, cum_hi = self.cumulative_cost(np.array([start, stop]), step)
+        cost = cum_hi - cum_lo
+        count = min(max(int(max_segments), 1), max(len(points) - 1, 1))
+        segments = min(range(1, count + 1), key=lambda k: self.makespan(k, workers, cost, dispatch))
+        # invert cumulative cost, dividers snapped to points
+        cum = self.cumulative_cost(points, step)
+        targets = cum_lo + cost * np.arange(1, segments) / segments
+        idx = np.unique(np.clip(np.searchsorted(cum, targets), 1, len(points) - 2)) if segments > 1 else []
+        return [float(start)] + [round(float(points[n]), 12) for n in idx] + [float(stop)]
+
+
+class CostModels(object):
+    """Cost models by grid settings (`cost_key` of bundle)"""
+    _defaultInstance = None
+    _defaultLock = threading.Lock()
+
+    def __init__(self, bins: int = 50):
+        super(CostModels, self).__init__()
+        self.bins = bins
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get(self, bundle) -> CostModel:
+        key = cost_key(bundle)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._models[key] = CostModel(bins=self.bins)
+            return model
+
+    @classmethod
+    def default_instance(cls) -> 'CostModels':
+        if cls._defaultInstance is None:
+            with cls._defaultLock:
+                if cls._defaultInstance is None:
+                    cls._defaultInstance = cls()
+        return cls._defaultInstance
+
+    @classmethod
+    def set_default_instance(cls, instance: Optional['CostModels']):
+        cls._defaultInstance = instance
+
+
+def _value(bundle, name, default=0.0):
+    try:
+        return float(bundle[name].val)
+    except (KeyError, TypeError):
+        return default
+
+
+def _mean_anomaly(nu, e):
+    ea = 2.0 * np.arctan(np.sqrt((1.0 - e) / (1.0 + e)) * np.tan(nu / 2.0))
+    return ea - e * np.sin(ea)
+
+
+def conjunction_phases(bundle) -> Tuple[float, float]:
+    """Phases of primary and secondary conjunction, from `PSHIFT`, `E` and `PERR0`"""
+    e = _value(bundle, 'E')
+    omega = _value(bundle, 'PERR0', math.pi / 2.0) if e > 0.0 else math.pi / 2.0  # lc ignores PERR0 for e=0
+    m1 = _mean_anomaly(math.pi / 2.0 - omega, e)
+    m2 = _mean_anomaly(3.0 * math.pi / 2.0 - omega, e)
+    primary = _value(bundle, 'PSHIFT') % 1.0
+    return primary, float((primary + (m2 - m1) / (2.0 * math.pi)) % 1.0)
+
+
+def eclipse_windows(bundle, margin: float = 1.5) -> List[Tuple[float, float]]:
+    """Phase ranges (within [0, 1]) around conjunctions where eclipses are possible
+
+    Relative radii are estimated from potentials (r ~ 1/Ω), half-width of a window is the phase
+    at which projected separation equals sum of radii, times `margin`. Empty for non-eclipsing systems."""
+    q = _value(bundle, 'RM', 1.0)
+    e = _value(bundle, 'E')
+    omega = _value(bundle, 'PERR0', math.pi / 2.0) if e > 0.0 else math.pi / 2.0
+    r1 = 1.0 / max(_value(bundle, 'POTH', 10.0), 1.0)
+    r2 = 1.0 / max((_value(bundle, 'POTC', 10.0) - 0.5 * (1.0 - q)) / q, 1.0)  # potential of star 2 in its frame
+    cos_i = abs(math.cos(math.radians(_value(bundle, 'XINCL', 90.0))))
+    ret = []
+    for center, nu in zip(conjunction_phases(bundle), (math.pi / 2.0 - omega, 3.0 * math.pi / 2.0 - omega)):
+        d = (1.0 - e ** 2) / (1.0 + e * math.cos(nu))  # separation at conjunction
+        reach = min((r1 + r2) / d, 1.0)
+        if cos_i >= reach:
+            continue
+        half = margin * math.asin(math.sqrt(reach ** 2 - cos_i ** 2)) / (2.0 * math.pi)
+        lo, hi = center - half, center + half
+        for shift in (-1.0, 0.0, 1.0):  # windows wrapping around phase 0
+            a, b = max(float(lo) + shift, 0.0), min(float(hi) + shift, 1.0)
+            if a < b:
+                ret.append((a, b))
+    return sorted(ret)
+
+
+def interpolation_errors(ph: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Estimated errors of cubic spline interpolation of `values` sampled at sorted `ph`, at each point
+
+    Spline through every other point is compared with the omitted points. That is the error of twice coarser
+    sampling, the error of the sampling is 16 times smaller (h^4). Errors at the end points are 0."""
+    ret = np.zeros(len(ph))
+    if len(ph) < 7:
+        return ret
+    for keep in (0, 1):
+        fit = np.arange(keep, len(ph), 2)
+        test = np.arange(1 - keep, len(ph), 2)
+        test = test[(test > fit[0]) & (test < fit[-1])]
+        spline = CubicSpline(ph[fit], values[fit])
+        ret[test] = np.abs(spline(ph[test]) - values[test]) / 16.0
+    return ret
+
+
+def refinement_ranges(ph: np.ndarray, columns: Sequence[np.ndarray], tolerance: float, min_step: float) \
+        -> List[Range]:
+    """Phase ranges (start, stop, step) to compute to bring interpolation error below `tolerance`
+
+    `columns` are curve values at sorted phases `ph`, `tolerance` is relative to amplitude of each column.
+    Step of a range is the local step halved as many times as needed for the error to drop below tolerance
+    (error ~ h^4), not finer than `min_step`."""
+    ph = np.asarray(ph, dtype=float)
+    if len(ph) < 7:
+        return []
+    error = np.zeros(len(ph))
+    for values in columns:
+        values = np.asarray(values, dtype=float)
+        amplitude = np.ptp(values)
+        if amplitude > 0.0 and np.all(np.isfinite(values)):
+            error = np.maximum(error, interpolation_errors(ph, values) / amplitude)
+    gaps = np.diff(ph)
+    local = np.maximum(np.concatenate([[gaps[0]], gaps]), np.concatenate([gaps, [gaps[-1]]]))
+    bad = np.flatnonzero((error > tolerance) & (local > min_step * 1.001))
+    ranges = []
+    for n in bad:
+        h = local[n]
+        halvings = max(math.ceil(0.25 * math.log2(error[n] / tolerance)), 1)
+        step = max(h / 2 ** halvings, min_step)
+        lo, hi = ph[max(n - 1, 0)], ph[min(n + 1, len(ph) - 1)]
+        if ranges and lo <= ranges[-1][1] + 1e-12:  # overlapping, merge with the finer step
+            prev_lo, prev_hi, prev_step = ranges[-1]
+            ranges[-1] = (prev_lo, max(prev_hi, hi), min(prev_step, step))
+        else:
+            ranges.append((lo, hi, step))
+    return [(round(float(lo), 12), round(float(hi), 12), round(float(step), 12)) for lo, hi, step in ranges]
+
+
+def model_digest(bundle) -> str:
+    """Digest of the model of `bundle` regardless of its phase range (`PHSTRT`, `PHSTOP`, `PHIN`)"""
+    from .cache import digest
+    from .config import cfg
+    from .runners import executable_identity, render_lcin
+    b = bundle.clone()
+    b['PHSTRT'], b['PHSTOP'], b['PHIN'] = 0.0, 1.0, 0.01
+    return digest(render_lcin(b), b.wdversion, executable_identity(cfg().get('executables', 'lc')))
+
+
+class SegmentResults(object):
+    """Computed points of curve models, by model digest
+
+    Parameters
+    ----------
+    column : str
+        Phase column of results
+    max_models : int
+        Number of recent models which points are kept (e.g. to reuse points after undo)
+    merge_gap : int
+        Missing points separated by at most `merge_gap` computed ones are computed by single range
+    """
+
+    def __init__(self, column: str = 'ph', max_models: int = 4, merge_gap: int = 4):
+        super(SegmentResults, self).__init__()
+        self.column = column
+        self.max_models = max_models
+        self.merge_gap = merge_gap
+        self._frames = OrderedDict()  # model digest: dataframe of points sorted by phase
+        self._lock = threading.Lock()
+
+    def add(self, key: str, frames: Sequence[pd.DataFrame]):
+        """Stores points of `frames` computed for model `key`"""
+        frames = [df for df in frames if df is not None and len(df)]
+        if not frames:
+            return
+        with self._lock:
+            if key in self._frames:
+                frames = [self._frames[key]] + frames
+            df = pd.concat(frames, ignore_index=True)
+            df = df[~df[self.column].round(6).duplicated()]
+            self._frames[key] = df.sort_values(self.column).reset_index(drop=True)
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.max_models:
+                self._frames.popitem(last=False)
+
+    def frame(self, key: str) -> Optional[pd.DataFrame]:
+        with self._lock:
+            return self._frames.get(key)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+    def split(self, key: str, ranges: Sequence[Range]) -> Tuple[List[pd.DataFrame], List[Range]]:
+        """Splits requested phase `ranges` into already computed points and ranges still to compute
+
+        Returns (dataframes of computed points of the ranges, ranges of missing points).
+        Point is computed if stored point is within min(1e-5, step/4) (lc prints rounded phases)."""
+        df = self.frame(key)
+        if df is None or not len(df):
+            return [], list(ranges)
+        stored = df[self.column].values
+        reused = []
+        missing = []
+        for start, stop, step in ranges:
+            points = range_phases(start, stop, step)
+            if not len(points):
+                continue
+            idx = np.clip(np.searchsorted(stored, points), 1, len(stored) - 1)
+            nearest = np.where(np.abs(stored[idx - 1] - points) <= np.abs(stored[idx] - points), idx - 1, idx)
+            have = np.abs(stored[nearest] - points) <= min(1e-5, step / 4.0)
+            if have.any():
+                reused.append(df.iloc[nearest[have]])
+            run = None  # [first, last] index of missing points
+            for n in np.flatnonzero(~have):
+                if run is not None and n - run[1] <= self.merge_gap + 1:
+                    run[1] = n
+                else:
+                    if run is not None:
+                        missing.append((points[run[0]], points[run[1]], step))
+                    run = [n, n]
+            if run is not None:
+                missing.append((points[run[0]], points[run[1]], step))
+        return reused, [(round(float(a), 12), round(float(b), 12), s) for a, b, s in missing]
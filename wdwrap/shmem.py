@@ -0,0 +1,132 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Shared-memory transport of `lc` results between local workers and client
+
+Worker writes output array into a file in shared memory directory (tmpfs `/dev/shm` by default)
+with `export` and returns only `SharedArray` handle. Client maps the file with `attach` (copy-on-write,
+no copy until array is written) and unlinks it, memory is freed when arrays are garbage collected.
+Arrays are stored column-major, so DataFrame columns are contiguous views of the mapping.
+
+Files of results never collected (e.g. cancelled jobs) are removed by `discard` or by `sweep` of stale files.
+"""
+import mmap
+import os
+import tempfile
+import time
+from typing import Optional
+
+import numpy as np
+
+PREFIX = 'wdwrap_shm-'
+
+_logger = None
+def logger():
+    global _logger
+    if _logger is None:
+        import logging
+        _logger = logging.getLogger('shmem')
+    return _logger
+
+
+class SharedArray(object):
+    """Handle of array exported to shared memory"""
+
+    def __init__(self, path: str, shape: tuple, dtype: str):
+        super(SharedArray, self).__init__()
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def __repr__(self):
+        return f'SharedArray({self.path}, {self.shape}, {self.dtype})'
+
+
+def default_directory() -> str:
+    """`/dev/shm` if available, system temp dir otherwise"""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def export(array, directory: Optional[str] = None) -> SharedArray:
+    """Writes `array` to shared memory file, returns handle"""
+    array = np.asarray(array)
+    if directory is None:
+        directory = default_directory()
+    fd, path = tempfile.mkstemp(prefix=PREFIX, dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(array.tobytes(order='F'))
+    except BaseException:
+        os.unlink(path)
+        raise
+    return SharedArray(path, array.shape, array.dtype.str)
+
+
+def attach(handle: SharedArray) -> np.ndarray:
+    """Maps exported array (zero-copy, copy-on-write), the file is unlinked"""
+    try:
+        if handle.nbytes == 0:
+            return np.empty(handle.shape, dtype=handle.dtype)
+        with open(handle.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), handle.nbytes, access=mmap.ACCESS_COPY)
+    finally:
+        _unlink(handle.path)
+    return np.frombuffer(mm, dtype=handle.dtype).reshape(handle.shape, order='F')
+
+
+def resolve(obj):
+    """Replaces handles in `obj` (nested dicts, lists, tuples) with attached arrays"""
+    if isinstance(obj, SharedArray):
+        return attach(obj)
+    if isinstance(obj, dict):
+        return {k: resolve(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(resolve(v) for v in obj)
+    return obj
+
+
+def discard(obj):
+    """Removes files of handles in `obj` (nested dicts, lists, tuples) without mapping them"""
+    if isinstance(obj, SharedArray):
+        _unlink(obj.path)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            discard(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            discard(v)
+
+
+def sweep(directory: Optional[str] = None, max_age: float = 3600.0) -> int:
+    """Removes shared memory files older than `max_age` [s], returns number of removed files"""
+    if directory is None:
+        directory = default_directory()
+    now = time.time()
+    ret = 0
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return 0
+    for f in entries:
+        if not f.name.startswith(PREFIX):
+            continue
+        try:
+            if now - f.stat().st_mtime > max_age and f.stat().st_uid == os.getuid():
+                os.unlink(f.path)
+                ret += 1
+        except OSError:
+            pass
+    if ret:
+        logger().info(f'Removed {ret} stale shared memory files from {directory}')
+    return ret
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -0,0 +1,159 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Staging of WD data files and `lc` executable on workers without shared filesystem
+
+`StagedFiles` is created on client: it describes WD data files (atmosphere and `limcof` tables) of WD versions
+and `lc` executables by their digests and (optionally) carries their compressed content.
+On worker `stage` makes sure identical files are present: worker's own files (e.g. of the same wdwrap
+installation) are only verified, missing or different files are written into staging directory,
+once per content (staging directory is reused by later workers of the host).
+Working directories (`wdwrap.tempdir`) and slim runner (`wdwrap.worker`) then use the staged files.
+
+Used by Dask `StagingPlugin` (`wdwrap.daskplugin`). Module needs standard library only.
+"""
+import hashlib
+import os
+import shutil
+import stat
+import zlib
+from typing import Dict, Iterable, Optional
+
+from .cache import digest
+from .tempdir import default_wd_files_path, set_wd_files_path
+
+_logger = None
+def logger():
+    global _logger
+    if _logger is None:
+        import logging
+        _logger = logging.getLogger('staging')
+    return _logger
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+_manifests = {}  # directory: (signature of its files, {file name: digest})
+
+
+def dir_manifest(directory: str) -> Dict[str, str]:
+    """Digests of files in `directory`, computed again only when the directory or any of its files changes"""
+    entries = [(f.name, f.path, f.stat()) for f in os.scandir(directory) if f.is_file()]
+    signature = (os.stat(directory).st_mtime_ns,
+                 sorted((name, st.st_size, st.st_mtime_ns) for name, _, st in entries))
+    cached = _manifests.get(directory)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    ret = {name: file_digest(path) for name, path, _ in entries}
+    _manifests[directory] = (signature, ret)
+    return ret
+
+
+def default_directory() -> str:
+    return os.path.expanduser('~/.cache/wdwrap/staged')
+
+
+class StagedFiles(object):
+    """WD data files and `lc` executables to be present on workers
+
+    Parameters
+    ----------
+    wdversions : iterable of str
+        WD versions which data files are staged, e.g. ['2015']
+    executables : iterable of str
+        `lc` executables as configured (name on PATH or path), executables not found on client are skipped
+    ship : bool
+        Carry compressed content of files, if `False` files are only verified on workers
+    """
+
+    def __init__(self, wdversions: Iterable[str] = (), executables: Iterable[str] = (), ship: bool = True):
+        super(StagedFiles, self).__init__()
+        self.wd_files = {}  # wdversion: {file name: digest}
+        self.executables = {}  # executable as configured: (file name, digest)
+        self.content = {}  # digest: compressed content
+        for version in wdversions:
+            src = default_wd_files_path(version)
+            self.wd_files[version] = dict(dir_manifest(src))
+            if ship:
+                for name, file_hash in self.wd_files[version].items():
+                    self._ship(os.path.join(src, name), file_hash)
+        for executable in executables:
+            path = shutil.which(executable)
+            if path is None:
+                logger().warning(f'Executable {executable} not found, it will not be staged')
+                continue
+            self.executables[executable] = (os.path.basename(path), self._add(path, ship))
+
+    def _add(self, path: str, ship: bool) -> str:
+        file_hash = file_digest(path)
+        if ship:
+            self._ship(path, file_hash)
+        return file_hash
+
+    def _ship(self, path: str, file_hash: str):
+        if file_hash not in self.content:
+            with open(path, 'rb') as fd:
+                self.content[file_hash] = zlib.compress(fd.read())
+
+    def stage(self, directory: Optional[str] = None, use_local: bool = True):
+        """Verifies or stages files on worker, configures `wdwrap.tempdir` and `wdwrap.worker` to use them
+
+        Worker's own files are used if identical (unless `use_local` is `False`), the rest is staged
+        in `directory` (default `~/.cache/wdwrap/staged`).
+        Raises `RuntimeError` if file is missing or different and its content is not shipped."""
+        from . import worker
+        if directory is None:
+            directory = default_directory()
+        for version, files in self.wd_files.items():
+            local = default_wd_files_path(version) if use_local else None
+            path = self._stage_dir(local, files, os.path.join(directory, 'wd-' + version))
+            set_wd_files_path(version, path)
+        for executable, (name, file_hash) in self.executables.items():
+            local = shutil.which(executable) if use_local else None
+            if local is not None and file_digest(local) == file_hash:
+                continue
+            path = os.path.join(directory, 'bin', file_hash[:16], name)
+            self._stage_file(path, file_hash, executable=True)
+            worker.set_executable(executable, path)
+
+    def _stage_dir(self, local: Optional[str], files: Dict[str, str], directory: str) -> str:
+        """Returns directory with `files`: `local` if it matches, staged copy otherwise"""
+        try:
+            if local is not None:
+                manifest = dir_manifest(local)
+                if all(manifest.get(name) == h for name, h in files.items()):
+                    return local
+        except OSError:
+            pass
+        directory = os.path.join(directory, digest(*(f'{n}:{d}' for n, d in sorted(files.items())))[:16])
+        marker = os.path.join(directory, '.complete')
+        if os.path.exists(marker):
+            return directory
+        for name, file_hash in files.items():
+            self._stage_file(os.path.join(directory, name), file_hash)
+        open(marker, 'w').close()
+        logger().info(f'WD files staged in {directory}')
+        return directory
+
+    def _stage_file(self, path: str, file_hash: str, executable: bool = False):
+        try:
+            if file_digest(path) == file_hash:
+                return
+        except OSError:
+            pass
+        try:
+            content = zlib.decompress(self.content[file_hash])
+        except KeyError:
+            raise RuntimeError(f'File {os.path.basename(path)} is missing or different on worker '
+                               f'and its content is not shipped')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as fd:
+            fd.write(content)
+        if executable:
+            os.chmod(tmp, os.stat(tmp).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        os.replace(tmp, path)
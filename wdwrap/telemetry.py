@@ -0,0 +1,269 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Per-job timing telemetry
+
+Every job scheduled by `JobScheduler` is run by `run_timed`, which collects `JobTiming` of the job:
+durations of stages
+    queue - from scheduling to start on worker (scheduler queue and backend queue)
+    render - rendering of lcin
+    setup - working directory lease and writing lcin
+    slot - waiting for CPU slot (`wdwrap.cpuslots`)
+    exec - `lc` run
+    parse - reading and converting `lc` output (on worker and on client)
+and resource usage of `lc` process: CPU time (user + system) and max RSS (from `wait4`).
+Runner code reports stages with `stage` context manager or `add`, it's no-op outside `run_timed`.
+Timing is attached to job future (`JobFuture.timing`).
+
+`Telemetry` aggregates timings of scheduler's jobs into histograms and counters,
+available by Python API and as Prometheus text (`prometheus_text`, `dump` to file
+e.g. for node exporter textfile collector). Configured by `[jobs] telemetry-file` and `telemetry-interval`.
+
+Module needs standard library only, it's used by slim worker runtime (`wdwrap.worker`).
+"""
+import os
+import sys
+import threading
+import time
+from configparser import NoSectionError, NoOptionError
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+STAGES = ('queue', 'render', 'setup', 'slot', 'exec', 'parse')
+
+_logger = None
+def logger():
+    global _logger
+    if _logger is None:
+        import logging
+        _logger = logging.getLogger('telemetry')
+    return _logger
+
+
+class JobTiming(object):
+    """Timing breakdown of a job: `stages` durations [s], `cpu_time` [s] and `max_rss` [bytes] of `lc`"""
+
+    def __init__(self):
+        super(JobTiming, self).__init__()
+        self.stages = {}
+        self.cpu_time = None
+        self.max_rss = None
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_usage(self, rusage):
+        """Adds resource usage (`resource.struct_rusage`) of finished `lc` process"""
+        self.cpu_time = (self.cpu_time or 0.0) + rusage.ru_utime + rusage.ru_stime
+        rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024  # Linux reports kB
+        self.max_rss = max(self.max_rss or 0, rss)
+
+    @property
+    def total(self) -> float:
+        return sum(self.stages.values())
+
+    def as_dict(self) -> dict:
+        return dict(self.stages, cpu_time=self.cpu_time, max_rss=self.max_rss)
+
+    def __repr__(self):
+        stages = ', '.join(f'{k}={v:.4f}' for k, v in self.stages.items())
+        return f'JobTiming({stages}, cpu_time={self.cpu_time}, max_rss={self.max_rss})'
+
+
+class Timed(object):
+    """Job result with its timing, returned by `run_timed`"""
+
+    __slots__ = ('value', 'timing')
+
+    def __init__(self, value, timing: JobTiming):
+        self.value = value
+        self.timing = timing
+
+    def __getstate__(self):
+        return self.value, self.timing
+
+    def __setstate__(self, state):
+        self.value, self.timing = state
+
+
+_current = threading.local()  # timing of job run by the thread
+
+
+def current() -> Optional[JobTiming]:
+    return getattr(_current, 'timing', None)
+
+
+def add(stage: str, seconds: float):
+    """Adds duration of `stage` to timing of current job"""
+    timing = current()
+    if timing is not None:
+        timing.add(stage, seconds)
+
+
+def add_usage(rusage):
+    timing = current()
+    if timing is not None and rusage is not None:
+        timing.add_usage(rusage)
+
+
+@contextmanager
+def stage(name: str):
+    """Measures duration of the block as `name` stage of current job"""
+    timing = current()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - start)
+
+
+def run_timed(fn, submitted: float, /, *args, **kwargs) -> Timed:
+    """Runs job `fn(*args, **kwargs)` collecting its timing, `submitted` is wall-clock time of scheduling"""
+    timing = JobTiming()
+    timing.add('queue', max(time.time() - submitted, 0.0))
+    previous = current()
+    _current.timing = timing
+    try:
+        value = fn(*args, **kwargs)
+    finally:
+        _current.timing = previous
+    return Timed(value, timing)
+
+
+class Histogram(object):
+    """Cumulative histogram (Prometheus style): counts of observations `<=` each bucket bound"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        super(Histogram, self).__init__()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[n] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket containing `q` percentile, `None` if empty or above the last bucket"""
+        if self.count == 0:
+            return None
+        rank = q / 100.0 * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return None
+
+
+class Telemetry(object):
+    """Aggregated timings of jobs of `JobScheduler`
+
+    Parameters
+    ----------
+    path : str or None
+        Prometheus text file written by `dump`, at most every `interval` seconds when jobs are recorded
+    interval : float
+        Min seconds between automatic dumps
+    """
+
+    TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                    120.0, 300.0)
+    RSS_BUCKETS = tuple(2**20 * m for m in (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048))
+
+    def __init__(self, path: Optional[str] = None, interval: float = 10.0):
+        super(Telemetry, self).__init__()
+        self.path = path
+        self.interval = interval
+        self._histograms = {}  # (metric, job kind, stage): Histogram
+        self._counters = {}  # (job kind, status): count
+        self._lock = threading.Lock()
+        self._last_dump = 0.0
+
+    def record(self, job_kind: str, timing: Optional[JobTiming], status: str = 'done'):
+        """Records finished job, `status`: 'done', 'failed', 'cancelled', 'cached' or 'invalid'"""
+        with self._lock:
+            key = (job_kind, status)
+            self._counters[key] = self._counters.get(key, 0) + 1
+            if timing is not None:
+                for name, seconds in timing.stages.items():
+                    self._observe('stage_seconds', job_kind, name, seconds, self.TIME_BUCKETS)
+                self._observe('stage_seconds', job_kind, 'total', timing.total, self.TIME_BUCKETS)
+                if timing.cpu_time is not None:
+                    self._observe('cpu_seconds', job_kind, None, timing.cpu_time, self.TIME_BUCKETS)
+                if timing.max_rss is not None:
+                    self._observe('max_rss_bytes', job_kind, None, timing.max_rss, self.RSS_BUCKETS)
+        if self.path is not None and time.monotonic() - self._last_dump >= self.interval:
+            self.dump()
+
+    def _observe(self, metric, job_kind, stage_name, value, buckets):
+        key = (metric, job_kind, stage_name)
+        h = self._histograms.get(key)
+        if h is None:
+            h = self._histograms[key] = Histogram(buckets)
+        h.observe(value)
+
+    def histogram(self, job_kind: str, stage_name: str = 'total', metric: str = 'stage_seconds') \
+            -> Optional[Histogram]:
+        """Histogram of `stage_name` durations (or of `metric` 'cpu_seconds', 'max_rss_bytes' with `stage_name=None`)"""
+        return self._histograms.get((metric, job_kind, stage_name))
+
+    def counter(self, job_kind: str, status: str = 'done') -> int:
+        return self._counters.get((job_kind, status), 0)
+
+    def counters(self) -> Dict[Tuple[str, str], int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def prometheus_text(self) -> str:
+        """Metrics in Prometheus text exposition format"""
+        lines = ['# HELP wdwrap_jobs_total Finished jobs by kind and status',
+                 '# TYPE wdwrap_jobs_total counter']
+        with self._lock:
+            for (kind, status), count in sorted(self._counters.items()):
+                lines.append(f'wdwrap_jobs_total{{kind="{kind}",status="{status}"}} {count}')
+            helps = {'stage_seconds': 'Duration of job stages [s]',
+                     'cpu_seconds': 'CPU time of lc process [s]',
+                     'max_rss_bytes': 'Max resident set size of lc process [bytes]'}
+            for metric, help_text in helps.items():
+                name = f'wdwrap_job_{metric}'
+                entries = sorted((k, h) for k, h in self._histograms.items() if k[0] == metric)
+                if not entries:
+                    continue
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (_, kind, stage_name), h in entries:
+                    labels = f'kind="{kind}"' + (f',stage="{stage_name}"' if stage_name is not None else '')
+                    for bound, count in zip(h.buckets, h.counts):
+                        lines.append(f'{name}_bucket{{{labels},le="{bound:g}"}} {count}')
+                    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {h.count}')
+                    lines.append(f'{name}_sum{{{labels}}} {h.sum:.6g}')
+                    lines.append(f'{name}_count{{{labels}}} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: Optional[str] = None):
+        """Writes `prometheus_text` to file `path` (default `self.path`) atomically"""
+        path = path or self.path
+        self._last_dump = time.monotonic()
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as fd:
+                fd.write(self.prometheus_text())
+            os.replace(tmp, path)
+        except OSError as e:
+            logger().warning(f'Cannot write telemetry to {path}: {e}')
+
+    @classmethod
+    def from_config(cls) -> 'Telemetry':
+        """Telemetry configured in `[jobs]` section"""
+        from .config import cfg
+        c = cfg()
+        try:
+            path = c.get('jobs', 'telemetry-file').strip() or None
+        except (NoSectionError, NoOptionError):
+            path = None
+        if path is not None:
+            path = os.path.expanduser(path)
+        return cls(path=path, interval=c.getfloat('jobs', 'telemetry-interval', fallback=10.0))
@@ -1,8 +1,29 @@
+import atexit
 import os
 import shutil
+import threading
+from configparser import NoSectionError, NoOptionError
 from tempfile import mkdtemp
+from typing import Optional
 
-from .io import Writer_lcin
+
+
+def default_wd_files_path(subdir='') -> str:
+    """WD files provided with module (same as `IO.default_wd_files_path`, without importing `wdwrap.io`)"""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'default_wd_files', subdir)
+
+
+_wd_files_paths = {}  # wdversion: directory of WD files staged on worker (see `wdwrap.staging`)
+
+
+def set_wd_files_path(wdversion: str, path: str):
+    """Working directories of `wdversion` will link WD files from `path`"""
+    _wd_files_paths[wdversion] = path
+
+
+def wd_files_path(wdversion: str) -> str:
+    """Directory of WD files of `wdversion`, staged or provided with module"""
+    return _wd_files_paths.get(wdversion) or default_wd_files_path(wdversion)
 
 
 class TmpDir:
@@ -11,9 +32,9 @@ class TmpDir:
     """
     path = None
 
-    def __init__(self, delete_on_exit=True):
+    def __init__(self, delete_on_exit=True, root=None):
         self.delete_on_exit = delete_on_exit
-        self.path = mkdtemp(prefix='wdwrap_')
+        self.path = mkdtemp(prefix='wdwrap_', dir=root)
         self._init_dir()
 
     def _init_dir(self):
@@ -42,13 +63,169 @@ class TmpDir:
 
 class WdTempDir(TmpDir):
 
-    def __init__(self, wdversion: str, delete_on_exit=True):
+    def __init__(self, wdversion: str, delete_on_exit=True, root=None):
         self.wdversion = wdversion
-        super().__init__(delete_on_exit)
+        super().__init__(delete_on_exit, root=root)
 
     def _init_dir(self):
         TmpDir._init_dir(self)
-        srcdir = os.path.join(Writer_lcin.default_wd_files_path(), self.wdversion)
+        srcdir = wd_files_path(self.wdversion)
 
+        self.initial_files = set()
         for f in os.scandir(srcdir):
             os.symlink(f.path, os.path.join(self.path, f.name))
+            self.initial_files.add(f.name)
+
+    def clean(self):
+        """Removes everything but initial WD files (symlinks), i.e. outputs of the run"""
+        for f in os.scandir(self.path):
+            if f.name in self.initial_files and f.is_symlink():
+                continue
+            try:
+                if f.is_dir(follow_symlinks=False):
+                    shutil.rmtree(f.path)
+                else:
+                    os.remove(f.path)
+            except OSError:
+                pass
+
+    def disk_usage(self) -> int:
+        """Bytes occupied by directory entries (symlinks are not followed)"""
+        ret = 0
+        for f in os.scandir(self.path):
+            try:
+                ret += f.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
+        return ret
+
+
+class PooledWdDir:
+    """Working directory leased from `WdDirPool`, returned to pool on context exit"""
+
+    def __init__(self, pool: 'WdDirPool', wddir: WdTempDir):
+        self.pool = pool
+        self.wddir = wddir
+
+    @property
+    def path(self):
+        return self.wddir.path
+
+    def __enter__(self):
+        return self.path
+
+    def __exit__(self, type_, value, traceback):
+        self.pool.release(self)
+
+    def __str__(self):
+        return self.path
+
+
+class WdDirPool:
+    """Pool of pre-initialised WD working directories
+
+    Directories (with WD files symlinked) are created once and recycled, only outputs
+    of the run are cleaned when directory is returned to the pool.
+
+    Parameters
+    ----------
+    root : str or None
+        Where directories are created (e.g. tmpfs `/dev/shm`), `None` for system temp directory
+    max_idle : int
+        Max number of idle directories kept in pool
+    max_disk : int
+        Max number of bytes occupied by idle directories, directories above limit are removed
+    """
+
+    _defaultInstance = None
+    _defaultLock = threading.Lock()  # default instance is requested concurrently by worker threads
+
+    def __init__(self, root: Optional[str] = None, max_idle: int = 16, max_disk: int = 64 * 2**20):
+        super().__init__()
+        self.root = root
+        self.max_idle = max_idle
+        self.max_disk = max_disk
+        self._idle = {}  # wdversion: list of WdTempDir
+        self._idle_usage = {}  # path: bytes
+        self._leased = set()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        atexit.register(self.clear)
+
+    def workdir(self, wdversion: str) -> PooledWdDir:
+        """Leases directory, use as context manager: `with pool.workdir('2015') as path: ...`"""
+        if self._pid != os.getpid():
+            self._forget_forked()
+        with self._lock:
+            try:
+                d = self._idle[wdversion].pop()
+                self._idle_usage.pop(d.path, None)
+            except (KeyError, IndexError):
+                d = None
+        if d is None:
+            d = WdTempDir(wdversion, delete_on_exit=False, root=self.root)
+        with self._lock:
+            self._leased.add(d)
+        return PooledWdDir(self, d)
+
+    def release(self, pooled: PooledWdDir):
+        d = pooled.wddir
+        d.clean()
+        usage = d.disk_usage()
+        with self._lock:
+            self._leased.discard(d)
+            if self.idle_count() < self.max_idle and sum(self._idle_usage.values()) + usage <= self.max_disk:
+                self._idle.setdefault(d.wdversion, []).append(d)
+                self._idle_usage[d.path] = usage
+                return
+        d.rm_dir()
+
+    def _forget_forked(self):
+        """In forked process, directories of parent process pool must not be used or removed"""
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._idle_usage = {}
+        self._leased = set()
+        self._pid = os.getpid()
+
+    def idle_count(self) -> int:
+        return sum(len(l) for l in self._idle.values())
+
+    def leased_count(self) -> int:
+        return len(self._leased)
+
+    def clear(self):
+        """Removes all directories (including leased ones)"""
+        if self._pid != os.getpid():
+            self._forget_forked()
+            return
+        with self._lock:
+            dirs = [d for l in self._idle.values() for d in l] + list(self._leased)
+            self._idle = {}
+            self._idle_usage = {}
+            self._leased = set()
+        for d in dirs:
+            d.rm_dir()
+
+    @classmethod
+    def default_instance(cls) -> 'WdDirPool':
+        if cls._defaultInstance is None:
+            with cls._defaultLock:
+                if cls._defaultInstance is None:
+                    cls._defaultInstance = cls.from_config()
+        return cls._defaultInstance
+
+    @classmethod
+    def from_config(cls) -> 'WdDirPool':
+        """Creates pool configured in `[workdirs]` section"""
+        from .config import cfg
+        c = cfg()
+        try:
+            root = c.get('workdirs', 'root').strip() or None
+        except (NoSectionError, NoOptionError):
+            root = None
+        if root is not None and not os.path.isdir(root):
+            root = None
+        max_idle = c.getint('workdirs', 'pool-size', fallback=16)
+        max_disk = int(c.getfloat('workdirs', 'max-disk', fallback=64) * 2**20)
+        return cls(root=root, max_idle=max_idle, max_disk=max_disk)
@@ -0,0 +1,266 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Pre-flight validation of bundles
+
+Bundles which `lc` cannot compute (or computes garbage for) are rejected before they reach a worker:
+    * surface potentials beyond critical Roche lobes for the `MODE`:
+      detached stars (MODE -1, 0, 2) have to be inside their limiting lobes, so the detached star of semi-detached
+      systems (MODE 4, 5), overcontact envelope (MODE 1, 3) has to be between inner (L1) and outer (L2)
+      critical potentials and the orbit has to be circular,
+    * values outside physical limits of parameters (`Parameter.min`, `Parameter.max`),
+    * inconsistent output settings: empty phase/time grid, `MPAGE=3` without spectral lines collections.
+
+Critical potentials follow Wilson (1979) generalisation for non-synchronous rotation (F1, F2)
+and eccentric orbits, evaluated at periastron separation (D = 1 - e) where lobes are the smallest.
+Potential of star 2 is expressed in star 1 frame (as WD's POTC).
+
+Checks of Roche geometry are vectorised: `roche_problems` takes arrays of parameters (e.g. of grid scan),
+`check_arrays` checks arrays of parameters varied over base bundle, `problems_many` checks batch of bundles
+at once. `JobScheduler` rejects invalid jobs with `ValidationError` (`[jobs] validate`).
+"""
+from functools import lru_cache
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from .exceptions import ValidationError
+
+# relative tolerance of potential comparisons, lc accepts potentials equal to critical ones
+_TOLERANCE = 1e-6
+
+DETACHED_MODES = (-1, 0, 2)
+OVERCONTACT_MODES = (1, 3)
+
+
+def _solve(g, dg, lo, hi, x, tolerance: float = 1e-12, iterations: int = 100):
+    """Roots of increasing function `g` (derivative `dg`) bracketed element-wise by `lo`, `hi`
+
+    Newton iterations from `x`, steps leaving the bracket are replaced by bisection."""
+    for _ in range(iterations):
+        gx = g(x)
+        negative = gx < 0.0
+        lo = np.where(negative, x, lo)
+        hi = np.where(negative, hi, x)
+        step = x - gx / dg(x)
+        step = np.where((step > lo) & (step < hi), step, 0.5 * (lo + hi))
+        done = np.all(np.abs(step - x) <= tolerance * np.abs(x))
+        x = step
+        if done:
+            break
+    return x
+
+
+def _potential(x, q, f, d):
+    """Roche potential of star 1 on the line of centres"""
+    return 1.0 / np.abs(x) + q * (1.0 / np.abs(d - x) - x / d ** 2) + 0.5 * f ** 2 * (1.0 + q) * x ** 2
+
+
+def _inner_critical(q, f, d):
+    """Potential at inner Lagrangian point of star 1 lobe"""
+    k = f ** 2 * (1.0 + q)
+    x = _solve(lambda x: -1.0 / x ** 2 + q * (1.0 / (d - x) ** 2 - 1.0 / d ** 2) + k * x,
+               lambda x: 2.0 / x ** 3 + 2.0 * q / (d - x) ** 3 + k,
+               np.zeros_like(q), d, d / (1.0 + np.sqrt(q)))
+    return _potential(x, q, f, d)
+
+
+def critical_potentials(q, f1=1.0, f2=1.0, e=0.0):
+    """Inner (L1) critical potentials of star 1 and star 2 (in star 1 frame, as WD's POTH, POTC), vectorised
+
+    Parameters
+    ----------
+    q : float or array
+        Mass ratio m2/m1 (RM)
+    f1, f2 : float or array
+        Rotation to orbital rate ratios (F1, F2)
+    e : float or array
+        Eccentricity, lobes are evaluated at periastron
+
+    Returns
+    -------
+    (pot1, pot2) : arrays
+    """
+    q, f1, f2, e = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (q, f1, f2, e)))
+    d = 1.0 - e
+    pot1 = _inner_critical(q, f1, d)
+    pot2 = q * _inner_critical(1.0 / q, f2, d) + 0.5 * (1.0 - q)  # star 2 frame (mass ratio 1/q) to star 1 frame
+    return pot1, pot2
+
+
+def outer_critical_potential(q):
+    """Outer (L2) critical potential of common envelope of synchronous circular system, vectorised"""
+    q = np.asarray(q, dtype=float)
+    one = np.ones_like(q)
+    # outer points lie beyond star 2 (x > 1) and beyond star 1 (x < 0), envelope leaks through the higher one
+    beyond2 = _solve(lambda x: -1.0 / x ** 2 - q / (x - 1.0) ** 2 - q + (1.0 + q) * x,
+                     lambda x: 2.0 / x ** 3 + 2.0 * q / (x - 1.0) ** 3 + 1.0 + q,
+                     one, one * 3.0, one * 1.5)
+    beyond1 = _solve(lambda x: 1.0 / x ** 2 + q / (1.0 - x) ** 2 - q + (1.0 + q) * x,
+                     lambda x: -2.0 / x ** 3 + 2.0 * q / (1.0 - x) ** 3 + 1.0 + q,
+                     -one * 3.0, 0.0 * one, -one * 0.5)
+    return np.maximum(_potential(beyond2, q, one, one), _potential(beyond1, q, one, one))
+
+
+@lru_cache(maxsize=1024)
+def _critical_scalar(q: float, f1: float, f2: float, e: float):
+    """Cached (inner 1, inner 2, outer) critical potentials of single point, fits often repeat the geometry"""
+    pot1, pot2 = critical_potentials(q, f1, f2, e)
+    sync1, _ = critical_potentials(q)
+    return float(pot1), float(pot2), float(sync1), float(outer_critical_potential(q))
+
+
+def _critical(q, f1, f2, e, contact: bool):
+    if q.size == 1:
+        return [np.full(q.shape, v) for v in _critical_scalar(*(float(a.flat[0]) for a in (q, f1, f2, e)))]
+    crit1, crit2 = critical_potentials(q, f1, f2, e)
+    if contact:
+        sync1, _ = critical_potentials(q)
+        outer = outer_critical_potential(q)
+    else:
+        sync1 = outer = None
+    return crit1, crit2, sync1, outer
+
+
+def roche_problems(mode, rm, f1, f2, e, poth, potc) -> Dict[str, np.ndarray]:
+    """Checks potentials against critical Roche potentials for `mode`, vectorised
+
+    Arguments are values (or arrays of values, broadcast together) of parameters MODE, RM, F1, F2, E, POTH, POTC.
+    Returns dict {problem description: boolean array of invalid points}, only problems present in any point."""
+    mode, q, f1, f2, e, poth, potc = np.broadcast_arrays(
+        np.asarray(mode, dtype=int), *(np.asarray(v, dtype=float) for v in (rm, f1, f2, e, poth, potc)))
+    ret = {}
+    bad_orbit = ~((q > 0.0) & (e >= 0.0) & (e < 1.0) & (f1 > 0.0) & (f2 > 0.0))
+    if bad_orbit.any():
+        ret['RM, F1, F2 have to be positive and 0 <= E < 1'] = bad_orbit.copy()
+    ok = ~bad_orbit
+    # placeholders for invalid points, they are reported already
+    q, f1, f2, e = (np.where(ok, v, default) for v, default in ((q, 1.0), (f1, 1.0), (f2, 1.0), (e, 0.0)))
+    contact = ok & np.isin(mode, OVERCONTACT_MODES)
+    crit1, crit2, sync1, outer = _critical(q, f1, f2, e, contact.any())
+    detached = np.isin(mode, DETACHED_MODES)
+    overflow1 = ok & (detached | (mode == 5)) & (poth < crit1 * (1.0 - _TOLERANCE))
+    overflow2 = ok & (detached | (mode == 4)) & (potc < crit2 * (1.0 - _TOLERANCE))
+    if overflow1.any():
+        ret['POTH beyond critical Roche lobe of star 1 for detached star'] = overflow1
+    if overflow2.any():
+        ret['POTC beyond critical Roche lobe of star 2 for detached star'] = overflow2
+    if contact.any():
+        eccentric = contact & (e != 0.0)
+        if eccentric.any():
+            ret['overcontact MODE requires circular orbit (E = 0)'] = eccentric
+        envelope = contact & ((poth > sync1 * (1.0 + _TOLERANCE)) | (poth < outer * (1.0 - _TOLERANCE)))
+        if envelope.any():
+            ret['POTH of overcontact envelope outside inner and outer critical potentials'] = envelope
+    return ret
+
+
+def _value(bundle, name, default=None):
+    try:
+        return bundle[name].val
+    except (KeyError, AttributeError):
+        return default
+
+
+def _roche_values(bundles: Sequence) -> dict:
+    names = ['MODE', 'RM', 'F1', 'F2', 'E', 'POTH', 'POTC']
+    defaults = [2, 1.0, 1.0, 1.0, 0.0, np.inf, np.inf]
+    return {n.lower(): np.array([_value(b, n, d) for b in bundles], dtype=float) for n, d in zip(names, defaults)}
+
+
+def range_problems(bundle) -> List[str]:
+    """Parameters (including collections) outside physical limits `Parameter.min`, `Parameter.max`"""
+    ret = []
+    params = []
+    for v in bundle.values():
+        if isinstance(v, list):  # collection of lines
+            params.extend(p for line in v for p in line.values())
+        else:
+            params.append(v)
+    for p in params:
+        val = p.val
+        if p.min is None and p.max is None or not isinstance(val, (int, float)) or val == p.nan_value:
+            continue
+        if (p.min is not None and val < p.min) or (p.max is not None and val > p.max):
+            ret.append(f'{p.name()}={val} outside [{p.min}, {p.max}]')
+    return ret
+
+
+def consistency_problems(bundle) -> List[str]:
+    """Output settings `lc` cannot handle"""
+    ret = []
+    if _value(bundle, 'JDPHS') == 1:
+        start, stop, step = (_value(bundle, n) for n in ('HJDST', 'HJDSP', 'HJDIN'))
+        grid = 'HJDST, HJDSP, HJDIN'
+    else:
+        start, stop, step = (_value(bundle, n) for n in ('PHSTRT', 'PHSTOP', 'PHIN'))
+        grid = 'PHSTRT, PHSTOP, PHIN'
+    if None not in (start, stop, step) and (step <= 0.0 or stop < start):
+        ret.append(f'empty output grid ({grid} = {start}, {stop}, {step})')
+    if _value(bundle, 'MPAGE') == 3 and not ('spectral1' in bundle and 'spectral2' in bundle):
+        ret.append('MPAGE=3 (line profiles) requires spectral lines of both stars')
+    return ret
+
+
+def problems_many(bundles: Sequence) -> List[List[str]]:
+    """Problems of each of `bundles`, Roche geometry is checked for all bundles at once"""
+    bundles = list(bundles)
+    if not bundles:
+        return []
+    ret = [range_problems(b) + consistency_problems(b) for b in bundles]
+    values = _roche_values(bundles)
+    for problem, mask in roche_problems(**values).items():
+        for n in np.flatnonzero(mask):
+            ret[n].append(problem)
+    return ret
+
+
+def problems(bundle) -> List[str]:
+    """Problems of `bundle`, empty list for valid bundle"""
+    return problems_many([bundle])[0]
+
+
+def check(bundle):
+    """Raises `ValidationError` if `bundle` is invalid"""
+    found = problems(bundle)
+    if found:
+        raise ValidationError(found)
+
+
+def check_arrays(base, **arrays) -> Dict[str, np.ndarray]:
+    """Checks points of parameter space: `arrays` of parameter values (by name) varied over `base` bundle
+
+    E.g. `check_arrays(bundle, POTH=np.linspace(2, 10, 1000), RM=q_grid)`. Arrays are broadcast together.
+    Returns dict {problem description: boolean array of invalid points}. Problems of `base` bundle itself
+    (other than of varied parameters) are not reported, check it with `problems`.
+    """
+    values = _roche_values([base])
+    values = {k: v[0] for k, v in values.items()}
+    shape = np.broadcast(*(np.asarray(a) for a in arrays.values())).shape if arrays else ()
+    ret = {}
+    for name, a in arrays.items():
+        a = np.asarray(a)
+        key = name.lower()
+        if key in values:
+            values[key] = a
+        try:
+            p = base[name]
+        except KeyError:
+            raise KeyError(f'Unknown parameter {name}')
+        outside = np.zeros(a.shape, dtype=bool)
+        if p.min is not None:
+            outside |= a < p.min
+        if p.max is not None:
+            outside |= a > p.max
+        if outside.any():
+            ret[f'{name} outside [{p.min}, {p.max}]'] = np.broadcast_to(outside, shape)
+    for problem, mask in roche_problems(**values).items():
+        ret[problem] = np.broadcast_to(mask, shape)
+    return ret
+
+
+def valid_mask(base, **arrays) -> np.ndarray:
+    """Boolean array of valid points of `check_arrays`"""
+    shape = np.broadcast(*(np.asarray(a) for a in arrays.values())).shape if arrays else ()
+    ret = np.ones(shape, dtype=bool)
+    for mask in check_arrays(base, **arrays).values():
+        ret &= ~mask
+    return ret
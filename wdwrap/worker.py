@@ -0,0 +1,265 @@
+#  Copyright (c) 2020. Mikolaj Kaluszynski et. al. CAMK, AkondLab
+"""Slim worker runtime of `lc` jobs
+
+Workers run pre-rendered job specs (see `LcRunner.job_spec`) with `run_lc`, which is pickled by reference.
+The module needs only numpy and standard library (with lightweight `wdwrap.config`, `wdwrap.cpuslots`,
+`wdwrap.tempdir`), `pandas`, `astropy` and parameter classes are not imported on worker.
+Runner is created once per worker process (`runner()`), Dask workers create it on start by `SlimWorkerPlugin`
+(`wdwrap.daskplugin`).
+
+Job spec is a dict:
+    lcin : str
+        Content of lcin file
+    wdversion : str
+        WD version, selects WD data files of working directory
+    executable : str
+        `lc` executable
+    timeout : float or None
+        Max time of `lc` run [s]
+    outputs : list of str
+        Output files to be read, e.g. ['light', 'veloc']
+    shared_memory : bool, optional
+        Return arrays as shared memory handles (see `wdwrap.shmem`), for workers on client's host
+    shm_dir : str, optional
+        Shared memory directory, default `/dev/shm`
+    shared : dict, optional
+        Objects shipped to worker once (see `Backend.share`), e.g. `observations`
+    reduce : dict, optional
+        For `run_reduce`: `output` name, indices of `ph` and `value` columns and `residuals` flag
+Worker returns dict {output name: list of 2D arrays}, one array per block of the output
+(blocks are separated by header lines in multi-bundle runs).
+
+Tasks of batch array jobs (`BatchBackend`) are run by `main` on batch nodes.
+"""
+import os
+import pickle
+import re
+import select
+import subprocess
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from . import reduction, shmem, telemetry
+from .cpuslots import CpuSlots
+from .exceptions import JobCancelledError
+from .tempdir import WdDirPool
+
+_logger = None
+def logger():
+    global _logger
+    if _logger is None:
+        import logging
+        _logger = logging.getLogger('worker')
+    return _logger
+
+
+def check_errors(errs: str):
+    """Raises `RuntimeError` if `lc` reported error on stderr"""
+    errors = re.search(r'error:\s*(.*)', errs)
+    if errors:
+        raise RuntimeError('lc error: ' + errors.groups()[0])
+
+
+def kill(proc):
+    try:
+        proc.kill()
+        logger().info(f'Canceling job. Killing')
+    except (AttributeError, ProcessLookupError):
+        pass
+
+
+def communicate(proc, timeout=None, cancel_token=None, poll_interval=0.1):
+    """Reads stdout and stderr pipes of `proc` till it exits, kills it on `timeout` or when `cancel_token` is set
+
+    Process is reaped by `os.wait4` (its `returncode` is set), returns `(stdout, stderr, rusage)`,
+    `rusage` is resource usage (`resource.struct_rusage`) of the process."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    pipes = [p for p in (proc.stdout, proc.stderr) if p is not None]
+    output = {p: [] for p in pipes}
+    while pipes:
+        wait = None if cancel_token is None else poll_interval
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0.0)
+            wait = remaining if wait is None else min(wait, remaining)
+        ready, _, _ = select.select(pipes, [], [], wait)
+        for p in ready:
+            data = os.read(p.fileno(), 2**16)
+            if data:
+                output[p].append(data)
+            else:  # closed by finished process
+                pipes.remove(p)
+        if cancel_token is not None and cancel_token.is_set():
+            kill(proc)
+            _reap(proc)
+            raise JobCancelledError()
+        if deadline is not None and time.monotonic() >= deadline:
+            logger().info(f'Timeout ({timeout}s) occurred. Killing')
+            proc.kill()
+            _reap(proc)
+            raise TimeoutError
+    rusage = _reap(proc)
+    return tuple(None if p is None else b''.join(output[p]).decode(errors='replace')
+                 for p in (proc.stdout, proc.stderr)) + (rusage,)
+
+
+def _reap(proc):
+    """Waits for `proc` by `os.wait4`, closes its pipes, returns its resource usage"""
+    for p in (proc.stdin, proc.stdout, proc.stderr):
+        if p is not None:
+            p.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+def read_blocks(filepath: str) -> List[np.ndarray]:
+    """Reads `lc` output table as list of 2D arrays, table is split at header lines"""
+    blocks = []
+    rows = None
+    with open(filepath) as fd:
+        for l in fd:
+            if '#' in l[:2]:
+                rows = []
+                blocks.append(rows)
+            elif l.strip():
+                if rows is None:
+                    rows = []
+                    blocks.append(rows)
+                rows.append([float(s.replace('D', 'E')) for s in l.split()])  # Fortran exponent
+    return [np.array(b, dtype=float) for b in blocks]
+
+
+_executables = {}  # executable of job spec: executable staged on worker (see `wdwrap.staging`)
+
+
+def set_executable(executable: str, path: str):
+    """Jobs of `executable` will run `path` instead"""
+    _executables[executable] = path
+
+
+def executable_path(executable: str) -> str:
+    """Executable to run for configured `executable`, staged one if set by `set_executable`"""
+    return _executables.get(executable, executable)
+
+
+class SlimLcRunner(object):
+    """Runs `lc` job specs, one instance per worker process"""
+
+    poll_interval = 0.1  # how often cancel token is checked [s]
+
+    def __init__(self):
+        super(SlimLcRunner, self).__init__()
+        WdDirPool.default_instance()  # configure worker singletons upfront
+        CpuSlots.default_instance()
+
+    def run(self, spec: dict, cancel_token=None) -> Dict[str, List[np.ndarray]]:
+        try:
+            if cancel_token is not None and cancel_token.is_set():  # cancelled while queued
+                raise JobCancelledError()
+            start = time.perf_counter()
+            with WdDirPool.default_instance().workdir(spec['wdversion']) as d:
+                with open(os.path.join(d, 'lcin.active'), 'w') as fd:
+                    fd.write(spec['lcin'])
+                telemetry.add('setup', time.perf_counter() - start)
+                self.execute(executable_path(spec['executable']), d,
+                             timeout=spec.get('timeout'), cancel_token=cancel_token)
+                with telemetry.stage('parse'):
+                    ret = {}
+                    for name in spec.get('outputs', ['light', 'veloc']):
+                        try:
+                            ret[name] = read_blocks(os.path.join(d, name + '.dat'))
+                        except IOError:
+                            pass
+            if spec.get('shared_memory'):
+                with telemetry.stage('parse'):
+                    ret = {name: [shmem.export(b, spec.get('shm_dir')) for b in blocks]
+                           for name, blocks in ret.items()}
+        finally:
+            if cancel_token is not None:
+                cancel_token.release()
+        return ret
+
+    def execute(self, executable, directory, timeout=None, cancel_token=None):
+        slots = CpuSlots.default_instance()
+        deadline = None if timeout is None else time.monotonic() + timeout  # includes waiting for slot
+        with telemetry.stage('slot'):
+            slot = None if slots is None else slots.acquire(cancel_token, timeout)
+        try:
+            with telemetry.stage('exec'):
+                proc = subprocess.Popen([executable], cwd=directory,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        preexec_fn=slot and slot.preexec_fn())
+                if deadline is not None:
+                    timeout = max(deadline - time.monotonic(), 0.0)
+                outs, errs, rusage = communicate(proc, timeout, cancel_token, self.poll_interval)
+            telemetry.add_usage(rusage)
+        finally:
+            if slot is not None:
+                slot.release()
+        check_errors(errs)
+
+
+_runner: Optional[SlimLcRunner] = None
+
+
+def runner() -> SlimLcRunner:
+    """Runner of this worker process, created on first use"""
+    global _runner
+    if _runner is None:
+        _runner = SlimLcRunner()
+    return _runner
+
+
+def run_lc(spec: dict, cancel_token=None) -> Dict[str, List[np.ndarray]]:
+    """Job function submitted to workers"""
+    return runner().run(spec, cancel_token=cancel_token)
+
+
+def run_reduce(spec: dict, cancel_token=None) -> dict:
+    """Job function submitted to workers, returns chi² of the model against `shared['observations']`"""
+    params = spec['reduce']
+    output = runner().run(dict(spec, shared_memory=False), cancel_token=cancel_token)
+    blocks = output.get(params['output']) or []
+    if not blocks:
+        raise RuntimeError(f'lc produced no {params["output"]} output')
+    with telemetry.stage('parse'):
+        data = np.concatenate(blocks)
+        ret = reduction.reduce(data[:, params['ph']], data[:, params['value']], spec['shared']['observations'],
+                               residuals=params.get('residuals', False))
+    if spec.get('shared_memory') and 'residuals' in ret:
+        ret['residuals'] = shmem.export(ret['residuals'], spec.get('shm_dir'))
+    return ret
+
+
+def run_task(directory: str, index: int):
+    """Runs task `index` of array job rendered by `BatchBackend` into `directory`
+
+    Task `tasks/<index>.pkl` is (function, args, kwargs), outcome is written to `results/<index>.pkl`
+    as ('result', value) or ('error', exception). Result file appears atomically."""
+    with open(os.path.join(directory, 'tasks', f'{index}.pkl'), 'rb') as fd:
+        fn, args, kwargs = pickle.load(fd)
+    try:
+        ret = ('result', fn(*args, **kwargs))
+    except Exception as e:
+        ret = ('error', e)
+    path = os.path.join(directory, 'results', f'{index}.pkl')
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        data = pickle.dumps(ret)
+    except Exception as e:  # e.g. exception with unpicklable arguments
+        data = pickle.dumps(('error', RuntimeError(f'Task outcome cannot be pickled: {e!r}')))
+    with open(tmp, 'wb') as fd:
+        fd.write(data)
+    os.replace(tmp, path)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Entry point of batch tasks: `main([directory, index])`, index defaults to `$SLURM_ARRAY_TASK_ID`"""
+    import sys
+    if argv is None:
+        argv = sys.argv[1:]
+    directory = argv[0]
+    index = argv[1] if len(argv) > 1 else os.environ['SLURM_ARRAY_TASK_ID']
+    run_task(directory, int(index))